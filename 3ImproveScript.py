@@ -1,77 +1,117 @@
-def broilerBuffer(compound, massBroilerWaste, iterations):
+import math
+import os
+import broilerCache
+import broilerCompounds
+
+
+def writeBuffer(bufferLayer, outputFile, compound):
+    # Define options for writing the Buffer to a GeoPackage layer
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = f'{compound}Buffer'
+    options.layerOptions = ['SPATIAL_INDEX=YES']
+    # Replace only this layer if the GeoPackage already exists
+    if os.path.exists(outputFile):
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    # Write Buffer layer
+    QgsVectorFileWriter.writeAsVectorFormatV3(bufferLayer, outputFile, QgsCoordinateTransformContext(), options)
+    # Add Buffer layer to data frame
+    iface.addVectorLayer(f'{outputFile}|layername={compound}Buffer', f'{compound}Buffer', 'ogr')
+
+
+def broilerBuffer(compound, massBroilerWaste, iterations, useCache=True, filePath=None):
     # Set mass & concentration of compound
-    if compound == 'Nitrogen':
-        massCompound = massBroilerWaste * 30.714286
-        concCompound = 0.005
-    elif compound == 'Phosphorus':
-        massCompound = massBroilerWaste * 14.142857
-        concCompound = 0.0027
-    elif compound == 'Potassium':
-        massCompound = massBroilerWaste * 13.428571
-        concCompound = 0.0025
+    factor, concCompound = broilerCompounds.COMPOUNDS[compound]
+    massCompound = massBroilerWaste * factor
     
-    # Set file path to data folder
-    filePath = 'C:\\...\\3BaseScript\\'
+    # Set file path to data folder, by default the folder of the saved
+    # project, or the working folder when the project is not saved
+    if filePath is None:
+        filePath = QgsProject.instance().homePath() or os.getcwd()
     # Set file for Central Point
-    pointFile = 'Data\\CentralPoint.shp'
+    pointFile = os.path.join(filePath, 'Data', 'CentralPoint.shp')
     # Set file for Hydro data
-    hydroFile = 'Data\\HY_WATERCOURSE.shp'
+    hydroFile = os.path.join(filePath, 'Data', 'HY_WATERCOURSE.shp')
     # Set file for Roads data
-    roadFile = 'Data\\TR_ROAD.shp'
-    # Add Hydro layer to data frame
-    hydroLayer = iface.addVectorLayer(f'{filePath}{hydroFile}', 'Hydro', 'ogr')
-    # Add CentralPoint layer to data frame
-    roadLayer = iface.addVectorLayer(f'{filePath}{roadFile}', 'Roads', 'ogr')
-    # Add CentralPoint layer to data frame
-    pointLayer = iface.addVectorLayer(f'{filePath}{pointFile}', 'Central Point', 'ogr')
-
-    # Delete most Temp files
-    for files in os.listdir(f'{filePath}\\Temp'):
-        QgsVectorFileWriter.deleteShapeFile(f'{filePath}\\Temp\\{files}')
+    roadFile = os.path.join(filePath, 'Data', 'TR_ROAD.shp')
+    # Set GeoPackage the final Buffer is written to
+    outputFile = os.path.join(filePath, 'broilerBuffer.gpkg')
+    # Load Hydro layer without adding it to the map
+    hydroLayer = QgsVectorLayer(hydroFile, 'Hydro', 'ogr')
+    # Load Roads layer without adding it to the map
+    roadLayer = QgsVectorLayer(roadFile, 'Roads', 'ogr')
+    # Load CentralPoint layer without adding it to the map
+    pointLayer = QgsVectorLayer(pointFile, 'Central Point', 'ogr')
+
+    # Look for a stored result of an identical solve
+    if useCache:
+        cache = broilerCache.ResultCache()
+        dataVersion = broilerCache.hashData(
+            ((feature.id(), feature.geometry().asWkb()) for feature in hydroLayer.getFeatures()),
+            ((feature.id(), feature.geometry().asWkb()) for feature in roadLayer.getFeatures())
+        )
+        points = [(feature.geometry().asPoint().x(), feature.geometry().asPoint().y()) for feature in pointLayer.getFeatures()]
+        cacheKey = broilerCache.makeKey(
+            points,
+            massBroilerWaste,
+            compound,
+            {'hydro' : 50, 'road' : 40},
+            {'iterations' : iterations, 'segments' : 10, 'crs' : pointLayer.crs().authid()},
+            dataVersion
+        )
+        cached = cache.get(cacheKey)
+        if cached is not None:
+            geometries, statistics = cached
+            # Rebuild the final Buffer from the stored geometry
+            cachedLayer = QgsVectorLayer(f'Polygon?crs={pointLayer.crs().authid()}', f'{compound}Buffer', 'memory')
+            for wkb in geometries:
+                geometry = QgsGeometry()
+                geometry.fromWkb(wkb)
+                feature = QgsFeature()
+                feature.setGeometry(geometry)
+                cachedLayer.dataProvider().addFeature(feature)
+            writeBuffer(cachedLayer, outputFile, compound)
+            listAreaBuff = statistics['listAreaBuff']
+            print(f'{massBroilerWaste}t of broiler waste contains {int(round(statistics["massCompound"] / 1000))}t of {compound}, which covers {int(round(listAreaBuff[iterations] / 10000))} Ha (from result cache)')
+            print(f'Process increases area covered by {int(round((listAreaBuff[iterations] - listAreaBuff[0]) / 10000))} Ha')
+            print(f'This is {round(((listAreaBuff[iterations] / listAreaBuff[0]) - 1) * 100)}% larger than original area')
+            return
 
     # Define parameters for Hydro buffer
     hydroBuffParameters = {
     'INPUT' : hydroLayer,
     'DISTANCE' : 50,
     'DISSOLVE' : True,
-    'OUTPUT' : f'{filePath}Temp\\hydroBufferFile.shp'
+    'OUTPUT' : 'memory:'
     }
     # Run Hydro buffer process
-    processing.run('native:buffer', hydroBuffParameters)
-    # Add buffer layer to data frame
-    hydroBuffer = iface.addVectorLayer(f'{filePath}Temp\\hydroBufferFile.shp', 'Hydro Buffer', 'ogr')
+    hydroBuffer = processing.run('native:buffer', hydroBuffParameters)['OUTPUT']
 
     # Define parameters for Road buffer
     roadBuffParameters = {
     'INPUT' : roadLayer,
     'DISTANCE' : 40,
     'DISSOLVE' : True,
-    'OUTPUT' : f'{filePath}Temp\\roadBufferFile.shp'
+    'OUTPUT' : 'memory:'
     }
     # Run Road buffer process
-    processing.run('native:buffer', roadBuffParameters)
-    # Add buffer layer to data frame
-    roadBuffer = iface.addVectorLayer(f'{filePath}Temp\\roadBufferFile.shp', 'Road Buffer', 'ogr')
+    roadBuffer = processing.run('native:buffer', roadBuffParameters)['OUTPUT']
 
     # Define parameters for Merge process
     mergeParameters = {
     'LAYERS' : [hydroBuffer, roadBuffer],
-    'OUTPUT' : f'{filePath}Temp\\mergeFile.shp'
+    'OUTPUT' : 'memory:'
     }
     # Run Merge process
-    processing.run('qgis:mergevectorlayers', mergeParameters)
-    # Add merged layer to data frame
-    mergeBuffer = iface.addVectorLayer(f'{filePath}Temp\\mergeFile.shp', 'Merge Buffer', 'ogr')
+    mergeBuffer = processing.run('qgis:mergevectorlayers', mergeParameters)['OUTPUT']
 
     # Define parameters for Dissolve process
     dissolveParameters = {
     'INPUT' : mergeBuffer,
-    'OUTPUT' : f'{filePath}Temp\\dissolveFile.shp'
+    'OUTPUT' : 'memory:'
     }
     # Run Dissolve process
-    processing.run('qgis:dissolve', dissolveParameters)
-    # Add merged layer to data frame
-    dissolveBuffer = iface.addVectorLayer(f'{filePath}Temp\\dissolveFile.shp', 'Dissolve Buffer', 'ogr')
+    dissolveBuffer = processing.run('qgis:dissolve', dissolveParameters)['OUTPUT']
 
     # Establish reference lists
     listBuff = [0]
@@ -90,24 +130,20 @@ def broilerBuffer(compound, massBroilerWaste, iterations):
     'INPUT' : pointLayer,
     'DISTANCE' : listDistBuff[0],
     'SEGMENTS' : 10,
-    'OUTPUT' : f'{filePath}Temp\\Buffer0File.shp'
+    'OUTPUT' : 'memory:'
     }
     # Run Buffer0 process
-    processing.run('native:buffer', parametersBuffer)
-    # Add Buffer0 layer to data frame
-    listBuff[0] = iface.addVectorLayer(f'{filePath}Temp\\Buffer0File.shp', 'Buffer0', 'ogr')
+    listBuff[0] = processing.run('native:buffer', parametersBuffer)['OUTPUT']
 
     for count in range (1, iterations + 1):
         # Define parameters for Clip
         parametersClip = {
         'INPUT' : dissolveBuffer,
         'OVERLAY' : listBuff[count - 1],
-        'OUTPUT' : f'{filePath}Temp\\Clip{count}File.shp'
+        'OUTPUT' : 'memory:'
         }
         # Run Clip process
-        processing.run('qgis:clip', parametersClip)
-        # Add Clip layer to data frame
-        listClip.append(iface.addVectorLayer(f'{filePath}Temp\\Clip{count}File.shp', f'Clip{count}', 'ogr'))
+        listClip.append(processing.run('qgis:clip', parametersClip)['OUTPUT'])
 
         # Create list of Clip features
         featuresClip = listClip[count].getFeatures()
@@ -121,48 +157,32 @@ def broilerBuffer(compound, massBroilerWaste, iterations):
         # Calculate Buffer distance
         listDistBuff.append(math.sqrt(listAreaBuff[count] / math.pi))
 
-        # Cause final buffer to be saved permanently
-        if count == iterations:
-            # Define parameters for Buffer
-            parametersBuffer = {
-            'INPUT' : pointLayer,
-            'DISTANCE' : listDistBuff[count],
-            'SEGMENTS' : 10,
-            'OUTPUT' : f'{filePath}{compound}Buffer.shp'
-            }
-            # Run Buffer process
-            processing.run('native:buffer', parametersBuffer)
-            # Add Buffer layer to data frame
-            listBuff.append(iface.addVectorLayer(f'{filePath}{compound}Buffer.shp', f'Buffer{count}' ,'ogr'))
-        else:
-            # Define parameters for Buffer
-            parametersBuffer = {
-            'INPUT' : pointLayer,
-            'DISTANCE' : listDistBuff[count],
-            'SEGMENTS' : 10,
-            'OUTPUT' : f'{filePath}Temp\\Buffer{count}File.shp'
-            }
-            # Run Buffer process
-            processing.run('native:buffer', parametersBuffer)
-            # Add Buffer layer to data frame
-            listBuff.append(iface.addVectorLayer(f'{filePath}Temp\\Buffer{count}File.shp', f'Buffer{count}', 'ogr'))
+        # Define parameters for Buffer
+        parametersBuffer = {
+        'INPUT' : pointLayer,
+        'DISTANCE' : listDistBuff[count],
+        'SEGMENTS' : 10,
+        'OUTPUT' : 'memory:'
+        }
+        # Run Buffer process
+        listBuff.append(processing.run('native:buffer', parametersBuffer)['OUTPUT'])
+
+    # Write the final Buffer, the only file this process creates
+    writeBuffer(listBuff[iterations], outputFile, compound)
+
+    # Store result so identical reruns can skip the process
+    if useCache:
+        cache.put(
+            cacheKey,
+            [bytes(feature.geometry().asWkb()) for feature in listBuff[iterations].getFeatures()],
+            {'massCompound' : massCompound, 'listAreaBuff' : listAreaBuff, 'listAreaClip' : listAreaClip, 'listDistBuff' : listDistBuff}
+        )
 
     # Calculate area increase
     areaIncrease = listAreaBuff[iterations] - listAreaBuff[0]
     # Calculate percent increase
     pcIncrease = ((listAreaBuff[iterations] / listAreaBuff[0]) - 1) * 100
         
-    # Remove Temporary map layers
-    QgsProject.instance().removeMapLayer(hydroLayer)
-    QgsProject.instance().removeMapLayer(roadLayer)
-    QgsProject.instance().removeMapLayer(hydroBuffer)
-    QgsProject.instance().removeMapLayer(roadBuffer)
-    QgsProject.instance().removeMapLayer(mergeBuffer)
-    QgsProject.instance().removeMapLayer(dissolveBuffer)
-    for count in range(1, iterations+1):
-        QgsProject.instance().removeMapLayer(listBuff[count - 1])
-        QgsProject.instance().removeMapLayer(listClip[count])
-
     # Print areaBuffer3
     print(f'{massBroilerWaste}t of broiler waste contains {int(round(massCompound / 1000))}t of {compound}, which covers {int(round(listAreaBuff[iterations] / 10000))} Ha')
     # Print areaIncrease
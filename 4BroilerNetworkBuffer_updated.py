@@ -16,18 +16,49 @@ future.
 import math
 import os
 from qgis import processing
-from qgis.core import (QgsFeature,
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransform,
+                       QgsExpression,
+                       QgsFeature,
+                       QgsFeatureRequest,
                        QgsFeatureSink,
+                       QgsFeatureSource,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
                        QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingException,
                        QgsProcessingFeatureSource,
+                       QgsProcessingParameterBoolean,
                        QgsProcessingParameterEnum,
+                       QgsProcessingParameterExpression,
                        QgsProcessingParameterFeatureSink,
                        QgsProcessingParameterFeatureSource,
-                       QgsProcessingParameterNumber)
-from qgis.PyQt.QtCore import QCoreApplication
-from qgis.utils import iface
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterString,
+                       QgsProcessingUtils,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsUnitTypes,
+                       QgsWkbTypes)
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
+import broilerCache
+import broilerCompounds
+# The vectorised engine needs Shapely 2 and NumPy, which not every QGIS ships
+try:
+    import broilerAllocation
+    import broilerEngine
+    import broilerSeason
+    import broilerUncertainty
+except ImportError:
+    broilerAllocation = None
+    broilerEngine = None
+    broilerSeason = None
+    broilerUncertainty = None
 
 
 # Establish the processing algorithm
@@ -54,7 +85,52 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
     MASS = 'MASS'
     COMPOUND = 'COMPOUND'
     ITERATIONS = 'ITERATIONS'
+    ENGINE = 'ENGINE'
+    SIMPLIFY = 'SIMPLIFY'
+    ALLOCATE = 'ALLOCATE'
+    MASS_FIELD = 'MASS_FIELD'
+    PARCELS = 'PARCELS'
+    PARCEL_FILTER = 'PARCEL_FILTER'
+    USE_CACHE = 'USE_CACHE'
+    SAMPLES = 'SAMPLES'
+    DISTRIBUTIONS = 'DISTRIBUTIONS'
+    SCHEDULE = 'SCHEDULE'
+    UPTAKE = 'UPTAKE'
+    SEASON_STATE = 'SEASON_STATE'
     OUTPUT = 'OUTPUT'
+    SPREADABLE_OUTPUT = 'SPREADABLE_OUTPUT'
+    UNCERTAINTY_OUTPUT = 'UNCERTAINTY_OUTPUT'
+    SEASON_OUTPUT = 'SEASON_OUTPUT'
+    SEASON_STATE_OUTPUT = 'SEASON_STATE_OUTPUT'
+
+    # Buffer distances (in metres) applied to the networks
+    HYDRO_DISTANCE = 50
+    ROAD_DISTANCE = 40
+    # Number of segments used to approximate a quarter circle
+    SEGMENTS = 10
+    # Number of segments Processing buffers the networks with
+    NETWORK_SEGMENTS = 5
+    # Largest number of vertices kept in one part of the subdivided mask
+    MAX_VERTICES = 256
+    # Width of the tiles the mask is cut into, and the largest share of
+    # network features that may change before the mask is rebuilt in full
+    TILE_SIZE = 5000
+    PATCH_LIMIT = 0.25
+    # Reach of the parcels loaded around each farm, as a multiple of the
+    # open land radius of its waste, doubled until every buffer fits
+    PARCEL_REACH = 1.5
+    # Networks each mask part can be excluded by, coded by position as in
+    # broilerEngine.SOURCES
+    SOURCES = ['hydro', 'road', 'both']
+    # Names of the compounds, in the order they are offered, with the mass
+    # of each in a tonne of waste and the concentration it is spread at
+    COMPOUNDS = list(broilerCompounds.COMPOUNDS)
+    FACTORS = [factor for factor, concentration in broilerCompounds.COMPOUNDS.values()]
+    CONCENTRATIONS = [concentration for factor, concentration in broilerCompounds.COMPOUNDS.values()]
+    # Seed of the Monte Carlo samples, so reruns give the same percentiles
+    SEED = 0
+    # Names of the geometry engines, in the order they are offered
+    ENGINES = ['QGIS Processing', 'Shapely (vectorised)']
 
     def tr(self, string):
         """
@@ -89,11 +165,27 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
         """
         return 'examplescripts'
 
+    def flags(self):
+        """
+        Returns the flags of the algorithm.  It keeps no project or interface
+        state, so Processing may run it in a background thread, and several
+        runs may go at once.
+        """
+        return super().flags() & ~QgsProcessingAlgorithm.FlagNoThreading
+
     def shortHelpString(self):
         """
         Returns a localised short helper string for the algorithm.
         """
-        return self.tr("This tool calculates the area of land (minus roads and rivers) that can be covered with certain volumes of waste products from a broiler farm.")
+        return self.tr("This tool calculates the area of land (minus roads and rivers) that can be covered with certain volumes of waste products from a broiler farm.\n\n"
+                       "When shared land is allocated, every point is a competing farm with the mass in the selected field (or the input mass). Land covered by several farms is split by a Voronoi split weighted by each farm's demand, and each farm's zone is re-solved until its demand is met. Allocation always uses the Shapely engine and repeats until every farm is solved.\n\n"
+                       "With a number of Monte Carlo samples, the mass, nutrient factor, concentration and buffer distances are drawn from the given distributions (quantities without one keep their usual value) and the P10, P50 and P90 buffers of each farm are reported. Distributions are written as quantity=kind(values) separated by semicolons, where kind is fixed, normal, lognormal (mean, deviation), uniform (low, high) or triangular (low, mode, high).\n\n"
+                       "A simplification tolerance thins the network lines with the Douglas-Peucker algorithm before they are buffered. No line moves further than the tolerance, so the mask can only change within that distance of its edge; the largest possible change in hectares is reported.\n\n"
+                       "The Shapely engine also reports how much of the final buffer was excluded by creeks only, by roads only and by both, so land under a road beside a creek is counted once.\n\n"
+                       "Given a parcel layer, waste is only spread on the parcels the expression selects (all parcels if it is empty), less the roads and creeks, and the Shapely engine is used. Only parcels near the farms are read, so a spatial index on the parcel layer keeps statewide cadastres fast. Parcels are not used by the Monte Carlo or season modes, and results on parcels are not cached.\n\n"
+                       "The optional spreadable land output holds each final buffer with the roads and rivers cut out, the land the waste can actually be spread on, with its area and the area the waste needs.\n\n"
+                       "Given a schedule (a CSV file with farm, date and mass columns, farms numbered from 1 in layer order), every application is solved in date order against the land the earlier ones left, nearest land first, on a 25 m raster of nutrient load. A share of the load can be taken up by crops each year. The raster can be saved and given to a later run of the same compound to continue the season, and is widened where the later schedule reaches past it.\n\n"
+                       "Buffer distances and areas are measured in metres. When the farm layer is not in a projected CRS in metres, the process works in the UTM zone of the farms; networks in another CRS are reprojected once, and the outputs are transformed back to the CRS of the farm layer.")
 
     def initAlgorithm(self, config=None):
         """
@@ -141,7 +233,7 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
             QgsProcessingParameterEnum(
                 self.COMPOUND,
                 self.tr('Select compound to be calculated'),
-                ['Nitrogen','Phosphorus','Potassium']
+                self.COMPOUNDS
             )
         )
         
@@ -152,7 +244,128 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
                 self.tr('Input desired number of iterations'),
             )
         )
+
+        # We specify which geometry engine performs the process.
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.ENGINE,
+                self.tr('Select geometry engine'),
+                self.ENGINES,
+                defaultValue=0
+            )
+        )
+
+        # We specify how far network lines may be simplified before buffering.
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SIMPLIFY,
+                self.tr('Simplify network lines before buffering, with tolerance (in metres, 0 to skip)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0
+            )
+        )
+
+        # We specify whether farms compete for the land between them.
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.ALLOCATE,
+                self.tr('Allocate shared land between competing farms'),
+                defaultValue=False
+            )
+        )
+
+        # We specify a field holding the mass of broiler waste at each farm.
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.MASS_FIELD,
+                self.tr('Field with mass of broiler waste at each farm (in tonnes, for allocation)'),
+                parentLayerParameterName=self.INPUT,
+                type=QgsProcessingParameterField.Numeric,
+                optional=True
+            )
+        )
+
+        # We specify the land parcels waste may be spread on, if restricted.
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PARCELS,
+                self.tr('Land parcels waste may be spread on (optional)'),
+                [QgsProcessing.TypeVectorPolygon],
+                optional=True
+            )
+        )
+
+        # We specify which of the parcels are eligible.
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.PARCEL_FILTER,
+                self.tr('Expression selecting eligible parcels, e.g. "owner" = \'Smith\' (all parcels if empty)'),
+                parentLayerParameterName=self.PARCELS,
+                optional=True
+            )
+        )
+
+        # We specify whether a previously solved result may be reused.
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_CACHE,
+                self.tr('Reuse cached results and exclusion masks for identical inputs'),
+                defaultValue=True
+            )
+        )
+        
+        # We specify how many Monte Carlo samples to draw, if any.
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SAMPLES,
+                self.tr('Number of Monte Carlo samples for uncertainty (0 to skip)'),
+                defaultValue=0,
+                minValue=0
+            )
+        )
+
+        # We specify the distributions the uncertain quantities are drawn from.
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.DISTRIBUTIONS,
+                self.tr('Distributions, e.g. mass=normal(3000, 300); concentration=uniform(0.0025, 0.0029)'),
+                optional=True
+            )
+        )
         
+        # We specify a schedule of applications for season mode, if any.
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.SCHEDULE,
+                self.tr('Schedule of applications for season mode (CSV of farm, date, mass)'),
+                extension='csv',
+                optional=True
+            )
+        )
+
+        # We specify the share of the load crops take up in a year.
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.UPTAKE,
+                self.tr('Share of spread nutrient taken up by crops each year (season mode)'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+                maxValue=1
+            )
+        )
+
+        # We specify the nutrient load left by an earlier season, if any.
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.SEASON_STATE,
+                self.tr('Nutrient load raster to continue from (season mode)'),
+                extension='npz',
+                optional=True
+            )
+        )
+
         # We add a feature sink in which to store our processed feature.
         self.addParameter(
             QgsProcessingParameterFeatureSink(
@@ -161,6 +374,50 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
             )
         )
 
+        # We add a feature sink in which to store the spreadable land.
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.SPREADABLE_OUTPUT,
+                self.tr('Output spreadable land layer (buffer minus roads and rivers)'),
+                QgsProcessing.TypeVectorPolygon,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # We add a feature sink in which to store the percentile buffers.
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.UNCERTAINTY_OUTPUT,
+                self.tr('Output P10/P50/P90 buffer layer'),
+                QgsProcessing.TypeVectorPolygon,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # We add a feature sink in which to store the buffer of every application.
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.SEASON_OUTPUT,
+                self.tr('Output season application layer'),
+                QgsProcessing.TypeVectorPolygon,
+                optional=True,
+                createByDefault=False
+            )
+        )
+
+        # We add a file in which to store the nutrient load after the season.
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.SEASON_STATE_OUTPUT,
+                self.tr('Output nutrient load raster'),
+                self.tr('NumPy archive (*.npz)'),
+                optional=True,
+                createByDefault=False
+            )
+        )
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
@@ -197,10 +454,79 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
             self.ITERATIONS,
             context
         )
+        engine = self.parameterAsEnum(
+            parameters,
+            self.ENGINE,
+            context
+        )
+        tolerance = self.parameterAsDouble(
+            parameters,
+            self.SIMPLIFY,
+            context
+        )
+        allocate = self.parameterAsBool(
+            parameters,
+            self.ALLOCATE,
+            context
+        )
+        massField = self.parameterAsString(
+            parameters,
+            self.MASS_FIELD,
+            context
+        )
+        useCache = self.parameterAsBool(
+            parameters,
+            self.USE_CACHE,
+            context
+        )
+        sampleCount = self.parameterAsInt(
+            parameters,
+            self.SAMPLES,
+            context
+        )
+        distributionsText = self.parameterAsString(
+            parameters,
+            self.DISTRIBUTIONS,
+            context
+        )
+        schedulePath = self.parameterAsFile(
+            parameters,
+            self.SCHEDULE,
+            context
+        )
+        uptake = self.parameterAsDouble(
+            parameters,
+            self.UPTAKE,
+            context
+        )
+        statePath = self.parameterAsFile(
+            parameters,
+            self.SEASON_STATE,
+            context
+        )
+        parcelFile = self.parameterAsSource(
+            parameters,
+            self.PARCELS,
+            context
+        )
+        parcelFilter = self.parameterAsExpression(
+            parameters,
+            self.PARCEL_FILTER,
+            context
+        )
 
         # If source was not found, throw an exception to indicate that the algorithm encountered a fatal error.
         if pointFile is None:
             raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        # The vectorised engine can only be used when its libraries are installed
+        if (engine == 1 or allocate or sampleCount > 0 or schedulePath or parcelFile is not None) and broilerEngine is None:
+            raise QgsProcessingException(self.tr('The Shapely engine needs Shapely 2 and NumPy to be installed'))
+        if parcelFilter and QgsExpression(parcelFilter).hasParserError():
+            raise QgsProcessingException(f'Cannot read the parcel expression: {QgsExpression(parcelFilter).parserErrorString()}')
+        # Eligible land is overlaid by the Shapely engine only
+        if parcelFile is not None and engine == 0 and not allocate:
+            feedback.pushInfo('Spreading on eligible parcels uses the Shapely engine')
+            engine = 1
         
         # Specify information about the output layer.
         (sink, dest_id) = self.parameterAsSink(
@@ -212,130 +538,959 @@ class BroilerNetworkBuffer(QgsProcessingAlgorithm):
             pointFile.sourceCrs()
         )
 
+        # Specify information about the spreadable land layer.
+        spreadableFields = QgsFields()
+        spreadableFields.append(QgsField('farm', QVariant.Int))
+        spreadableFields.append(QgsField('area_ha', QVariant.Double))
+        spreadableFields.append(QgsField('target_ha', QVariant.Double))
+        (spreadableSink, spreadableId) = self.parameterAsSink(
+            parameters,
+            self.SPREADABLE_OUTPUT,
+            context,
+            spreadableFields,
+            QgsWkbTypes.Polygon,
+            pointFile.sourceCrs()
+        )
+
+        # Work in one metric CRS, so buffer distances and areas are in metres
+        # and no layer is reprojected on the fly during the process
+        crs = self.workingCrs(pointFile, context)
+        transform = None
+        if pointFile.sourceCrs() != crs:
+            feedback.pushInfo(f'Working in {crs.authid()}, outputs are transformed back to {pointFile.sourceCrs().authid()}')
+            transform = QgsCoordinateTransform(pointFile.sourceCrs(), crs, context.transformContext())
+
         # Set mass & concentration of compound
-        if parameters[self.COMPOUND] == 0:
-            massCompound = parameters[self.MASS] * 30.714286
-            concCompound = 0.005
-        elif parameters[self.COMPOUND] == 1:
-            massCompound = parameters[self.MASS] * 14.142857
-            concCompound = 0.0027
-        elif parameters[self.COMPOUND] == 2:
-            massCompound = parameters[self.MASS] * 13.428571
-            concCompound = 0.0025
-        
+        massCompound = massBroilerWaste * self.FACTORS[compound]
+        concCompound = self.CONCENTRATIONS[compound]
+
+        # Read the mass of broiler waste at each farm when they are allocated
+        masses = None
+        if allocate:
+            masses = [float(feature[massField] or 0) if massField else massBroilerWaste for feature in pointFile.getFeatures()]
+
+        # Look for a stored result of an identical solve
+        cached = None
+        maskCache = None
+        maskKey = None
+        records = None
+        if useCache:
+            cache = broilerCache.ResultCache()
+            # Hash the network data so edited layers never reuse stale results
+            records = {'hydro' : self.featureRecords(hydroFile, crs, context), 'road' : self.featureRecords(roadFile, crs, context)}
+            dataVersion = broilerCache.hashRecords(records['hydro'], records['road'])
+            cacheKey = self.cacheKey(pointFile, massBroilerWaste, compound, iterations, engine, tolerance, masses, dataVersion, crs, transform)
+            maskCache = broilerCache.MaskCache()
+            maskKey = self.maskKey(parameters, context, 1 if allocate else engine, tolerance, crs)
+            # Parcels are read near the farms only, so results on them are
+            # not stored, as an edit to the cadastre could not be detected
+            cached = cache.get(cacheKey) if parcelFile is None else None
+
+        # Load the exclusion mask, unless a stored result makes it unnecessary
+        mask = None
+        if cached is None or spreadableSink is not None:
+            if allocate or engine == 1:
+                mask = self.loadShapelyMask(parameters, context, hydroFile, roadFile, crs, tolerance, maskCache, maskKey, records, feedback)
+            else:
+                mask = self.loadProcessingMask(parameters, context, hydroFile, roadFile, crs, tolerance, maskCache, maskKey, records, feedback)
+
+        # The land the waste is spread on, which the parcels narrow down
+        land = mask
+        if cached is not None:
+            feedback.pushInfo('Identical inputs found in result cache, reusing stored result')
+            geometries, statistics = cached
+        else:
+            # Run the iterative process with the selected engine
+            if parcelFile is not None:
+                geometries, statistics, land = self.solveParcels(pointFile, transform, parcelFile, parcelFilter, crs, context, masses, compound, massCompound / concCompound, iterations, tolerance, mask, feedback)
+            elif allocate:
+                geometries, statistics = self.solveAllocation(pointFile, transform, masses, compound, tolerance, mask, feedback)
+            elif engine == 1:
+                geometries, statistics = self.solveShapely(pointFile, transform, massCompound / concCompound, iterations, tolerance, mask, feedback)
+            else:
+                geometries, statistics = self.solveProcessing(pointFile, transform, massCompound / concCompound, iterations, tolerance, mask, feedback)
+            statistics['massCompound'] = massCompound if masses is None else sum(masses) * self.FACTORS[compound]
+
+            # Store result so identical reruns can skip the process
+            if useCache and parcelFile is None:
+                cache.put(cacheKey, geometries, statistics)
+
+        # Allocated zones keep the attributes of their farm
+        if allocate:
+            attributes = [feature.attributes() for feature in pointFile.getFeatures()]
+        else:
+            attributes = [["Id", 0]] * len(geometries)
+
+        # Create output features from the final Buffer geometries
+        features = []
+        for wkb, featureAttributes in zip(geometries, attributes):
+            geometry = self.outputGeometry(wkb, transform)
+            new_feature =  QgsFeature()
+            # Set geometry to Buffer geometry
+            new_feature.setGeometry(geometry)
+            # Set Id so feature can be indexed in Shapefile
+            new_feature.setAttributes(featureAttributes)
+            features.append(new_feature)
+        # Write every feature to the sink in one call
+        sink.addFeatures(features, QgsFeatureSink.FastInsert)
+
+        self.reportResult(massBroilerWaste if masses is None else sum(masses), statistics, feedback)
+        results = {self.OUTPUT: dest_id}
+
+        # Cut the exclusions out of the final buffers
+        if spreadableSink is not None:
+            if allocate:
+                targetAreas = [mass * self.FACTORS[compound] / concCompound for mass in masses]
+            else:
+                targetAreas = [massCompound / concCompound] * len(geometries)
+            self.writeSpreadableLand(spreadableSink, spreadableFields, geometries, targetAreas, land, allocate or engine == 1, transform, feedback)
+            results[self.SPREADABLE_OUTPUT] = spreadableId
+
+        # Sample the uncertain quantities and report percentile buffers
+        if sampleCount > 0:
+            try:
+                distributions = broilerUncertainty.parseDistributions(distributionsText)
+            except ValueError as error:
+                raise QgsProcessingException(str(error))
+            results[self.UNCERTAINTY_OUTPUT] = self.runUncertainty(
+                parameters, context, pointFile, transform, hydroFile, roadFile, crs, masses or None, massBroilerWaste,
+                compound, iterations, tolerance, sampleCount, distributions, feedback
+            )
+
+        # Solve every application of the schedule against the land left
+        if schedulePath:
+            if not (allocate or engine == 1) or mask is None:
+                mask = self.loadShapelyMask(parameters, context, hydroFile, roadFile, crs, tolerance, maskCache,
+                                            self.maskKey(parameters, context, 1, tolerance, crs) if useCache else None, records, feedback)
+            results.update(self.runSeason(parameters, context, pointFile, transform, schedulePath, statePath, compound, uptake, mask, feedback))
+
+        # Return final Buffer as ouput layer
+        return results
+
+    def solveProcessing(self, pointFile, transform, targetArea, iterations, tolerance, mask, feedback):
+        """
+        Runs the iterative buffer and clip process with QGIS geometry.
+        mask is the (index, parts, sources) triple from loadProcessingMask.
+        Returns the final Buffer geometries as WKB and the per-iteration lists.
+        """
+        maskIndex, maskParts, sources = mask
+        # Read the central points once, outside the loop
+        points = [QgsGeometry.fromPointXY(point) for point in self.farmPoints(pointFile, transform)]
+
+        # Establish reference lists for loop
+        listBuff = [0]
+        listAreaBuff = [0]
+        listAreaClip = [0]
+        listDistBuff = [0]
+
+        # Calculate area of Buffer0
+        listAreaBuff[0] = targetArea
+        # Calculate distance of Buffer0
+        listDistBuff[0] = self.discRadius(listAreaBuff[0])
+
+        # Create Buffer0 directly from the points, as native:buffer would
+        listBuff[0] = [point.buffer(listDistBuff[0], self.SEGMENTS) for point in points]
+
+        # This step runs iterations of the buffer process and clip.
+        # It calculates the area of the networks covered by the buffer and adds it to the waste buffer.
+        # This is an iterative process.  More iterations get closer to the 'true' value.
+        for count in range (1, iterations + 1):
+            # Stop between iterations when the run is cancelled
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * count / iterations)
+            # Determine area covered by clipped network buffer
+            areaClip = 0
+            for disc in listBuff[count - 1]:
+                areaClip += self.clipArea(disc, maskIndex, maskParts)
+            listAreaClip.append(areaClip)
+
+            # Calculate Buffer area
+            listAreaBuff.append(listAreaBuff[count - 1] + (listAreaClip[count] - listAreaClip[count - 1]))
+            # Calculate Buffer distance
+            listDistBuff.append(self.discRadius(listAreaBuff[count]))
+
+            # Create Buffer
+            listBuff.append([point.buffer(listDistBuff[count], self.SEGMENTS) for point in points])
+
+        # Read the final Buffer geometries and split the land excluded from
+        # them by the networks excluding it
+        geometries = []
+        boundaryLength = 0
+        excludedSources = [0] * len(self.SOURCES)
+        for disc in listBuff[-1]:
+            geometries.append(bytes(disc.asWkb()))
+            if tolerance > 0:
+                boundaryLength += self.boundaryLength(disc, maskIndex, maskParts)
+            excludedSources = [total + area for total, area in zip(excludedSources, self.sourceAreas(disc, maskIndex, maskParts, sources))]
+
+        return geometries, {
+        'listAreaBuff' : listAreaBuff,
+        'listAreaClip' : listAreaClip,
+        'listDistBuff' : listDistBuff,
+        'excludedSources' : excludedSources,
+        'errorBound' : 2 * tolerance * boundaryLength
+        }
+
+    def loadProcessingMask(self, parameters, context, hydroFile, roadFile, crs, tolerance, maskCache, maskKey, records, feedback):
+        """
+        Returns the spatial index, geometries and source codes of the
+        exclusion mask parts for the Processing engine, from the mask cache
+        when it has been prepared before.  A stored mask of edited networks
+        is patched.
+        """
+        # Reuse the subdivided exclusion mask if it has been prepared before
+        stored = maskCache.getMask(maskKey) if maskCache is not None else None
+        # Masks stored without the network of each part are built again
+        if stored is not None and stored[3] is None:
+            stored = None
+        maskParts = None
+        if stored is None or stored[2] != records:
+            # The networks are only read, in the working CRS, when the mask
+            # has to be prepared or patched
+            parameters, hydroFile, roadFile = self.reprojectNetworks(parameters, context, hydroFile, roadFile, crs, feedback)
+        if stored is not None:
+            maskParts = []
+            for wkb in stored[0]:
+                geometry = QgsGeometry()
+                geometry.fromWkb(wkb)
+                maskParts.append(geometry)
+            tiles = [tuple(tile) for tile in stored[1]]
+            sources = stored[3]
+            if stored[2] != records:
+                changes = self.networkChanges(stored[2], records)
+                if changes is None:
+                    maskParts = None
+                else:
+                    feedback.pushInfo('Network edits found, patching the stored exclusion mask')
+                    maskParts, tiles, sources = self.patchProcessingMask(maskParts, tiles, sources, hydroFile, roadFile, changes, tolerance)
+        if maskParts is None:
+            maskParts, tiles, sources = self.prepareProcessingMask(parameters, context, hydroFile, roadFile, tolerance, feedback)
+        if maskCache is not None and (stored is None or stored[2] != records):
+            if not maskCache.putMask(maskKey, [bytes(geometry.asWkb()) for geometry in maskParts], tiles, records, sources):
+                self.reportMaskNotStored(maskCache, feedback)
+
+        # Index the mask parts so each clip only touches the parts near the disc
+        maskIndex = QgsSpatialIndex()
+        for partId, geometry in enumerate(maskParts):
+            maskIndex.addFeature(partId, geometry.boundingBox())
+        return maskIndex, maskParts, sources
+
+    def patchProcessingMask(self, maskParts, tiles, sources, hydroFile, roadFile, changes, tolerance):
+        """
+        Rebuilds the tiles of the mask an edit to the networks can reach, from
+        the lines that reach them.  Returns the patched parts, tiles and
+        source codes.
+        """
+        hydroBounds, roadBounds = changes
+        affected = self.tilesCovering(
+            [(xmin - self.HYDRO_DISTANCE, ymin - self.HYDRO_DISTANCE, xmax + self.HYDRO_DISTANCE, ymax + self.HYDRO_DISTANCE) for xmin, ymin, xmax, ymax in hydroBounds]
+            + [(xmin - self.ROAD_DISTANCE, ymin - self.ROAD_DISTANCE, xmax + self.ROAD_DISTANCE, ymax + self.ROAD_DISTANCE) for xmin, ymin, xmax, ymax in roadBounds]
+        )
+        # Keep the parts of every tile the edits cannot reach
+        kept = [index for index, tile in enumerate(tiles) if tile not in affected]
+        patchedParts = [maskParts[index] for index in kept]
+        patchedTiles = [tiles[index] for index in kept]
+        patchedSources = [sources[index] for index in kept]
+
+        for column, row in sorted(affected):
+            rectangle = QgsRectangle(column * self.TILE_SIZE, row * self.TILE_SIZE, (column + 1) * self.TILE_SIZE, (row + 1) * self.TILE_SIZE)
+            # Buffer only the lines whose buffers reach the tile, then dissolve
+            # each network and clip it to the tile
+            networkPieces = []
+            for source, distance in ((hydroFile, self.HYDRO_DISTANCE), (roadFile, self.ROAD_DISTANCE)):
+                buffers = []
+                for feature in source.getFeatures(QgsFeatureRequest().setFilterRect(rectangle.buffered(distance))):
+                    geometry = feature.geometry()
+                    if tolerance > 0:
+                        geometry = geometry.simplify(tolerance)
+                    buffers.append(geometry.buffer(distance, self.NETWORK_SEGMENTS))
+                networkPieces.append(QgsGeometry.unaryUnion(buffers).intersection(QgsGeometry.fromRect(rectangle)) if buffers else QgsGeometry())
+            hydroPiece, roadPiece = networkPieces
+            # Split the tile by the networks excluding it and subdivide, as a
+            # full rebuild does
+            if hydroPiece.isEmpty() or roadPiece.isEmpty():
+                pieces = [hydroPiece, roadPiece]
+            else:
+                pieces = [hydroPiece.difference(roadPiece), roadPiece.difference(hydroPiece), hydroPiece.intersection(roadPiece)]
+            for code, piece in enumerate(pieces):
+                if piece.isEmpty():
+                    continue
+                for part in piece.subdivide(self.MAX_VERTICES).asGeometryCollection():
+                    if part.type() == QgsWkbTypes.PolygonGeometry:
+                        patchedParts.append(part)
+                        patchedTiles.append((column, row))
+                        patchedSources.append(code)
+        return patchedParts, patchedTiles, patchedSources
+
+    def tilesCovering(self, bounds):
+        """
+        Returns the set of (column, row) tiles touched by a list of
+        (xmin, ymin, xmax, ymax) bounds.
+        """
+        tiles = set()
+        for xmin, ymin, xmax, ymax in bounds:
+            for column in range(math.floor(xmin / self.TILE_SIZE), math.floor(xmax / self.TILE_SIZE) + 1):
+                for row in range(math.floor(ymin / self.TILE_SIZE), math.floor(ymax / self.TILE_SIZE) + 1):
+                    tiles.add((column, row))
+        return tiles
+
+    def networkChanges(self, storedRecords, records):
+        """
+        Returns the bounds of the hydro and road features edited since a mask
+        was stored, or None when so much changed a full rebuild is cheaper.
+        """
+        hydroBounds = broilerCache.changedBounds(storedRecords['hydro'], records['hydro'])
+        roadBounds = broilerCache.changedBounds(storedRecords['road'], records['road'])
+        if len(hydroBounds) + len(roadBounds) > self.PATCH_LIMIT * (len(records['hydro']) + len(records['road'])):
+            return None
+        return hydroBounds, roadBounds
+
+    def prepareProcessingMask(self, parameters, context, hydroFile, roadFile, tolerance, feedback):
+        """
+        Buffers, splits, tiles and subdivides the networks with Processing
+        algorithms, simplifying the lines first when a tolerance is given.
+        The buffers are split into the land excluded by each network only and
+        by both.  Returns the mask part geometries and the tile and source
+        code of each.
+        """
+        feedback.pushInfo('Preparing exclusion mask')
+        hydroLines = parameters[self.HYDRO]
+        roadLines = parameters[self.ROAD]
+
+        if tolerance > 0:
+            # Define parameters for Simplify process (Douglas-Peucker)
+            simplifyParameters = {
+            'METHOD' : 0,
+            'TOLERANCE' : tolerance,
+            'OUTPUT' : 'memory:'
+            }
+            # Run Simplify process on each network
+            hydroSimplified = processing.run('native:simplifygeometries', dict(simplifyParameters, INPUT=hydroLines), context=context, feedback=feedback, is_child_algorithm=True)
+            roadSimplified = processing.run('native:simplifygeometries', dict(simplifyParameters, INPUT=roadLines), context=context, feedback=feedback, is_child_algorithm=True)
+            vertices = self.countVertices(hydroFile) + self.countVertices(roadFile)
+            hydroLines = hydroSimplified["OUTPUT"]
+            roadLines = roadSimplified["OUTPUT"]
+            simplifiedVertices = (self.countVertices(QgsProcessingUtils.mapLayerFromString(hydroLines, context))
+                                  + self.countVertices(QgsProcessingUtils.mapLayerFromString(roadLines, context)))
+
         # Define parameters for Hydro buffer
         hydroBuffParameters = {
-        'INPUT' : parameters[self.HYDRO],
-        'DISTANCE' : 50,
+        'INPUT' : hydroLines,
+        'DISTANCE' : self.HYDRO_DISTANCE,
         'DISSOLVE' : True,
         'OUTPUT' : 'memory:'
         }
         # Run Hydro buffer process
-        hydroBuffer = processing.run('native:buffer', hydroBuffParameters)
+        hydroBuffer = processing.run('native:buffer', hydroBuffParameters, context=context, feedback=feedback, is_child_algorithm=True)
 
         # Define parameters for Road buffer
         roadBuffParameters = {
-        'INPUT' : parameters[self.ROAD],
-        'DISTANCE' : 40,
+        'INPUT' : roadLines,
+        'DISTANCE' : self.ROAD_DISTANCE,
         'DISSOLVE' : True,
         'OUTPUT' : 'memory:'
         }
         # Run Road buffer process
-        roadBuffer = processing.run('native:buffer', roadBuffParameters)
+        roadBuffer = processing.run('native:buffer', roadBuffParameters, context=context, feedback=feedback, is_child_algorithm=True)
+
+        hydroLayer = QgsProcessingUtils.mapLayerFromString(hydroBuffer["OUTPUT"], context)
+        roadLayer = QgsProcessingUtils.mapLayerFromString(roadBuffer["OUTPUT"], context)
 
-        # Define parameters for Merge process
-        mergeParameters = {
-        'LAYERS' : [hydroBuffer["OUTPUT"], roadBuffer["OUTPUT"]],
+        if tolerance > 0:
+            # Every boundary of the split mask is a boundary of one of the
+            # network buffers
+            perimeter = sum(feature.geometry().length() for layer in (hydroLayer, roadLayer) for feature in layer.getFeatures())
+            self.reportSimplification(vertices, simplifiedVertices, 2 * tolerance * perimeter, feedback)
+
+        # Split the buffers into the land excluded by the hydro network only,
+        # the road network only and both, in the order of SOURCES
+        splitBuffers = [
+        processing.run('native:difference', {'INPUT' : hydroBuffer["OUTPUT"], 'OVERLAY' : roadBuffer["OUTPUT"], 'OUTPUT' : 'memory:'}, context=context, feedback=feedback, is_child_algorithm=True),
+        processing.run('native:difference', {'INPUT' : roadBuffer["OUTPUT"], 'OVERLAY' : hydroBuffer["OUTPUT"], 'OUTPUT' : 'memory:'}, context=context, feedback=feedback, is_child_algorithm=True),
+        processing.run('native:intersection', {'INPUT' : hydroBuffer["OUTPUT"], 'OVERLAY' : roadBuffer["OUTPUT"], 'OUTPUT' : 'memory:'}, context=context, feedback=feedback, is_child_algorithm=True)
+        ]
+
+        # Define parameters for Grid process, aligned to the tile size so
+        # every run cuts the mask along the same lines
+        extent = QgsRectangle(hydroLayer.extent())
+        extent.combineExtentWith(roadLayer.extent())
+        gridParameters = {
+        'TYPE' : 2,
+        'EXTENT' : QgsRectangle(
+            math.floor(extent.xMinimum() / self.TILE_SIZE) * self.TILE_SIZE,
+            math.floor(extent.yMinimum() / self.TILE_SIZE) * self.TILE_SIZE,
+            (math.floor(extent.xMaximum() / self.TILE_SIZE) + 1) * self.TILE_SIZE,
+            (math.floor(extent.yMaximum() / self.TILE_SIZE) + 1) * self.TILE_SIZE
+        ),
+        'HSPACING' : self.TILE_SIZE,
+        'VSPACING' : self.TILE_SIZE,
+        'CRS' : hydroFile.sourceCrs(),
         'OUTPUT' : 'memory:'
         }
-        # Run Merge process
-        mergeBuffer = processing.run('qgis:mergevectorlayers', mergeParameters)
+        # Run Grid process
+        gridTiles = processing.run('native:creategrid', gridParameters, context=context, feedback=feedback, is_child_algorithm=True)
 
-        # Define parameters for Dissolve process
-        dissolveParameters = {
-        'INPUT' : mergeBuffer["OUTPUT"],
-        'OUTPUT' : 'memory:'
+        maskParts = []
+        tiles = []
+        sources = []
+        for code, splitBuffer in enumerate(splitBuffers):
+            # Define parameters for Intersection process
+            intersectionParameters = {
+            'INPUT' : splitBuffer["OUTPUT"],
+            'OVERLAY' : gridTiles["OUTPUT"],
+            'OUTPUT' : 'memory:'
+            }
+            # Run Intersection process
+            tileBuffer = processing.run('native:intersection', intersectionParameters, context=context, feedback=feedback, is_child_algorithm=True)
+
+            # Define parameters for Subdivide process
+            subdivideParameters = {
+            'INPUT' : tileBuffer["OUTPUT"],
+            'MAX_NODES' : self.MAX_VERTICES,
+            'OUTPUT' : 'memory:'
+            }
+            # Run Subdivide process
+            subdivideBuffer = processing.run('native:subdivide', subdivideParameters, context=context, feedback=feedback, is_child_algorithm=True)
+
+            # Define parameters for Multipart to Singleparts process
+            singlepartParameters = {
+            'INPUT' : subdivideBuffer["OUTPUT"],
+            'OUTPUT' : 'memory:'
+            }
+            # Run Multipart to Singleparts process
+            singlepartBuffer = processing.run('native:multiparttosingleparts', singlepartParameters, context=context, feedback=feedback, is_child_algorithm=True)
+
+            # Read the mask parts and find the tile each lies in
+            for feature in QgsProcessingUtils.mapLayerFromString(singlepartBuffer["OUTPUT"], context).getFeatures():
+                point = feature.geometry().pointOnSurface().asPoint()
+                maskParts.append(feature.geometry())
+                tiles.append((math.floor(point.x() / self.TILE_SIZE), math.floor(point.y() / self.TILE_SIZE)))
+                sources.append(code)
+        return maskParts, tiles, sources
+
+    def countVertices(self, source):
+        """
+        Returns the total number of vertices in a line layer or source.
+        """
+        return sum(feature.geometry().constGet().nCoordinates() for feature in source.getFeatures())
+
+    def boundaryLength(self, disc, maskIndex, maskParts):
+        """
+        Returns the length of mask part boundaries inside a disc, the band in
+        which simplification can have changed the mask.
+        """
+        length = 0
+        for partId in maskIndex.intersects(disc.boundingBox()):
+            boundary = QgsGeometry(maskParts[partId].constGet().boundary())
+            length += boundary.intersection(disc).length()
+        return length
+
+    def spreadableLand(self, disc, maskIndex, maskParts):
+        """
+        Returns a disc less the mask, dissolving only the mask parts whose
+        bounding boxes intersect it.
+        """
+        pieces = [maskParts[partId].intersection(disc) for partId in maskIndex.intersects(disc.boundingBox())]
+        if not pieces:
+            return disc
+        return disc.difference(QgsGeometry.unaryUnion(pieces))
+
+    def writeSpreadableLand(self, sink, fields, geometries, targetAreas, mask, vectorised, transform, feedback):
+        """
+        Writes each final buffer less the exclusion mask, with its area and
+        the area its waste needs.
+        """
+        if vectorised:
+            lands = broilerEngine.shapely.to_wkb(mask.spreadableLand(broilerEngine.shapely.from_wkb(geometries)))
+        else:
+            lands = []
+            for wkb in geometries:
+                disc = QgsGeometry()
+                disc.fromWkb(wkb)
+                lands.append(self.spreadableLand(disc, *mask[:2]).asWkb())
+
+        totalArea = 0
+        for index, (wkb, targetArea) in enumerate(zip(lands, targetAreas)):
+            geometry = QgsGeometry()
+            geometry.fromWkb(bytes(wkb))
+            # Measure the land before it leaves the working CRS
+            area = geometry.area()
+            new_feature = QgsFeature(fields)
+            new_feature.setGeometry(self.outputGeometry(bytes(wkb), transform))
+            new_feature.setAttributes([index + 1, area / 10000, targetArea / 10000])
+            sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
+            totalArea += area
+        # Print how close the solved land is to what the waste needs
+        feedback.pushInfo(f'Spreadable land covers {round(totalArea / 10000, 2)} Ha, {round((totalArea / sum(targetAreas) - 1) * 100, 2)}% from the {round(sum(targetAreas) / 10000, 2)} Ha needed')
+
+    def discRadius(self, area):
+        """
+        Returns the radius of the buffer polygon of a point whose area, rather
+        than that of its circle, is the given area.
+        """
+        sides = 4 * self.SEGMENTS
+        return math.sqrt(area / (sides / 2 * math.sin(2 * math.pi / sides)))
+
+    def sourceAreas(self, disc, maskIndex, maskParts, sources):
+        """
+        Returns the area of the mask inside a disc split by the SOURCES
+        excluding it, overlaying only the mask parts near the disc.
+        """
+        areas = [0] * len(self.SOURCES)
+        for partId in maskIndex.intersects(disc.boundingBox()):
+            areas[sources[partId]] += maskParts[partId].intersection(disc).area()
+        return areas
+
+    def clipArea(self, disc, maskIndex, maskParts):
+        """
+        Returns the area of the mask inside a disc, overlaying only the mask
+        parts whose bounding boxes intersect it.
+        """
+        area = 0
+        for partId in maskIndex.intersects(disc.boundingBox()):
+            area += maskParts[partId].intersection(disc).area()
+        return area
+
+    def solveShapely(self, pointFile, transform, targetArea, iterations, tolerance, mask, feedback):
+        """
+        Runs the iterative buffer and clip process with the vectorised engine.
+        Returns the final Buffer geometries as WKB and the per-iteration lists.
+        """
+        points = self.farmPoints(pointFile, transform)
+
+        # Solve every central point at once
+        discs, arrays = broilerEngine.solveBuffer(
+            [point.x() for point in points],
+            [point.y() for point in points],
+            targetArea,
+            mask,
+            iterations,
+            self.SEGMENTS
+        )
+
+        # Report the totals over all points, as the Processing engine does
+        return [bytes(wkb) for wkb in broilerEngine.shapely.to_wkb(discs)], {
+        'listAreaBuff' : arrays['listAreaBuff'].sum(axis=1).tolist(),
+        'listAreaClip' : arrays['listAreaClip'].sum(axis=1).tolist(),
+        'listDistBuff' : arrays['listDistBuff'].max(axis=1).tolist(),
+        'excludedSources' : arrays['excludedSources'].sum(axis=0).tolist() if 'excludedSources' in arrays else None,
+        'errorBound' : 2 * tolerance * float(mask.boundaryLengths(discs).sum()) if tolerance > 0 else 0
         }
-        # Run Dissolve process
-        dissolveBuffer = processing.run('qgis:dissolve', dissolveParameters)
 
-        # Establish reference lists for loop
-        listBuff = [0]
-        listClip = [0]
-        listAreaBuff = [0]
-        listAreaClip = [0]
-        listDistBuff = [0]
+    def solveAllocation(self, pointFile, transform, masses, compound, tolerance, mask, feedback):
+        """
+        Allocates shared land between every farm with the vectorised engine.
+        Returns the land allocated to each farm as WKB and the totals of the
+        demand and of the solved discs.
+        """
+        points = self.farmPoints(pointFile, transform)
+        targetArea = [mass * self.FACTORS[compound] / self.CONCENTRATIONS[compound] for mass in masses]
 
-        # Calculate area of Buffer0
-        listAreaBuff[0] = massCompound / concCompound
-        # Calculate distance of Buffer0
-        listDistBuff[0] = math.sqrt(listAreaBuff[0] / math.pi)
+        # Re-solve every farm until its share of the land meets its demand
+        feedback.pushInfo(f'Allocating land between {len(points)} farms')
+        result = broilerAllocation.allocate(
+            [point.x() for point in points],
+            [point.y() for point in points],
+            targetArea,
+            mask,
+            segments=self.SEGMENTS
+        )
+        # Warn about farms whose demand cannot be met from their share
+        for index in broilerEngine.numpy.flatnonzero(~result['converged']):
+            feedback.reportError(f'Farm {index + 1} could only be allocated {int(round(result["netArea"][index] / 10000))} of {int(round(targetArea[index] / 10000))} Ha')
 
-        # Define parameters for Buffer0
-        parametersBuffer = {
-        'INPUT' : parameters[self.INPUT],
-        'DISTANCE' : listDistBuff[0],
-        'SEGMENTS' : 10,
-        'OUTPUT' : 'memory:'
+        return [bytes(wkb) for wkb in broilerEngine.shapely.to_wkb(result['cells'])], {
+        'listAreaBuff' : [sum(targetArea), float((broilerEngine.numpy.pi * result['radius'] ** 2).sum())],
+        'listAreaClip' : [0, float((broilerEngine.numpy.pi * result['radius'] ** 2 - result['netArea']).sum())],
+        'listDistBuff' : [0, float(result['radius'].max())],
+        'errorBound' : 2 * tolerance * float(mask.boundaryLengths(result['cells']).sum()) if tolerance > 0 else 0
         }
-        # Run Buffer0 process
-        listBuff[0] = processing.run('native:buffer', parametersBuffer)
 
-        # This step runs iterations of the buffer process and clip.
-        # It calculates the area of the networks covered by the buffer and adds it to the waste buffer.
-        # This is an iterative process.  More iterations get closer to the 'true' value.
-        for count in range (1, iterations + 1):
-            # Define parameters for Clip
-            parametersClip = {
-            'INPUT' : dissolveBuffer["OUTPUT"],
-            'OVERLAY' : listBuff[count - 1]["OUTPUT"],
-            'OUTPUT' : 'memory:'
+    def solveParcels(self, pointFile, transform, parcelFile, parcelFilter, crs, context, masses, compound, targetArea, iterations, tolerance, mask, feedback):
+        """
+        Solves every farm counting only the eligible parcels less the exclusion
+        mask as land.  Only the parcels within reach of each farm are loaded,
+        and the reach of farms without enough eligible land within it is
+        doubled until it holds their waste, so each parcel is cut out of the
+        mask once and the farms are solved once.  Returns the solved geometries
+        as WKB, the per-iteration lists and the eligible land, for the
+        spreadable land output.
+        """
+        points = self.farmPoints(pointFile, transform)
+        targetAreas = [targetArea] * len(points) if masses is None else [mass * self.FACTORS[compound] / self.CONCENTRATIONS[compound] for mass in masses]
+        reach = [self.PARCEL_REACH * math.sqrt(area / math.pi) for area in targetAreas]
+        # Parcels beyond the extent of the layer need never be looked for
+        extent = QgsCoordinateTransform(parcelFile.sourceCrs(), crs, context.transformContext()).transformBoundingBox(parcelFile.sourceExtent())
+        if parcelFile.hasSpatialIndex() == QgsFeatureSource.SpatialIndexNotPresent:
+            feedback.pushInfo('The parcel layer has no spatial index, creating one (Vector general > Create spatial index) makes finding the parcels near each farm much faster')
+
+        def widen(indices):
+            # Double the reach of the farms that can still find more parcels
+            widened = []
+            for index in indices:
+                point = points[index]
+                loaded = QgsRectangle(point.x() - reach[index], point.y() - reach[index], point.x() + reach[index], point.y() + reach[index])
+                if not loaded.contains(extent):
+                    reach[index] *= 2
+                    widened.append(index)
+            return widened
+
+        parcels = set()
+        land = None
+        loading = list(range(len(points)))
+        while True:
+            # Load parcels further out until the reach of every farm holds
+            # the eligible land its waste needs
+            while loading and (land is None or not feedback.isCanceled()):
+                found = self.loadParcels(parcelFile, parcelFilter, [points[index] for index in loading], [reach[index] for index in loading], crs, context, parcels)
+                land = broilerEngine.eligibleLand(mask, broilerEngine.shapely.from_wkb(found), self.MAX_VERTICES, land)
+                discs = broilerEngine.makeDiscs([points[index].x() for index in loading], [points[index].y() for index in loading], [reach[index] for index in loading])
+                short = land.partAreas(discs) < [targetAreas[index] for index in loading]
+                loading = widen([index for index, isShort in zip(loading, short) if isShort])
+            feedback.pushInfo(f'Spreading on {len(parcels)} eligible parcels near the farms')
+            if masses is None:
+                geometries, statistics = self.solveShapely(pointFile, transform, targetArea, iterations, tolerance, land, feedback)
+            else:
+                geometries, statistics = self.solveAllocation(pointFile, transform, masses, compound, tolerance, land, feedback)
+
+            # Farms sharing land with their neighbours can still reach past
+            # the parcels loaded for them
+            bounds = broilerEngine.shapely.bounds(broilerEngine.shapely.from_wkb(geometries))
+            loading = widen([index for index, (point, (xmin, ymin, xmax, ymax)) in enumerate(zip(points, bounds))
+                             if max(point.x() - xmin, point.y() - ymin, xmax - point.x(), ymax - point.y()) > reach[index]])
+            if not loading or feedback.isCanceled():
+                return geometries, statistics, land
+            feedback.pushInfo(f'{len(loading)} buffers reach past the parcels loaded, loading parcels further out')
+
+    def loadParcels(self, parcelFile, parcelFilter, points, reach, crs, context, parcels):
+        """
+        Returns the WKB, in the working CRS, of every eligible parcel within
+        reach of each point whose feature id is not yet in the set parcels,
+        and adds those ids to it.  The requests are filtered by rectangle, so
+        a provider with a spatial index reads only the parcels near the farms.
+        """
+        found = []
+        for point, distance in zip(points, reach):
+            request = QgsFeatureRequest().setDestinationCrs(crs, context.transformContext())
+            # The rectangle is in the destination CRS of the request
+            request.setFilterRect(QgsRectangle(point.x() - distance, point.y() - distance, point.x() + distance, point.y() + distance))
+            if parcelFilter:
+                request.setFilterExpression(parcelFilter)
+                request.setExpressionContext(context.expressionContext())
+            for feature in parcelFile.getFeatures(request):
+                if feature.id() not in parcels and feature.hasGeometry():
+                    parcels.add(feature.id())
+                    found.append(bytes(feature.geometry().asWkb()))
+        return found
+
+    def runUncertainty(self, parameters, context, pointFile, transform, hydroFile, roadFile, crs, masses, massBroilerWaste, compound, iterations, tolerance, sampleCount, distributions, feedback):
+        """
+        Solves every farm for sampleCount draws of the uncertain quantities and
+        writes the P10, P50 and P90 buffers.  Returns the output layer id.
+        """
+        # Specify information about the percentile layer.
+        fields = QgsFields()
+        fields.append(QgsField('farm', QVariant.Int))
+        fields.append(QgsField('percentile', QVariant.Int))
+        fields.append(QgsField('radius', QVariant.Double))
+        fields.append(QgsField('area_ha', QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.UNCERTAINTY_OUTPUT,
+            context,
+            fields,
+            QgsWkbTypes.Polygon,
+            pointFile.sourceCrs()
+        )
+
+        parameters, hydroFile, roadFile = self.reprojectNetworks(parameters, context, hydroFile, roadFile, crs, feedback)
+        hydroLines = self.loadShapelyLines(hydroFile)
+        roadLines = self.loadShapelyLines(roadFile)
+        if tolerance > 0:
+            hydroLines = broilerEngine.simplifyNetwork(hydroLines, tolerance)
+            roadLines = broilerEngine.simplifyNetwork(roadLines, tolerance)
+        for index, point in enumerate(self.farmPoints(pointFile, transform)):
+            # Point estimates stand in for quantities without a distribution
+            defaults = {
+            'mass' : masses[index] if masses else massBroilerWaste,
+            'factor' : self.FACTORS[compound],
+            'concentration' : self.CONCENTRATIONS[compound],
+            'hydroDistance' : self.HYDRO_DISTANCE,
+            'roadDistance' : self.ROAD_DISTANCE
             }
-            # Run Clip process
-            listClip.append(processing.run('qgis:clip', parametersClip))
+            samples = broilerUncertainty.sample(distributions, defaults, sampleCount, self.SEED)
+            feedback.pushInfo(f'Solving {sampleCount} samples for farm {index + 1}')
+            areas, radii = broilerUncertainty.simulate(hydroLines, roadLines, point.x(), point.y(), samples, iterations)
 
-            # Create list of Clip features
-            featuresClip = listClip[count]["OUTPUT"].getFeatures()
-            # Iterate through features
-            for feature in featuresClip:
-                # Determine feature area covered by clipped network buffer
-                listAreaClip.append(feature.geometry().area())
+            # Report and draw the buffers at each percentile
+            percentileAreas = broilerEngine.numpy.percentile(areas, broilerUncertainty.PERCENTILES)
+            percentileRadii = broilerEngine.numpy.percentile(radii, broilerUncertainty.PERCENTILES)
+            for percentile, area, radius in zip(broilerUncertainty.PERCENTILES, percentileAreas, percentileRadii):
+                feedback.pushInfo(f'P{percentile}: radius {int(round(radius))} m, covering {int(round(area / 10000))} Ha')
+                if sink is not None:
+                    new_feature = QgsFeature(fields)
+                    new_feature.setGeometry(self.outputGeometry(QgsGeometry.fromPointXY(point).buffer(radius, self.SEGMENTS).asWkb(), transform))
+                    new_feature.setAttributes([index + 1, percentile, float(radius), float(area / 10000)])
+                    sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
+        return dest_id
 
-            # Calculate Buffer area
-            listAreaBuff.append(listAreaBuff[count - 1] + (listAreaClip[count] - listAreaClip[count - 1]))
-            # Calculate Buffer distance
-            listDistBuff.append(math.sqrt(listAreaBuff[count] / math.pi))
+    def runSeason(self, parameters, context, pointFile, transform, schedulePath, statePath, compound, uptake, mask, feedback):
+        """
+        Solves every application of a schedule against the nutrient load the
+        earlier ones left, and writes the buffer of each application and the
+        load at the end of the season.  Returns the ids of the outputs.
+        """
+        try:
+            applications = broilerSeason.readSchedule(schedulePath)
+        except ValueError as error:
+            raise QgsProcessingException(str(error))
+        points = self.farmPoints(pointFile, transform)
+        for date, farm, mass in applications:
+            if not 1 <= farm <= len(points):
+                raise QgsProcessingException(f'The schedule names farm {farm}, but the layer has {len(points)} farms')
+
+        # Specify information about the season layer.
+        fields = QgsFields()
+        fields.append(QgsField('farm', QVariant.Int))
+        fields.append(QgsField('date', QVariant.String))
+        fields.append(QgsField('mass', QVariant.Double))
+        fields.append(QgsField('radius', QVariant.Double))
+        fields.append(QgsField('area_ha', QVariant.Double))
+        fields.append(QgsField('unmet_kg', QVariant.Double))
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.SEASON_OUTPUT,
+            context,
+            fields,
+            QgsWkbTypes.Polygon,
+            pointFile.sourceCrs()
+        )
+
+        # Continue the load of an earlier season where one is given
+        grid = broilerSeason.NutrientGrid.read(statePath) if statePath else None
+        feedback.pushInfo(f'Solving {len(applications)} scheduled applications')
+        try:
+            grid, results = broilerSeason.runSeason(
+                [point.x() for point in points],
+                [point.y() for point in points],
+                applications,
+                mask,
+                self.FACTORS[compound],
+                self.CONCENTRATIONS[compound],
+                grid,
+                uptake,
+                compound=self.COMPOUNDS[compound]
+            )
+        except ValueError as error:
+            raise QgsProcessingException(str(error))
+
+        for result in results:
+            feedback.pushInfo(f'{result["date"]}: farm {result["farm"]} spreads {result["mass"]}t within {int(round(result["radius"]))} m')
+            if result['unmet'] > 0:
+                feedback.reportError(f'{result["date"]}: farm {result["farm"]} could not place {int(round(result["unmet"]))} kg of {self.COMPOUNDS[compound]}')
+            if sink is not None:
+                new_feature = QgsFeature(fields)
+                new_feature.setGeometry(self.outputGeometry(broilerEngine.shapely.to_wkb(result['disc']), transform))
+                new_feature.setAttributes([result['farm'], result['date'].isoformat(), result['mass'], result['radius'],
+                                           float(broilerEngine.shapely.area(result['disc']) / 10000), result['unmet']])
+                sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
 
-            # Define parameters for Buffer
-            parametersBuffer = {
-            'INPUT' : parameters[self.INPUT],
-            'DISTANCE' : listDistBuff[count],
-            'SEGMENTS' : 10,
+        outputs = {self.SEASON_OUTPUT : dest_id}
+        statePath = self.parameterAsFileOutput(parameters, self.SEASON_STATE_OUTPUT, context)
+        if statePath:
+            grid.save(statePath)
+            outputs[self.SEASON_STATE_OUTPUT] = statePath
+        return outputs
+
+    def workingCrs(self, pointFile, context):
+        """
+        Returns the CRS the process works in: the CRS of the farm layer when
+        it is projected in metres, otherwise the UTM zone of the farms.
+        """
+        crs = pointFile.sourceCrs()
+        if not crs.isGeographic() and crs.mapUnits() == QgsUnitTypes.DistanceMeters:
+            return crs
+        # Find the zone of the middle of the farms in longitude and latitude
+        toGeographic = QgsCoordinateTransform(crs, QgsCoordinateReferenceSystem('EPSG:4326'), context.transformContext())
+        centre = toGeographic.transformBoundingBox(pointFile.sourceExtent()).center()
+        zone = min(int((centre.x() + 180) // 6) + 1, 60)
+        return QgsCoordinateReferenceSystem(f'EPSG:{(32600 if centre.y() >= 0 else 32700) + zone}')
+
+    def reprojectNetworks(self, parameters, context, hydroFile, roadFile, crs, feedback):
+        """
+        Returns the parameters and sources of the networks reprojected into
+        the working CRS.  Networks already in it are returned as they are.
+        """
+        parameters = dict(parameters)
+        sources = {self.HYDRO : hydroFile, self.ROAD : roadFile}
+        for name, source in sources.items():
+            if source.sourceCrs() == crs:
+                continue
+            feedback.pushInfo(f'Reprojecting {name.lower()} network from {source.sourceCrs().authid()} to {crs.authid()}')
+            # Define parameters for Reproject process
+            reprojectParameters = {
+            'INPUT' : parameters[name],
+            'TARGET_CRS' : crs,
             'OUTPUT' : 'memory:'
             }
-            # Run Buffer process
-            listBuff.append(processing.run('native:buffer', parametersBuffer))
+            # Run Reproject process, the layer it makes serving as the source
+            # of the network from here
+            parameters[name] = processing.run('native:reprojectlayer', reprojectParameters, context=context, feedback=feedback, is_child_algorithm=True)["OUTPUT"]
+            sources[name] = QgsProcessingUtils.mapLayerFromString(parameters[name], context)
+        return parameters, sources[self.HYDRO], sources[self.ROAD]
 
-        # Read the Buffer layer and create output features
-        for feature in listBuff[iterations]["OUTPUT"].getFeatures():
-            new_feature =  QgsFeature()
-            # Set geometry to Buffer geometry
-            new_feature.setGeometry(feature.geometry())
-            # Set Id so feature can be indexed in Shapefile
-            new_feature.setAttributes(["Id", 0])
-            sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
+    def farmPoints(self, pointFile, transform):
+        """
+        Returns the central points of the farm layer in the working CRS.
+        """
+        points = [feature.geometry().asPoint() for feature in pointFile.getFeatures()]
+        if transform is None:
+            return points
+        return [transform.transform(point) for point in points]
+
+    def outputGeometry(self, wkb, transform):
+        """
+        Returns a geometry from WKB in the CRS of the farm layer, transforming
+        it back from the working CRS when the two differ.
+        """
+        geometry = QgsGeometry()
+        geometry.fromWkb(bytes(wkb))
+        if transform is not None:
+            geometry.transform(transform, QgsCoordinateTransform.ReverseTransform)
+        return geometry
+
+    def loadShapelyLines(self, source):
+        """
+        Returns the geometries of a feature source as a Shapely array.
+        """
+        return broilerEngine.shapely.from_wkb([bytes(feature.geometry().asWkb()) for feature in source.getFeatures()])
+
+    def loadShapelyMask(self, parameters, context, hydroFile, roadFile, crs, tolerance, maskCache, maskKey, records, feedback):
+        """
+        Returns the exclusion mask for the vectorised engine, from the mask
+        cache when it has been prepared before.  A stored mask of edited
+        networks is patched.
+        """
+        # Reuse the subdivided exclusion mask if it has been prepared before
+        stored = maskCache.getMask(maskKey) if maskCache is not None else None
+        # Masks stored without the network of each part are built again
+        if stored is not None and stored[3] is None:
+            stored = None
+        if stored is not None and stored[2] == records:
+            return broilerEngine.ExclusionMask(broilerEngine.shapely.from_wkb(stored[0]), stored[1], sources=stored[3])
+
+        # Load the networks as geometry arrays in the working CRS, outside the
+        # hot path
+        parameters, hydroFile, roadFile = self.reprojectNetworks(parameters, context, hydroFile, roadFile, crs, feedback)
+        hydroLines = self.loadShapelyLines(hydroFile)
+        roadLines = self.loadShapelyLines(roadFile)
+        changes = self.networkChanges(stored[2], records) if stored is not None else None
+        if changes is not None:
+            # Rebuild only the tiles the edited lines can reach
+            feedback.pushInfo('Network edits found, patching the stored exclusion mask')
+            mask = broilerEngine.patchMask(
+                broilerEngine.ExclusionMask(broilerEngine.shapely.from_wkb(stored[0]), stored[1], sources=stored[3]),
+                hydroLines, roadLines, changes[0], changes[1],
+                self.HYDRO_DISTANCE, self.ROAD_DISTANCE, self.MAX_VERTICES, tolerance, self.TILE_SIZE
+            )
+        else:
+            # Buffer, dissolve and overlay both networks into one exclusion mask
+            feedback.pushInfo('Preparing exclusion mask')
+            mask = broilerEngine.prepareMask(hydroLines, roadLines, self.HYDRO_DISTANCE, self.ROAD_DISTANCE, self.MAX_VERTICES, tolerance, self.TILE_SIZE)
+            if tolerance > 0:
+                self.reportSimplification(mask.statistics['vertices'], mask.statistics['simplifiedVertices'], mask.statistics['errorBound'], feedback)
+        if maskCache is not None:
+            if not maskCache.putMask(maskKey, [bytes(wkb) for wkb in broilerEngine.shapely.to_wkb(mask.parts)], mask.tiles.tolist(), records, mask.sources.tolist()):
+                self.reportMaskNotStored(maskCache, feedback)
+        return mask
+
+    def reportMaskNotStored(self, maskCache, feedback):
+        """
+        Warns that the exclusion mask was too large for the mask cache, so it
+        will be prepared again on every run.
+        """
+        feedback.reportError(f'The exclusion mask is larger than the {maskCache.maxBytes // (1024 * 1024)} MB mask cache and was not stored, '
+                             'so it will be prepared again on every run')
 
+    def featureRecords(self, source, crs, context):
+        """
+        Returns the hash and bounds of every feature of a network, keyed by
+        feature id.  The bounds are in the working CRS, so edits can be
+        found without reprojecting the network.
+        """
+        transform = None
+        if source.sourceCrs() != crs:
+            transform = QgsCoordinateTransform(source.sourceCrs(), crs, context.transformContext())
+        features = []
+        for feature in source.getFeatures():
+            box = feature.geometry().boundingBox()
+            if transform is not None:
+                box = transform.transformBoundingBox(box)
+            features.append((feature.id(), feature.geometry().asWkb(), (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())))
+        return broilerCache.hashFeatures(features)
+
+    def maskKey(self, parameters, context, engine, tolerance, crs):
+        """
+        Returns the mask cache key of the exclusion mask for these inputs.
+        The key names the network layers rather than hashing their data, so
+        a mask stored before an edit can be found and patched.
+        """
+        sources = []
+        for name in (self.HYDRO, self.ROAD):
+            layer = self.parameterAsVectorLayer(parameters, name, context)
+            sources.append(layer.source() if layer is not None else str(parameters[name]))
+        return broilerCache.makeMaskKey(
+            {'hydro' : self.HYDRO_DISTANCE, 'road' : self.ROAD_DISTANCE},
+            {'maxVertices' : self.MAX_VERTICES, 'engine' : self.ENGINES[engine], 'simplify' : tolerance, 'tileSize' : self.TILE_SIZE, 'crs' : crs.authid()},
+            sources
+        )
+
+    def cacheKey(self, pointFile, massBroilerWaste, compound, iterations, engine, tolerance, masses, dataVersion, crs, transform):
+        """
+        Returns the result cache key for a solve of these inputs.
+        """
+        # Key the central points in metres in the working CRS, so rounding
+        # them means the same distance whatever the CRS of the farm layer
+        points = [(point.x(), point.y()) for point in self.farmPoints(pointFile, transform)]
+        return broilerCache.makeKey(
+            points,
+            massBroilerWaste,
+            self.COMPOUNDS[compound],
+            {'hydro' : self.HYDRO_DISTANCE, 'road' : self.ROAD_DISTANCE},
+            {'iterations' : iterations, 'segments' : self.SEGMENTS, 'engine' : self.ENGINES[engine], 'simplify' : tolerance, 'allocatedMasses' : masses, 'crs' : pointFile.sourceCrs().authid(), 'workingCrs' : crs.authid()},
+            dataVersion
+        )
+
+    def reportResult(self, massBroilerWaste, statistics, feedback):
+        """
+        Prints the area covered by the final buffer and the gain of the process.
+        """
+        listAreaBuff = statistics['listAreaBuff']
         # Calculate area increase
-        areaIncrease = listAreaBuff[iterations] - listAreaBuff[0]
+        areaIncrease = listAreaBuff[-1] - listAreaBuff[0]
         # Calculate percent increase
-        pcIncrease = ((listAreaBuff[iterations] / listAreaBuff[0]) - 1) * 100
-        
+        pcIncrease = ((listAreaBuff[-1] / listAreaBuff[0]) - 1) * 100
+
         # Print area of final Buffer
-        feedback.pushInfo(f'{parameters[self.MASS]}t of broiler waste contains {int(round(massCompound / 1000))}t of fertiliser, which covers {int(round(listAreaBuff[iterations] / 10000))} Ha')
+        feedback.pushInfo(f'{massBroilerWaste}t of broiler waste contains {int(round(statistics["massCompound"] / 1000))}t of fertiliser, which covers {int(round(listAreaBuff[-1] / 10000))} Ha')
         # Print area that has been added through this process
         feedback.pushInfo(f'Process increases area covered by {int(round(areaIncrease / 10000))} Ha')
         # Print percent increase process has provided
         feedback.pushInfo(f'This is {round(pcIncrease)}% larger than original area')
+        # Print the land each network took out of the final buffer
+        if statistics.get('excludedSources'):
+            hydroArea, roadArea, bothArea = statistics['excludedSources']
+            feedback.pushInfo(f'Excluded from the final buffer: {round(hydroArea / 10000, 1)} Ha by creeks only, {round(roadArea / 10000, 1)} Ha by roads only '
+                              f'and {round(bothArea / 10000, 1)} Ha by both, {round((hydroArea + roadArea + bothArea) / 10000, 1)} Ha in all')
+        # Print the largest change network simplification can have made
+        if statistics.get('errorBound'):
+            feedback.pushInfo(f'Simplifying the networks changed the area clipped from the final buffer by at most {round(statistics["errorBound"] / 10000, 2)} Ha')
 
-        # Return final Buffer as ouput layer
-        return {self.OUTPUT: dest_id}
\ No newline at end of file
+    def reportSimplification(self, vertices, simplifiedVertices, errorBound, feedback):
+        """
+        Prints the vertex reduction and largest area error of simplifying the
+        networks.
+        """
+        feedback.pushInfo(f'Simplification reduced the networks from {vertices} to {simplifiedVertices} vertices ({round((1 - simplifiedVertices / max(vertices, 1)) * 100)}% fewer)')
+        feedback.pushInfo(f'The exclusion mask changed by at most {round(errorBound / 10000, 2)} Ha')
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+Competing-farm allocation for the broiler buffer process.
+When the farms of a district are solved one at a time their spreading discs
+overlap, and the same paddocks are counted as capacity for several farms.
+This module treats land as a shared resource instead.  Where discs overlap,
+land is split between the farms with a multiplicatively weighted Voronoi
+split, weighted by the radius each farm's demand would need on open land.
+Land covered by several discs goes to the farm with the smallest distance
+divided by weight, so every piece of land belongs to exactly one farm and
+larger farms reach proportionally further into the land they share.  Each farm's radius is then re-solved until the land
+allocated to it, less the exclusion mask, meets its demand.
+Neighbouring discs are found with an STRtree and only farms whose
+neighbourhood changed are re-solved in each round, so hundreds of farms can
+be allocated without comparing every pair.
+"""
+
+# Import relevant Python libraries
+import numpy
+import shapely
+
+import broilerEngine
+
+
+# Relative shortfall of allocated land below which a farm is considered solved
+TOLERANCE = 0.0005
+# Smallest usable share of a disc assumed when growing it
+MIN_USABLE = 0.1
+# Largest disc area, as a multiple of demand, a farm may grow to
+MAX_GROWTH = 25
+# Width of the rim of a disc, as a share of its radius, that a farm's land
+# must reach for growing the disc to win it more land, and the number of
+# rounds in a row a farm may fall short of the rim before it is taken to
+# have run out of land
+RIM = 0.01
+STALL_ROUNDS = 3
+# Number of rounds without a farm being solved or running out of land after
+# which the farms still moving are left as they are
+PATIENCE = 5
+# Number of vertices used to draw a boundary circle between two farms
+CIRCLE_VERTICES = 720
+# Boundary circles larger than this many times a disc's reach are drawn straight
+CURVE_LIMIT = 1000
+# Number of sectors the land of farms sharing a location is measured in
+# before it is split between them
+SECTORS = 720
+
+
+def halfPlanes(xi, yi, xj, yj, offset, reach):
+    """
+    Returns polygons covering the side of a line across the segment from
+    farm i to farm j that is closer to farm i, out to a distance reach from
+    i.  The line is perpendicular to the segment, offset from i towards j.
+    """
+    # Unit vector from i towards j and its perpendicular
+    distance = numpy.hypot(xj - xi, yj - yi)
+    ux = (xj - xi) / distance
+    uy = (yj - yi) / distance
+    vx = -uy
+    vy = ux
+    # Rectangle from the line back past the far side of disc i
+    corners = numpy.stack([
+        numpy.stack([xi + ux * offset + vx * reach, yi + uy * offset + vy * reach], axis=-1),
+        numpy.stack([xi + ux * offset - vx * reach, yi + uy * offset - vy * reach], axis=-1),
+        numpy.stack([xi - ux * reach - vx * reach, yi - uy * reach - vy * reach], axis=-1),
+        numpy.stack([xi - ux * reach + vx * reach, yi - uy * reach + vy * reach], axis=-1)
+    ], axis=1)
+    return shapely.polygons(corners)
+
+
+def weightedRegions(xi, yi, wi, xj, yj, wj, reach):
+    """
+    Returns the boundary regions of a weighted Voronoi split between each pair
+    of farms i and j, and whether farm i keeps the inside of its region.
+    Land goes to the farm with the smaller distance divided by weight, so the
+    boundary is a circle of Apollonius around the farm of smaller weight.
+    Circles too large to curve noticeably within reach of farm i are replaced
+    by a straight line, as they are for farms of equal weight.
+    """
+    distance = numpy.hypot(xj - xi, yj - yi)
+    ratio = wi / wj
+    # Point on the segment where the two weighted distances are equal
+    offset = ratio * distance / (1 + ratio)
+    # Radius of the circle of Apollonius, infinite for equal weights
+    with numpy.errstate(divide='ignore'):
+        radius = ratio * distance / numpy.abs(1 - ratio ** 2)
+    straight = radius > CURVE_LIMIT * reach
+
+    # Farm i keeps the inside of a circle around itself when it is the lighter
+    regions = halfPlanes(xi, yi, xj, yj, offset, reach)
+    inside = straight | (ratio < 1)
+    curved = ~straight
+    if curved.any():
+        # Centre of the circle of Apollonius
+        scale = ratio[curved] ** 2
+        centreX = (xi[curved] - scale * xj[curved]) / (1 - scale)
+        centreY = (yi[curved] - scale * yj[curved]) / (1 - scale)
+        angles = numpy.linspace(0, 2 * numpy.pi, CIRCLE_VERTICES, endpoint=False)
+        corners = numpy.stack([
+            centreX[:, None] + radius[curved, None] * numpy.cos(angles),
+            centreY[:, None] + radius[curved, None] * numpy.sin(angles)
+        ], axis=-1)
+        regions[curved] = shapely.polygons(corners)
+    return regions, inside
+
+
+def allocateCells(x, y, radii, weights, farms, segments=broilerEngine.DISC_SEGMENTS):
+    """
+    Returns the land allocated to each of the given farms: its disc less the
+    parts of every overlapping neighbour's disc that lie on the neighbour's
+    side of their weighted Voronoi boundary.
+    Land covered by a single disc always stays with its farm.
+    """
+    discs = broilerEngine.makeDiscs(x, y, radii, segments)
+    cells = discs[farms].copy()
+    # Find overlapping neighbours of the farms being allocated
+    tree = shapely.STRtree(discs)
+    farmIndex, neighbourIndex = tree.query(discs[farms], predicate='intersects')
+    keep = farms[farmIndex] != neighbourIndex
+    farmIndex = farmIndex[keep]
+    neighbourIndex = neighbourIndex[keep]
+    if not len(farmIndex):
+        return cells
+
+    # Build the boundary each neighbour sets against the farm
+    i = farms[farmIndex]
+    regions, inside = weightedRegions(x[i], y[i], weights[i], x[neighbourIndex], y[neighbourIndex], weights[neighbourIndex], 2 * radii[i] + 1)
+
+    # Find the part of each neighbour's disc the neighbour wins
+    lost = numpy.empty(len(farmIndex), dtype=object)
+    lost[inside] = shapely.difference(discs[neighbourIndex[inside]], regions[inside])
+    lost[~inside] = shapely.intersection(discs[neighbourIndex[~inside]], regions[~inside])
+
+    # Cut every cell by its first neighbour, then its second, and so on
+    order = numpy.argsort(farmIndex, kind='stable')
+    farmIndex = farmIndex[order]
+    lost = lost[order]
+    starts = numpy.searchsorted(farmIndex, farmIndex, side='left')
+    rank = numpy.arange(len(farmIndex)) - starts
+    for count in range(rank.max() + 1):
+        selected = rank == count
+        cells[farmIndex[selected]] = shapely.difference(cells[farmIndex[selected]], lost[selected])
+    return cells
+
+
+def sectors(x, y, start, end, reach):
+    """
+    Returns polygons covering the sectors around x, y between the angles
+    start and end (in radians), out to at least reach.
+    """
+    polygons = []
+    for first, last in zip(numpy.atleast_1d(start), numpy.atleast_1d(end)):
+        count = max(int(numpy.ceil((last - first) / (2 * numpy.pi) * SECTORS)), 1)
+        angles = numpy.linspace(first, last, count + 1)
+        # Push the arc out so its chords stay beyond reach
+        distance = reach / numpy.cos(numpy.pi / SECTORS)
+        arc = numpy.stack([x + distance * numpy.cos(angles), y + distance * numpy.sin(angles)], axis=1)
+        polygons.append(shapely.Polygon(numpy.concatenate([[[x, y]], arc])) if last > first else shapely.Polygon())
+    return numpy.array(polygons, dtype=object)
+
+
+def splitLocation(cell, x, y, reach, shares, mask):
+    """
+    Returns the land of a location split into one sector per farm, so that
+    each farm's share of the land less the mask matches its share of the
+    demand, and the land less the mask in each sector.
+    The land is measured in narrow sectors first, and the angles between
+    farms interpolated from the running total.
+    """
+    angles = numpy.linspace(0, 2 * numpy.pi, SECTORS + 1)
+    pieces = shapely.intersection(cell, sectors(x, y, angles[:-1], angles[1:], reach))
+    land = numpy.concatenate([[0], numpy.cumsum(shapely.area(pieces) - mask.clipAreas(pieces))])
+    bounds = numpy.interp(numpy.concatenate([[0], numpy.cumsum(shares)]) * land[-1] / max(numpy.sum(shares), 1e-12), land, angles)
+    bounds[0] = 0
+    bounds[-1] = 2 * numpy.pi
+    parts = shapely.intersection(cell, sectors(x, y, bounds[:-1], bounds[1:], reach))
+    return parts, shapely.area(parts) - mask.clipAreas(parts)
+
+
+def allocate(x, y, targetArea, mask, iterations=50, tolerance=TOLERANCE, segments=broilerEngine.DISC_SEGMENTS):
+    """
+    Solves the radius of every farm so that its share of the land, less the
+    exclusion mask, meets targetArea.
+    x, y and targetArea are arrays with one value per farm and mask is an
+    ExclusionMask.  Farms at the same location are solved as one, and its
+    land is then split into sectors, one per farm, in proportion to their
+    demand, so no land is given to two farms.  A farm whose share of land runs
+    out before its demand is met, as its land no longer reaches the rim of
+    its disc, is reported as not converged and grown no further, and the
+    rounds end early once no farm has been settled for PATIENCE rounds.  Returns a
+    dictionary of the arrays radius, netArea (allocated land less the mask),
+    converged and cells (the land allocated to each farm).
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    targetArea = numpy.broadcast_to(numpy.asarray(targetArea, dtype=float), x.shape)
+
+    # Combine farms sharing a location, as no bisector separates them
+    locations, farmGroup = numpy.unique(numpy.stack([x, y], axis=1), axis=0, return_inverse=True)
+    farmGroup = farmGroup.ravel()
+    groupX = locations[:, 0]
+    groupY = locations[:, 1]
+    groupTarget = numpy.bincount(farmGroup, weights=targetArea, minlength=len(locations))
+
+    # Start every group from the disc its demand would need on open land,
+    # whose radius also weights its share of overlapping land
+    areaBuff = groupTarget.copy()
+    radii = numpy.sqrt(areaBuff / numpy.pi)
+    weights = radii.copy()
+    netArea = numpy.zeros(len(locations))
+    cells = numpy.empty(len(locations), dtype=object)
+    converged = numpy.zeros(len(locations), dtype=bool)
+    active = numpy.arange(len(locations))
+    # Largest disc area known to fall short and smallest known to exceed demand
+    lowArea = groupTarget.copy()
+    lowShortfall = numpy.full(len(locations), numpy.nan)
+    highArea = numpy.full(len(locations), numpy.inf)
+    highShortfall = numpy.full(len(locations), numpy.nan)
+    # Whether the last step was held back by the upper or lower bound
+    heldHigh = numpy.zeros(len(locations), dtype=bool)
+    heldLow = numpy.zeros(len(locations), dtype=bool)
+    # Whether each disc fell short (1) or exceeded demand (-1) last time
+    lastSide = numpy.zeros(len(locations))
+    # Rounds in a row each farm's land has fallen short of the rim of its disc
+    stalls = numpy.zeros(len(locations), dtype=int)
+    exhausted = numpy.zeros(len(locations), dtype=bool)
+    # Most farms settled so far, and the round it was reached in
+    settled = 0
+    settledRound = 0
+
+    for count in range(iterations + 1):
+        # Allocate land to the groups whose disc or neighbours changed
+        cells[active] = allocateCells(groupX, groupY, radii, weights, active, segments)
+        netArea[active] = shapely.area(cells[active]) - mask.clipAreas(cells[active])
+
+        shortfall = groupTarget - netArea
+        converged = numpy.abs(shortfall) <= tolerance * groupTarget
+        # Count the rounds in which a short farm's land stops short of the rim
+        # of its disc, as its neighbours then win all the land around it and
+        # growing the disc cannot help
+        short = active[shortfall[active] > 0]
+        rims = shapely.difference(
+            broilerEngine.makeDiscs(groupX[short], groupY[short], radii[short], segments),
+            broilerEngine.makeDiscs(groupX[short], groupY[short], radii[short] * (1 - RIM), segments)
+        )
+        enclosed = shapely.area(shapely.intersection(cells[short], rims)) <= 1e-6 * shapely.area(rims)
+        stalls[active] = 0
+        stalls[short] = numpy.where(enclosed, stalls[short] + 1, 0)
+        # Farms at the growth limit, or which have stalled, cannot be helped
+        # by growing further
+        exhausted |= (shortfall > 0) & ((areaBuff >= MAX_GROWTH * groupTarget * (1 - tolerance)) | (stalls >= STALL_ROUNDS))
+        changed = active[~converged[active] & ~exhausted[active]]
+        # Stop once farms have stopped settling, rather than running every
+        # iteration for a few farms chasing each other's boundaries
+        if (converged | exhausted).sum() > settled:
+            settled = (converged | exhausted).sum()
+            settledRound = count
+        if not len(changed) or count == iterations or count - settledRound >= PATIENCE:
+            break
+
+        # Narrow the bracket around each disc area.  A bound that still holds
+        # a disc back after it was pressed against is likely stale, as the
+        # neighbours have moved since, so it is forgotten
+        short = changed[shortfall[changed] > 0]
+        over = changed[shortfall[changed] <= 0]
+        stale = short[heldHigh[short]]
+        highArea[stale] = numpy.inf
+        highShortfall[stale] = numpy.nan
+        lowArea[short] = areaBuff[short]
+        lowShortfall[short] = shortfall[short]
+        stale = over[heldLow[over]]
+        lowArea[stale] = groupTarget[stale]
+        lowShortfall[stale] = numpy.nan
+        highArea[over] = areaBuff[over]
+        highShortfall[over] = shortfall[over]
+        # Halve the weight of a bound kept twice in a row, so interpolation
+        # cannot stall against it
+        highShortfall[short[lastSide[short] == 1]] /= 2
+        lowShortfall[over[lastSide[over] == -1]] /= 2
+        lastSide[short] = 1
+        lastSide[over] = -1
+
+        # Without an upper bound, grow the disc by its shortfall as in the
+        # single farm process, scaled by the share of its disc the farm can
+        # use as shared land returns less than the area added
+        usable = numpy.clip(netArea[changed] / (numpy.pi * radii[changed] ** 2), MIN_USABLE, 1)
+        nextArea = areaBuff[changed] + shortfall[changed] / usable
+        # Within a bracket, interpolate between its ends but keep clear of them
+        bracketed = numpy.isfinite(highArea[changed]) & numpy.isfinite(lowShortfall[changed])
+        low = lowArea[changed]
+        high = highArea[changed]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            secant = low + lowShortfall[changed] * (high - low) / (lowShortfall[changed] - highShortfall[changed])
+            lowest = low + 0.1 * (high - low)
+            highest = high - 0.1 * (high - low)
+        heldHigh[changed] = bracketed & (secant >= highest) | ~bracketed & (nextArea >= high)
+        heldLow[changed] = bracketed & (secant <= lowest)
+        nextArea = numpy.where(bracketed, numpy.clip(secant, lowest, highest), numpy.minimum(nextArea, high))
+        previousRadii = radii[changed]
+        # Never more than double a disc in one round, nor grow it past the
+        # limit where its share of land has clearly run out
+        nextArea = numpy.minimum(nextArea, numpy.minimum(2 * areaBuff[changed], MAX_GROWTH * groupTarget[changed]))
+        areaBuff[changed] = numpy.maximum(nextArea, groupTarget[changed])
+        radii[changed] = numpy.sqrt(areaBuff[changed] / numpy.pi)
+
+        # Re-solve changed groups and every neighbour their old or new discs touch
+        discs = broilerEngine.makeDiscs(groupX, groupY, radii, segments)
+        reach = broilerEngine.makeDiscs(groupX[changed], groupY[changed], numpy.maximum(previousRadii, radii[changed]), segments)
+        neighbours = shapely.STRtree(discs).query(reach, predicate='intersects')[1]
+        # Farms that ran out of land keep their discs, so their land is only
+        # allocated again once the rest are solved
+        active = numpy.setdiff1d(numpy.union1d(changed, neighbours), numpy.flatnonzero(exhausted))
+
+    # Allocate the land left to the farms that ran out of it
+    final = numpy.flatnonzero(exhausted)
+    if len(final):
+        cells[final] = allocateCells(groupX, groupY, radii, weights, final, segments)
+        netArea[final] = shapely.area(cells[final]) - mask.clipAreas(cells[final])
+        converged[final] = numpy.abs(groupTarget[final] - netArea[final]) <= tolerance * groupTarget[final]
+
+    # Split the land of a combined location between its farms
+    farmCells = cells[farmGroup]
+    farmNetArea = netArea[farmGroup]
+    for group in numpy.flatnonzero(numpy.bincount(farmGroup, minlength=len(locations)) > 1):
+        farms = numpy.flatnonzero(farmGroup == group)
+        farmCells[farms], farmNetArea[farms] = splitLocation(cells[group], groupX[group], groupY[group], radii[group], targetArea[farms], mask)
+    return {
+        'radius' : radii[farmGroup],
+        'netArea' : farmNetArea,
+        'converged' : converged[farmGroup],
+        'cells' : farmCells
+    }
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sharded batch runner for solving thousands of farms across many machines.
+A statewide run is too big for one machine, so the farm layer is split into
+shards by mask tile (farms sharing tiles land in the same shard), and
+worker processes on any number of hosts pull shards from a work queue kept
+as files on shared storage:
+
+    queue/job.json                settings of the run
+    queue/mask.npz                exclusion mask, written once and only read
+    queue/pending/                shards waiting for a worker
+    queue/claimed/                shards being solved, touched as they progress
+    queue/checkpoints/            farms already solved in each claimed shard
+    queue/results/                solved shards, merged at the end
+
+A worker claims a shard by renaming it from pending to claimed, which only
+one worker can do.  Farms are solved in chunks and each chunk is saved to a
+checkpoint, so a shard whose worker fails is returned to pending once its
+claim goes stale and the next worker resumes from the checkpoint.
+Farms are solved independently, with the single farm process of
+broilerEngine, so shards never need each other's results.
+Networks and farms are read from GeoJSON files, such as those written by
+broilerSynthetic.py.  This module has no QGIS dependency.
+"""
+
+# Import relevant Python libraries
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+import numpy
+import shapely
+
+import broilerCache
+import broilerCompounds
+import broilerEngine
+import broilerExport
+import broilerSynthetic
+
+# pyproj tells projected coordinate systems from geographic ones, which not
+# every install has
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+
+# Default number of farms in a shard
+SHARD_SIZE = 200
+# Number of farms solved between checkpoints
+CHECKPOINT_SIZE = 20
+# Seconds after which a claimed shard nobody has touched is given up on
+LEASE = 600
+# Seconds a worker waits before looking again for shards to claim
+POLL = 5
+# Name of the exclusion mask file in the queue
+MASK_FILE = 'mask.npz'
+# EPSG code of longitude and latitude on WGS84, the coordinate system of
+# GeoJSON files that do not name one (RFC 7946)
+WGS84 = 4326
+# Geographic coordinate systems recognised when pyproj is not installed
+GEOGRAPHIC_EPSG = [4326, 4283, 7844, 4269, 4258]
+
+
+def readGeoJSON(path):
+    """
+    Returns the geometries, properties and EPSG code of a GeoJSON file.
+    Files that do not name a coordinate system, or name CRS84, are in
+    longitude and latitude on WGS84.
+    """
+    with open(path) as file:
+        data = json.load(file)
+    geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in data['features']])
+    properties = [feature.get('properties') or {} for feature in data['features']]
+    name = (data.get('crs') or {}).get('properties', {}).get('name', 'urn:ogc:def:crs:OGC:1.3:CRS84')
+    if name.upper().endswith('CRS84'):
+        epsg = WGS84
+    elif name.split(':')[-1].isdigit():
+        epsg = int(name.split(':')[-1])
+    else:
+        raise ValueError(f'Cannot read the coordinate system {name} of {path}, expected an EPSG code')
+    return geometries, properties, epsg
+
+
+def requireMetres(epsg, path):
+    """
+    Raises a ValueError unless an EPSG code is a projected coordinate system
+    in metres, as the buffer distances and areas are in metres.  Without
+    pyproj, only the GEOGRAPHIC_EPSG systems are recognised.
+    """
+    if pyproj is not None:
+        crs = pyproj.CRS.from_epsg(epsg)
+        metres = crs.is_projected and all(axis.unit_name in ('metre', 'meter') for axis in crs.axis_info)
+    else:
+        metres = epsg not in GEOGRAPHIC_EPSG
+    if not metres:
+        raise ValueError(f'{path} is in EPSG:{epsg}, reproject it to a projected coordinate system in metres')
+
+
+def writeJSON(path, data):
+    """
+    Writes a JSON file so readers never see it half written.
+    """
+    temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def readJSON(path):
+    """
+    Returns the contents of a JSON file.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+def featureRecords(lines):
+    """
+    Returns the hash and bounds of every line, keyed by its position.
+    """
+    return broilerCache.hashFeatures(zip(range(len(lines)), shapely.to_wkb(lines), shapely.bounds(lines)))
+
+
+def writeMask(path, mask, key, records):
+    """
+    Writes an exclusion mask to a NumPy archive, with the key of the
+    settings it was built with and the feature records of its networks.
+    The parts are stored as their WKB end to end, with the offset of each,
+    and the file is written whole under a temporary name, so workers never
+    see it half written.
+    """
+    wkb = shapely.to_wkb(mask.parts)
+    offsets = numpy.concatenate([[0], numpy.cumsum([len(part) for part in wkb])])
+    temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp.npz'
+    numpy.savez(temporary, wkb=numpy.frombuffer(b''.join(wkb), dtype=numpy.uint8), offsets=offsets, tiles=mask.tiles,
+                sources=mask.sources, key=key, records=json.dumps(records))
+    os.replace(temporary, path)
+
+
+def readMask(path):
+    """
+    Returns the exclusion mask, key and feature records of a mask file
+    written with writeMask.  The file is only read, so any number of workers
+    can open it at once.
+    """
+    with open(path, 'rb') as file, numpy.load(file) as data:
+        wkb = data['wkb'].tobytes()
+        offsets = data['offsets']
+        parts = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+        mask = broilerEngine.ExclusionMask(parts, data['tiles'], sources=data['sources'])
+        return mask, str(data['key']), json.loads(str(data['records']))
+
+
+def prepareMask(job, queue):
+    """
+    Builds the exclusion mask of a job and writes it to the queue.  A mask
+    written by an earlier prepare of the queue with the same settings is
+    kept if the networks are unchanged, or patched where they changed.
+    """
+    path = os.path.join(queue, MASK_FILE)
+    maskKey = broilerCache.makeMaskKey(
+        {'hydro' : broilerEngine.HYDRO_DISTANCE, 'road' : broilerEngine.ROAD_DISTANCE},
+        {'maxVertices' : broilerEngine.MAX_VERTICES, 'engine' : 'Shapely (vectorised)', 'simplify' : job['tolerance'], 'tileSize' : broilerEngine.TILE_SIZE},
+        [os.path.abspath(job['hydro']), os.path.abspath(job['road'])]
+    )
+    hydroLines, _, hydroEPSG = readGeoJSON(job['hydro'])
+    roadLines, _, roadEPSG = readGeoJSON(job['road'])
+    for network, epsg in ((job['hydro'], hydroEPSG), (job['road'], roadEPSG)):
+        if epsg != job['epsg']:
+            raise ValueError(f'{network} is in EPSG:{epsg} but the farms are in EPSG:{job["epsg"]}, reproject the inputs to one coordinate system')
+    records = {'hydro' : featureRecords(hydroLines), 'road' : featureRecords(roadLines)}
+
+    stored = readMask(path) if os.path.exists(path) else None
+    # Masks built with other settings cannot be patched
+    if stored is not None and stored[1] != maskKey:
+        stored = None
+    if stored is not None and stored[2] == records:
+        return
+    if stored is not None:
+        # Rebuild only the tiles the edited lines can reach
+        mask = broilerEngine.patchMask(
+            stored[0], hydroLines, roadLines,
+            broilerCache.changedBounds(stored[2]['hydro'], records['hydro']),
+            broilerCache.changedBounds(stored[2]['road'], records['road']),
+            tolerance=job['tolerance']
+        )
+    else:
+        mask = broilerEngine.prepareMask(hydroLines, roadLines, tolerance=job['tolerance'])
+    writeMask(path, mask, maskKey, records)
+
+
+def loadMask(queue):
+    """
+    Returns the exclusion mask prepared for a queue.
+    """
+    path = os.path.join(queue, MASK_FILE)
+    if not os.path.exists(path):
+        raise RuntimeError(f'{path} is missing, prepare the queue before starting workers')
+    return readMask(path)[0]
+
+
+def makeShards(x, y, shardSize=SHARD_SIZE, tileSize=broilerEngine.TILE_SIZE):
+    """
+    Returns a list of arrays of farm indices, each at most shardSize long.
+    Farms are ordered by the Z-order curve of their mask tile, so farms in
+    the same or neighbouring tiles fall in the same shard.
+    """
+    column = numpy.floor(numpy.asarray(x) / tileSize).astype(numpy.int64)
+    row = numpy.floor(numpy.asarray(y) / tileSize).astype(numpy.int64)
+    column -= column.min()
+    row -= row.min()
+    # Interleave the bits of the column and row
+    code = numpy.zeros(len(column), dtype=numpy.int64)
+    for bit in range(31):
+        code |= ((column >> bit) & 1) << (2 * bit)
+        code |= ((row >> bit) & 1) << (2 * bit + 1)
+    order = numpy.argsort(code, kind='stable')
+    return [order[start:start + shardSize] for start in range(0, len(order), shardSize)]
+
+
+def prepareJob(queue, points, hydro, road, compound='Nitrogen', iterations=10, massField='mass', mass=3000, tolerance=0, shardSize=SHARD_SIZE):
+    """
+    Creates the work queue of a run: writes its settings and one pending
+    file per shard, and builds the exclusion mask the workers read.  A queue
+    still holding the shards of a run is not prepared again, so no shard is
+    queued twice.  Returns the number of shards.
+    """
+    # Every input must be in the same coordinate system, in metres
+    geometries, properties, epsg = readGeoJSON(points)
+    requireMetres(epsg, points)
+    shardFiles = [path for folder in ('pending', 'claimed', 'checkpoints', 'results') for path in glob.glob(os.path.join(queue, folder, '*.json'))]
+    if shardFiles:
+        raise RuntimeError(f'The queue still holds {len(shardFiles)} shard files of an earlier run, merge them and empty its pending, claimed, '
+                           'checkpoints and results folders before preparing it again')
+    for folder in ('pending', 'claimed', 'checkpoints', 'results'):
+        os.makedirs(os.path.join(queue, folder), exist_ok=True)
+    job = {
+        'points' : os.path.abspath(points),
+        'hydro' : os.path.abspath(hydro),
+        'road' : os.path.abspath(road),
+        'compound' : compound,
+        'iterations' : iterations,
+        'massField' : massField,
+        'mass' : mass,
+        'tolerance' : tolerance,
+        'epsg' : epsg
+    }
+    # Build the mask once, so workers only need to read it
+    prepareMask(job, queue)
+    writeJSON(os.path.join(queue, 'job.json'), job)
+
+    shards = makeShards(shapely.get_x(geometries), shapely.get_y(geometries), shardSize)
+    for number, farms in enumerate(shards):
+        writeJSON(os.path.join(queue, 'pending', f'shard{number:05d}.json'), {'farms' : farms.tolist()})
+    return len(shards)
+
+
+def requeueStale(queue, lease=LEASE):
+    """
+    Returns shards whose claims have not been touched within lease seconds to
+    pending, as their worker has most likely failed.
+    """
+    for path in glob.glob(os.path.join(queue, 'claimed', '*.json')):
+        try:
+            if time.time() - os.path.getmtime(path) > lease:
+                os.rename(path, os.path.join(queue, 'pending', os.path.basename(path)))
+        except OSError:
+            # Another worker finished or requeued the shard first
+            continue
+
+
+def claimShard(queue):
+    """
+    Returns the name of a pending shard this worker now owns, or None.
+    """
+    for path in sorted(glob.glob(os.path.join(queue, 'pending', '*.json'))):
+        try:
+            os.rename(path, os.path.join(queue, 'claimed', os.path.basename(path)))
+        except OSError:
+            # Another worker claimed this shard first
+            continue
+        return os.path.basename(path)
+    return None
+
+
+def solveShard(queue, name, job, mask, geometries, properties):
+    """
+    Solves the farms of a claimed shard in chunks, saving a checkpoint after
+    each chunk, and writes the shard's results.  Returns whether the results
+    were written, which they are not when another worker took the shard over.
+    """
+    claimed = os.path.join(queue, 'claimed', name)
+    checkpoint = os.path.join(queue, 'checkpoints', name)
+    farms = readJSON(claimed)['farms']
+    # Resume from the farms a failed worker already solved
+    solved = readJSON(checkpoint) if os.path.exists(checkpoint) else {}
+    factor, concentration = broilerCompounds.COMPOUNDS[job['compound']]
+
+    remaining = [farm for farm in farms if str(farm) not in solved]
+    for start in range(0, len(remaining), CHECKPOINT_SIZE):
+        chunk = numpy.array(remaining[start:start + CHECKPOINT_SIZE])
+        # Farms without a mass attribute spread the default mass, while a
+        # mass of 0 is kept
+        masses = [properties[farm].get(job['massField']) for farm in chunk]
+        masses = numpy.array([float(job['mass'] if value is None else value) for value in masses])
+        discs, arrays = broilerEngine.solveBuffer(
+            shapely.get_x(geometries[chunk]),
+            shapely.get_y(geometries[chunk]),
+            masses * factor / concentration,
+            mask,
+            job['iterations']
+        )
+        for index, farm in enumerate(chunk):
+            solved[str(farm)] = {
+                'geometry' : shapely.to_wkb(discs[index], hex=True),
+                'radius' : float(arrays['listDistBuff'][-1, index]),
+                'area' : float(arrays['listAreaBuff'][-1, index]),
+                'target' : float(arrays['listAreaBuff'][0, index]),
+                # Split the land excluded from the final disc by network
+                'excluded' : arrays['excludedSources'][index].tolist(),
+                # Keep the iterations of the process for the columnar export
+                'traces' : {name : arrays[name][:, index].tolist() for name in broilerExport.TRACES}
+            }
+        writeJSON(checkpoint, solved)
+        # Touch the claim so other workers know this shard is alive
+        try:
+            os.utime(claimed)
+        except OSError:
+            # The claim went stale and another worker has the shard now
+            return False
+
+    writeJSON(os.path.join(queue, 'results', name), solved)
+    for path in (claimed, checkpoint):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+    return True
+
+
+def work(queue, lease=LEASE, poll=POLL, wait=False):
+    """
+    Claims and solves shards until none are left.  With wait, keeps looking
+    while other workers still hold claims, in case one of them fails.
+    Returns the number of shards this worker solved and wrote.
+    """
+    job = readJSON(os.path.join(queue, 'job.json'))
+    mask = loadMask(queue)
+    geometries, properties, epsg = readGeoJSON(job['points'])
+    count = 0
+    while True:
+        requeueStale(queue, lease)
+        name = claimShard(queue)
+        if name is not None:
+            if solveShard(queue, name, job, mask, geometries, properties):
+                count += 1
+        elif wait and glob.glob(os.path.join(queue, 'claimed', '*.json')):
+            time.sleep(poll)
+        else:
+            return count
+
+
+def excludedColumns(result):
+    """
+    Returns the land excluded from a farm's final disc by each network (in
+    hectares), keyed by output column.  Results solved before the exclusion
+    was split have no such columns.
+    """
+    return {f'{source}_ha' : round(area / 10000, 4) for source, area in zip(broilerEngine.SOURCES, result.get('excluded', []))}
+
+
+def mergeResults(queue, output):
+    """
+    Merges the results of every shard into one GeoJSON file of buffers with
+    the attributes of their farm.  Outputs ending in .parquet, .arrow or
+    .feather are written as columns with broilerExport instead, with the
+    trace of every iteration.  Returns the number of farms written.
+    """
+    unfinished = glob.glob(os.path.join(queue, 'pending', '*.json')) + glob.glob(os.path.join(queue, 'claimed', '*.json'))
+    if unfinished:
+        raise RuntimeError(f'{len(unfinished)} shards have not been solved')
+    job = readJSON(os.path.join(queue, 'job.json'))
+    properties, epsg = readGeoJSON(job['points'])[1:]
+
+    solved = {}
+    for path in sorted(glob.glob(os.path.join(queue, 'results', '*.json'))):
+        solved.update(readJSON(path))
+    farms = sorted(solved, key=int)
+    if output.endswith(('.parquet', '.arrow', '.feather')):
+        table = broilerExport.resultsTable(
+            [int(farm) for farm in farms],
+            shapely.from_wkb([solved[farm]['geometry'] for farm in farms]),
+            {name : numpy.array([solved[farm]['traces'][name] for farm in farms]).T for name in broilerExport.TRACES},
+            [dict(properties[int(farm)], **excludedColumns(solved[farm])) for farm in farms],
+            epsg
+        )
+        broilerExport.writeResults(output, table)
+        return len(farms)
+    broilerSynthetic.writeGeoJSON(
+        output,
+        shapely.from_wkb([solved[farm]['geometry'] for farm in farms]),
+        [dict(properties[int(farm)], radius=round(solved[farm]['radius'], 2), area_ha=round(solved[farm]['area'] / 10000, 4), **excludedColumns(solved[farm])) for farm in farms],
+        epsg
+    )
+    return len(farms)
+
+
+def runLocal(queue, output, workers):
+    """
+    Solves a prepared queue with several local processes standing in for
+    hosts, then merges the results.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=work, args=(queue,), kwargs={'wait' : True}) for count in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return mergeResults(queue, output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Solve the broiler buffers of many farms across many machines.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prepare = commands.add_parser('prepare', help='create the work queue of a run')
+    prepare.add_argument('queue', help='folder on shared storage holding the queue')
+    prepare.add_argument('--points', required=True, help='GeoJSON file of farm points')
+    prepare.add_argument('--hydro', required=True, help='GeoJSON file of the hydro network')
+    prepare.add_argument('--road', required=True, help='GeoJSON file of the road network')
+    prepare.add_argument('--compound', default='Nitrogen', choices=list(broilerCompounds.COMPOUNDS))
+    prepare.add_argument('--iterations', type=int, default=10)
+    prepare.add_argument('--mass-field', default='mass', help='farm property holding its mass of waste (in tonnes)')
+    prepare.add_argument('--mass', type=float, default=3000, help='mass of farms without the property (in tonnes)')
+    prepare.add_argument('--simplify', type=float, default=0, help='network simplification tolerance (in metres)')
+    prepare.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    worker = commands.add_parser('work', help='solve shards until none are left')
+    worker.add_argument('queue')
+    worker.add_argument('--lease', type=float, default=LEASE, help='seconds before an untouched claim is given up on')
+    worker.add_argument('--wait', action='store_true', help='keep waiting while other workers hold claims')
+    merge = commands.add_parser('merge', help='merge the solved shards')
+    merge.add_argument('queue')
+    merge.add_argument('output', help='GeoJSON, GeoParquet (.parquet) or Arrow (.arrow) file the buffers are written to')
+    local = commands.add_parser('local', help='solve a prepared queue with local processes, then merge')
+    local.add_argument('queue')
+    local.add_argument('output')
+    local.add_argument('--workers', type=int, default=4)
+    arguments = parser.parse_args()
+
+    if arguments.command == 'prepare':
+        print(f'{prepareJob(arguments.queue, arguments.points, arguments.hydro, arguments.road, arguments.compound, arguments.iterations, arguments.mass_field, arguments.mass, arguments.simplify, arguments.shard_size)} shards queued')
+    elif arguments.command == 'work':
+        print(f'{work(arguments.queue, arguments.lease, wait=arguments.wait)} shards solved')
+    elif arguments.command == 'merge':
+        print(f'{mergeResults(arguments.queue, arguments.output)} farms written')
+    else:
+        print(f'{runLocal(arguments.queue, arguments.output, arguments.workers)} farms written')
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scaling benchmark of the broiler buffer engines on synthetic study areas.
+Each engine is run over study areas of increasing size (as multiples of
+TestData) and numbers of farms, built by broilerSynthetic.py.  Every case
+records the time taken to prepare the exclusion mask and to solve, the peak
+memory of the process and the accuracy of the result, measured as how far
+the spreadable land of the solved buffers falls from the area the waste
+needs.  Results are written to a CSV file, with the slope of time against
+network size on a log-log scale for each engine.
+Given the CSV of an earlier run as a baseline, the benchmark fails when a
+case becomes much slower or less accurate, so it can gate a release.
+Every case runs in a separate process, so its peak memory is not inflated
+by earlier cases.  The 'QGIS Processing' engine runs the Broiler Network
+Buffer algorithm through qgis_process, and is only benchmarked when
+qgis_process is found and has the script loaded in the Processing Toolbox.
+From the QGIS Python console, pass the arguments to main rather than
+running the module, as the console's own arguments are not the
+benchmark's:
+
+    import broilerBenchmark
+    broilerBenchmark.main(['results.csv', '--scales', '1', '10'])
+"""
+
+# Import relevant Python libraries
+import argparse
+import csv
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import shapely
+
+import broilerAllocation
+import broilerBatch
+import broilerCompounds
+import broilerEngine
+import broilerSynthetic
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Engines that can be benchmarked
+ENGINES = ['QGIS Processing', 'Shapely (vectorised)', 'Allocation']
+# Identifier of the Broiler Network Buffer algorithm in the Processing Toolbox
+ALGORITHM = 'script:broilernetworkbuffer'
+# Mass of waste at each farm for the single farm engines (in tonnes)
+MASS = 3000
+# Target area of a tonne of waste, as Nitrogen (square metres)
+AREA_PER_TONNE = broilerCompounds.COMPOUNDS['Nitrogen'][0] / broilerCompounds.COMPOUNDS['Nitrogen'][1]
+# Columns of the results file
+COLUMNS = ['engine', 'scale', 'farms', 'vertices', 'prepareSeconds', 'solveSeconds', 'totalSeconds', 'peakMegabytes', 'residual']
+# Default ratio of time to baseline time above which a case fails
+SLOWDOWN_LIMIT = 1.5
+# Default rise in residual above baseline at which a case fails
+RESIDUAL_LIMIT = 0.001
+
+
+def peakMegabytes(children=False):
+    """
+    Returns the peak resident memory of this process in megabytes, or with
+    children, of the largest process it started that has ended.  Returns
+    None where the platform cannot tell.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def targetAreas(area, engine):
+    """
+    Returns the area the waste of each farm of a study area needs.
+    """
+    if engine == 'Allocation':
+        return area['masses'] * AREA_PER_TONNE
+    return numpy.full(len(area['points']), MASS * AREA_PER_TONNE)
+
+
+def solveCase(engine, scale, farms, seed, iterations):
+    """
+    Runs one engine on one study area.  Returns the solved buffers as WKB,
+    the preparation and solve times and the peak memory.
+    """
+    area = broilerSynthetic.studyArea(scale, farms, seed)
+    x = shapely.get_x(area['points'])
+    y = shapely.get_y(area['points'])
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    mask = broilerEngine.prepareMask(area['hydro'], area['road'])
+    prepared = time.perf_counter()
+    if engine == 'Allocation':
+        buffers = broilerAllocation.allocate(x, y, targetAreas(area, engine), mask, iterations)['cells']
+    else:
+        buffers = broilerEngine.solveBuffer(x, y, targetAreas(area, engine), mask, iterations)[0]
+    solved = time.perf_counter()
+
+    # Fall back on Python allocations where resident memory is unknown
+    peak = peakMegabytes()
+    if peak is None:
+        peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return shapely.to_wkb(buffers).tolist(), prepared - start, solved - prepared, peak
+
+
+def solveProcessingCase(scale, farms, seed, iterations, folder, qgisProcess):
+    """
+    Runs the Broiler Network Buffer algorithm with the Processing engine on
+    one study area through qgis_process.  Returns the same as solveCase.
+    Run in a worker of its own, the peak memory is that of qgis_process, or
+    NaN where the platform cannot tell, and the solve time includes the
+    start of QGIS.
+    """
+    area = broilerSynthetic.studyArea(scale, farms, seed)
+    caseFolder = os.path.join(folder, f'scale{scale}farms{farms}')
+    hydroFile, roadFile, pointFile = broilerSynthetic.writeStudyArea(caseFolder, area)
+    output = os.path.join(caseFolder, 'Buffers.geojson')
+    start = time.perf_counter()
+    subprocess.run([
+        qgisProcess, 'run', ALGORITHM, '--',
+        f'INPUT={pointFile}',
+        f'HYDRO={hydroFile}',
+        f'ROAD={roadFile}',
+        f'MASS={MASS}',
+        'COMPOUND=0',
+        f'ITERATIONS={iterations}',
+        'ENGINE=0',
+        'USE_CACHE=false',
+        f'OUTPUT={output}'
+    ], check=True, capture_output=True)
+    solved = time.perf_counter()
+    peak = peakMegabytes(children=True)
+    # The Processing engine prepares its mask inside the algorithm
+    return shapely.to_wkb(broilerBatch.readGeoJSON(output)[0]).tolist(), 0, solved - start, float('nan') if peak is None else peak
+
+
+def findQgisProcess():
+    """
+    Returns the path of qgis_process, or None when it is not on the PATH.
+    """
+    return shutil.which('qgis_process') or shutil.which('qgis_process-qgis') or shutil.which('qgis_process-qgis-ltr')
+
+
+def processingAvailable(qgisProcess):
+    """
+    Returns whether qgis_process can run the Broiler Network Buffer
+    algorithm.
+    """
+    if qgisProcess is None:
+        return False
+    return subprocess.run([qgisProcess, 'help', ALGORITHM], capture_output=True).returncode == 0
+
+
+def pythonExecutable():
+    """
+    Returns the Python interpreter the benchmark's workers are started with.
+    Inside QGIS sys.executable is QGIS itself, which would start a new QGIS
+    window for every worker.
+    """
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    version = f'python{sys.version_info.major}.{sys.version_info.minor}'
+    for path in [os.path.join(sys.exec_prefix, 'python.exe'), os.path.join(sys.exec_prefix, 'bin', version), os.path.join(sys.exec_prefix, 'bin', 'python3')]:
+        if os.path.isfile(path):
+            return path
+    path = shutil.which(version) or shutil.which('python3')
+    if path is None:
+        raise RuntimeError(f'Cannot find the Python interpreter of {sys.executable} to start the benchmark workers with')
+    return path
+
+
+def residual(buffers, targets, mask):
+    """
+    Returns how far the spreadable land of the buffers falls from the area
+    needed, relative to the area needed.
+    """
+    buffers = shapely.from_wkb(buffers)
+    spreadable = shapely.area(buffers) - mask.clipAreas(buffers)
+    return float(abs(spreadable.sum() - targets.sum()) / targets.sum())
+
+
+def runBenchmark(engines, scales, farmCounts, seed=0, iterations=10, feedback=print, qgisProcess=None):
+    """
+    Runs every engine over every scale and number of farms.  Returns a list
+    of result dictionaries with the COLUMNS as keys.  qgisProcess is the
+    path of qgis_process, needed for the 'QGIS Processing' engine.
+    """
+    results = []
+    folder = tempfile.mkdtemp(prefix='broilerBenchmark')
+    # Run each case in a fresh process so peak memory is its own
+    pool = multiprocessing.get_context('spawn')
+    pool.set_executable(pythonExecutable())
+    for scale in scales:
+        for farms in farmCounts:
+            area = broilerSynthetic.studyArea(scale, farms, seed)
+            vertices = broilerEngine.countVertices(area['hydro']) + broilerEngine.countVertices(area['road'])
+            # Measure accuracy against a mask built outside the timed cases
+            mask = broilerEngine.prepareMask(area['hydro'], area['road'])
+            for engine in engines:
+                if engine == 'Allocation' and farms < 2:
+                    continue
+                feedback(f'{engine}: scale {scale}, {farms} farms, {vertices} vertices')
+                with pool.Pool(1) as worker:
+                    if engine == 'QGIS Processing':
+                        buffers, prepareSeconds, solveSeconds, peak = worker.apply(solveProcessingCase, (scale, farms, seed, iterations, folder, qgisProcess))
+                    else:
+                        buffers, prepareSeconds, solveSeconds, peak = worker.apply(solveCase, (engine, scale, farms, seed, iterations))
+                results.append({
+                    'engine' : engine,
+                    'scale' : scale,
+                    'farms' : farms,
+                    'vertices' : vertices,
+                    'prepareSeconds' : round(prepareSeconds, 3),
+                    'solveSeconds' : round(solveSeconds, 3),
+                    'totalSeconds' : round(prepareSeconds + solveSeconds, 3),
+                    'peakMegabytes' : round(peak, 1),
+                    'residual' : round(residual(buffers, targetAreas(area, engine), mask), 6)
+                })
+    return results
+
+
+def scalingSlopes(results):
+    """
+    Returns the slope of log time against log vertices for each engine and
+    number of farms, 1 meaning time grows in proportion to network size.
+    """
+    slopes = {}
+    for engine, farms in sorted({(result['engine'], result['farms']) for result in results}):
+        cases = [result for result in results if result['engine'] == engine and result['farms'] == farms]
+        if len(cases) < 2:
+            continue
+        vertices = numpy.log([float(result['vertices']) for result in cases])
+        seconds = numpy.log([max(float(result['totalSeconds']), 1e-3) for result in cases])
+        slopes[(engine, farms)] = float(numpy.polyfit(vertices, seconds, 1)[0])
+    return slopes
+
+
+def writeResults(path, results):
+    """
+    Writes benchmark results to a CSV file.
+    """
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def readResults(path):
+    """
+    Reads benchmark results from a CSV file.
+    """
+    with open(path, newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def compareResults(results, baseline, slowdownLimit=SLOWDOWN_LIMIT, residualLimit=RESIDUAL_LIMIT):
+    """
+    Returns a list of messages describing every case that is slower than
+    slowdownLimit times its baseline or whose residual rose by more than
+    residualLimit.  Cases missing from the baseline are not compared.
+    """
+    previous = {(row['engine'], float(row['scale']), int(row['farms'])) : row for row in baseline}
+    failures = []
+    for result in results:
+        row = previous.get((result['engine'], float(result['scale']), int(result['farms'])))
+        if row is None:
+            continue
+        name = f'{result["engine"]} at scale {result["scale"]} with {result["farms"]} farms'
+        if float(result['totalSeconds']) > slowdownLimit * max(float(row['totalSeconds']), 1e-3):
+            failures.append(f'{name} took {result["totalSeconds"]} s against {row["totalSeconds"]} s')
+        if float(result['residual']) > float(row['residual']) + residualLimit:
+            failures.append(f'{name} is {result["residual"]} from its target against {row["residual"]}')
+    return failures
+
+
+def main(argv=None):
+    """
+    Runs the benchmark with a list of command line arguments, or those of
+    the command line when argv is None.  Returns 1 when a case failed,
+    otherwise 0.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the broiler buffer engines on synthetic study areas.')
+    parser.add_argument('output', help='CSV file the results are written to')
+    parser.add_argument('--engines', nargs='+', default=ENGINES[1:], choices=ENGINES, help='engines to benchmark')
+    parser.add_argument('--scales', nargs='+', type=float, default=[1, 10, 100], help='study area sizes as multiples of TestData')
+    parser.add_argument('--farms', nargs='+', type=int, default=[1, 100], help='numbers of farms')
+    parser.add_argument('--iterations', type=int, default=10, help='iterations of the buffer process')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic study areas')
+    parser.add_argument('--baseline', help='CSV file of an earlier run to compare against')
+    parser.add_argument('--slowdown', type=float, default=SLOWDOWN_LIMIT, help='ratio of time to baseline time that fails')
+    parser.add_argument('--max-slope', type=float, help='largest log-log slope of time against vertices allowed')
+    parser.add_argument('--qgis-process', default=findQgisProcess(), help='path of qgis_process, for the QGIS Processing engine')
+    arguments = parser.parse_args(argv)
+
+    engines = arguments.engines
+    if 'QGIS Processing' in engines and not processingAvailable(arguments.qgis_process):
+        print('qgis_process cannot run the Broiler Network Buffer algorithm, skipping the QGIS Processing engine')
+        engines = [engine for engine in engines if engine != 'QGIS Processing']
+    results = runBenchmark(engines, arguments.scales, arguments.farms, arguments.seed, arguments.iterations, qgisProcess=arguments.qgis_process)
+    writeResults(arguments.output, results)
+
+    failures = []
+    for (engine, farms), slope in scalingSlopes(results).items():
+        print(f'{engine} with {farms} farms: time grows as vertices to the power {slope:.2f}')
+        if arguments.max_slope is not None and slope > arguments.max_slope:
+            failures.append(f'{engine} with {farms} farms scales as vertices to the power {slope:.2f}')
+    if arguments.baseline:
+        failures += compareResults(results, readResults(arguments.baseline), arguments.slowdown)
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
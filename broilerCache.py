@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent caches of solved broiler buffers and prepared exclusion masks.
+Consultants often rerun the same farm with the same inputs while building a
+report.  Rather than repeating the whole iterative buffer and clip process,
+the solved geometry and statistics are stored in a small SQLite database,
+keyed by everything that can change the answer.  The cache is capped in size
+and the least recently used results are evicted first.
+Preparing the exclusion mask (buffering, dissolving and subdividing the
+networks) is the most expensive step of a new solve, so the subdivided mask
+parts are kept in a second cache, keyed by the network layers and the
+settings used to build them.  A hash of every network feature is stored with
+the mask, so after an edit only the features that changed need rebuilding.
+This module has no QGIS dependency, so it can be used from the Processing
+algorithm, the console scripts or any other Python process.
+"""
+
+# Import relevant Python libraries
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+# Number of decimal places coordinates (in metres, in the working CRS) are
+# rounded to when building a key
+COORDINATE_PRECISION = 3
+# Number of decimal places the waste mass is rounded to when building a key
+MASS_PRECISION = 6
+# Default size cap of the result cache (in bytes of stored results)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Default size cap of the mask cache (in bytes of stored masks)
+DEFAULT_MASK_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def defaultCachePath():
+    """
+    Returns the default location of the cache database in the user's home.
+    """
+    return os.path.join(os.path.expanduser('~'), '.broilerBuffer', 'resultCache.sqlite')
+
+
+def defaultMaskCachePath():
+    """
+    Returns the default location of the mask cache database in the user's home.
+    """
+    return os.path.join(os.path.expanduser('~'), '.broilerBuffer', 'maskCache.sqlite')
+
+
+def hashData(*sources):
+    """
+    Returns a hash identifying a version of the source data.
+    Each source is an iterable of (feature id, geometry WKB) pairs.
+    """
+    digest = hashlib.sha256()
+    for index, source in enumerate(sources):
+        # Separate sources so features cannot migrate between them unnoticed
+        digest.update(f'source{index}'.encode())
+        for featureId, wkb in source:
+            digest.update(str(featureId).encode())
+            digest.update(bytes(wkb))
+    return digest.hexdigest()
+
+
+def hashFeatures(features):
+    """
+    Returns a dictionary of feature records keyed by feature id.
+    features is an iterable of (feature id, geometry WKB, bounds) tuples, and
+    each record is the geometry hash followed by its xmin, ymin, xmax, ymax.
+    """
+    return {str(featureId) : [hashlib.sha256(bytes(wkb)).hexdigest()] + [float(value) for value in bounds] for featureId, wkb, bounds in features}
+
+
+def hashRecords(*records):
+    """
+    Returns a hash identifying a version of the source data from the feature
+    records of each source.
+    """
+    return hashlib.sha256(json.dumps(records, sort_keys=True).encode()).hexdigest()
+
+
+def changedBounds(oldRecords, newRecords):
+    """
+    Returns the bounds of every geometry added, removed or changed between
+    two sets of feature records.  A changed feature contributes its bounds
+    both before and after the edit.
+    Geometries are matched by hash, so features that were only renumbered,
+    as when a row is deleted from a shapefile, are not counted as changed.
+    """
+    oldGeometries = {record[0] : record[1:] for record in oldRecords.values()}
+    newGeometries = {record[0] : record[1:] for record in newRecords.values()}
+    bounds = [oldGeometries[geometryHash] for geometryHash in oldGeometries.keys() - newGeometries.keys()]
+    bounds += [newGeometries[geometryHash] for geometryHash in newGeometries.keys() - oldGeometries.keys()]
+    return bounds
+
+
+def makeKey(points, mass, compound, distances, settings, dataVersion):
+    """
+    Returns the cache key of a solve.
+    points is a list of (x, y) tuples, distances and settings are dictionaries
+    of the buffer distances and solver settings used.
+    """
+    keyParts = {
+        'points' : [[round(x, COORDINATE_PRECISION), round(y, COORDINATE_PRECISION)] for x, y in points],
+        'mass' : round(float(mass), MASS_PRECISION),
+        'compound' : compound,
+        'distances' : distances,
+        'settings' : settings,
+        'data' : dataVersion
+    }
+    # Sort dictionary keys so equal inputs always produce equal keys
+    return hashlib.sha256(json.dumps(keyParts, sort_keys=True).encode()).hexdigest()
+
+
+def makeMaskKey(distances, settings, sources):
+    """
+    Returns the cache key of a prepared exclusion mask.
+    distances and settings are dictionaries of the buffer distances and mask
+    preparation settings used, sources a list naming the network layers.
+    The key does not depend on the network data, so an edited network finds
+    its previous mask to patch.
+    """
+    keyParts = {
+        'distances' : distances,
+        'settings' : settings,
+        'sources' : sources
+    }
+    return hashlib.sha256(json.dumps(keyParts, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite backed store of solved buffers with a size cap and least recently
+    used eviction.
+    A new connection is opened for every call, so one cache can be shared
+    between threads and processes.
+    """
+
+    def __init__(self, path=None, maxBytes=DEFAULT_MAX_BYTES):
+        self.path = path or defaultCachePath()
+        self.maxBytes = maxBytes
+        # Make sure the folder holding the database exists
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, '
+                'geometry BLOB, '
+                'statistics TEXT, '
+                'size INTEGER, '
+                'lastUsed REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS resultsLastUsed ON results (lastUsed)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Opens a connection to the cache database, committing and closing it
+        when the block ends.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        """
+        Returns the stored (geometry WKB list, statistics) of a key, or None.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT geometry, statistics FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            # Mark result as recently used
+            connection.execute('UPDATE results SET lastUsed = ? WHERE key = ?', (time.time(), key))
+        geometries = json.loads(row[0].decode('ascii'))
+        return [bytes.fromhex(wkb) for wkb in geometries], json.loads(row[1])
+
+    def put(self, key, geometries, statistics):
+        """
+        Stores a list of geometry WKBs and a dictionary of statistics.
+        Returns whether they were stored, as results larger than the size cap
+        are not.
+        """
+        geometryBlob = json.dumps([bytes(wkb).hex() for wkb in geometries]).encode('ascii')
+        statisticsText = json.dumps(statistics)
+        size = len(geometryBlob) + len(statisticsText)
+        # Results larger than the whole cache are not worth keeping
+        if size > self.maxBytes:
+            return False
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                (key, geometryBlob, statisticsText, size, time.time())
+            )
+            self._evict(connection)
+        return True
+
+    def _evict(self, connection):
+        """
+        Removes least recently used results until the cache fits its size cap.
+        """
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.maxBytes:
+            return
+        rows = connection.execute('SELECT key, size FROM results ORDER BY lastUsed').fetchall()
+        for key, size in rows:
+            if total <= self.maxBytes:
+                break
+            connection.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+
+    def clear(self):
+        """
+        Removes every stored result.
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM results')
+
+
+class MaskCache(ResultCache):
+    """
+    SQLite backed store of subdivided exclusion mask parts, with the same
+    size cap and eviction as the result cache.
+    Each mask is stored with the tile and source network of every part and
+    the feature records of the networks it was built from.
+    """
+
+    def __init__(self, path=None, maxBytes=DEFAULT_MASK_MAX_BYTES):
+        super().__init__(path or defaultMaskCachePath(), maxBytes)
+
+    def getMask(self, key):
+        """
+        Returns the stored (mask part WKB list, tile list, feature records,
+        source list) of a key, or None.  The source list is None for masks
+        stored before the source of each part was recorded.
+        """
+        cached = self.get(key)
+        if cached is None:
+            return None
+        parts, statistics = cached
+        return parts, statistics['tiles'], statistics['records'], statistics.get('sources')
+
+    def putMask(self, key, parts, tiles, records, sources=None):
+        """
+        Stores a list of mask part WKBs, the (column, row) tile of each part,
+        the feature records of the networks and the source code of each part.
+        Returns whether the mask was stored, as masks larger than the size
+        cap are not.
+        """
+        return self.put(key, parts, {
+            'parts' : len(parts),
+            'tiles' : [[int(column), int(row)] for column, row in tiles],
+            'records' : records,
+            'sources' : None if sources is None else [int(source) for source in sources]
+        })
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compounds of broiler waste the buffer can be solved for.
+Every tool reads the mass of each compound in the waste and the
+concentration it is spread at from here, so they always agree.
+This module has no dependencies, so the QGIS Processing engine can use it
+where Shapely and NumPy are not installed.
+"""
+
+# Mass of each compound in a tonne of broiler waste (in kilograms) and the
+# concentration it is spread at (in kilograms per square metre), in the
+# order the compounds are offered
+COMPOUNDS = {
+    'Nitrogen' : (30.714286, 0.005),
+    'Phosphorus' : (14.142857, 0.0027),
+    'Potassium' : (13.428571, 0.0025)
+}
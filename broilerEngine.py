@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorised geometry engine for the broiler buffer process.
+The Processing version of the tool runs one algorithm at a time and loops
+over features in Python.  This engine holds the network as Shapely 2
+geometry arrays instead, and performs the buffering, union and disc
+intersection with vectorised functions, so the iterative process never has
+to leave compiled code.  Areas are returned as NumPy arrays.
+This module has no QGIS dependency.
+"""
+
+# Import relevant Python libraries
+import numpy
+import shapely
+
+
+# Buffer distances (in metres) applied to the networks
+HYDRO_DISTANCE = 50
+ROAD_DISTANCE = 40
+# Number of segments per quarter circle used by QGIS for network buffers
+NETWORK_SEGMENTS = 5
+# Number of segments per quarter circle used for the waste discs
+DISC_SEGMENTS = 10
+# Largest number of vertices kept in one part of a subdivided mask
+MAX_VERTICES = 256
+# Width (in metres) of the square tiles the mask is cut into, so an edit to
+# the networks only needs the tiles around it rebuilt
+TILE_SIZE = 5000
+# Networks each mask part is excluded by, in the order of the source codes
+SOURCES = ['hydro', 'road', 'both']
+
+
+def bufferNetwork(lines, distance, segments=NETWORK_SEGMENTS):
+    """
+    Returns the dissolved buffer of an array of network lines.
+    """
+    # Buffer every line at once and dissolve the result
+    buffers = shapely.buffer(numpy.asarray(lines), distance, quad_segs=segments)
+    return shapely.union_all(buffers)
+
+
+def simplifyNetwork(lines, tolerance):
+    """
+    Returns an array of network lines simplified with the Douglas-Peucker
+    algorithm.  Every point of a simplified line lies within tolerance of the
+    original line and every point of the original within tolerance of the
+    simplified one.
+    """
+    return shapely.simplify(numpy.asarray(lines), tolerance, preserve_topology=False)
+
+
+def countVertices(geometries):
+    """
+    Returns the total number of vertices in an array of geometries.
+    """
+    return int(shapely.get_num_coordinates(numpy.asarray(geometries)).sum())
+
+
+def simplificationError(mask, tolerance):
+    """
+    Returns the largest area a mask can have gained or lost by simplifying
+    its network lines with tolerance.
+    As no line moved further than tolerance, the buffer of a simplified line
+    lies between the buffers of the original at the buffer distance plus and
+    minus tolerance.  Any change therefore lies within tolerance of the
+    boundary of the mask, a band whose area is at most twice tolerance times
+    the perimeter.
+    """
+    return 2 * tolerance * float(shapely.length(mask))
+
+
+def subdivide(geometry, maxVertices=MAX_VERTICES, returnIndex=False):
+    """
+    Returns an array of polygons covering a polygonal geometry, none with
+    more than maxVertices vertices.
+    Parts are split in half across their longer side until they are small
+    enough, in the manner of PostGIS ST_Subdivide.
+    Given an array of geometries and returnIndex, the index of the geometry
+    each polygon came from is returned as well.
+    """
+    parts, owners = shapely.get_parts(numpy.atleast_1d(geometry), return_index=True)
+    # Tiles the geometry does not reach leave empty pieces behind
+    present = ~shapely.is_empty(parts)
+    parts = parts[present]
+    owners = owners[present]
+    done = []
+    doneOwners = []
+    while len(parts):
+        # Keep parts which are already small enough
+        small = shapely.get_num_coordinates(parts) <= maxVertices
+        done.append(parts[small])
+        doneOwners.append(owners[small])
+        parts = parts[~small]
+        owners = owners[~small]
+        if not len(parts):
+            break
+        # Split every remaining part in half across its longer side
+        bounds = shapely.bounds(parts)
+        xmin, ymin, xmax, ymax = bounds.T
+        wide = (xmax - xmin) >= (ymax - ymin)
+        xmid = numpy.where(wide, (xmin + xmax) / 2, xmax)
+        ymid = numpy.where(wide, ymax, (ymin + ymax) / 2)
+        first = shapely.intersection(parts, shapely.box(xmin, ymin, xmid, ymid))
+        second = shapely.intersection(parts, shapely.box(numpy.where(wide, xmid, xmin), numpy.where(wide, ymin, ymid), xmax, ymax))
+        parts, index = shapely.get_parts(numpy.concatenate([first, second]), return_index=True)
+        owners = numpy.concatenate([owners, owners])[index]
+        # Clipping can leave slivers of lower dimension behind
+        polygonal = shapely.get_type_id(parts) == 3
+        parts = parts[polygonal]
+        owners = owners[polygonal]
+    if returnIndex:
+        return numpy.concatenate(done), numpy.concatenate(doneOwners)
+    return numpy.concatenate(done)
+
+
+def tileBoxes(tiles, tileSize=TILE_SIZE):
+    """
+    Returns the square polygons of an array of (column, row) tiles.
+    """
+    tiles = numpy.asarray(tiles).reshape(-1, 2)
+    return shapely.box(tiles[:, 0] * tileSize, tiles[:, 1] * tileSize, (tiles[:, 0] + 1) * tileSize, (tiles[:, 1] + 1) * tileSize)
+
+
+def tilesCovering(bounds, tileSize=TILE_SIZE):
+    """
+    Returns the (column, row) tiles touched by an array of bounds given as
+    (xmin, ymin, xmax, ymax) rows.
+    """
+    tiles = set()
+    for xmin, ymin, xmax, ymax in numpy.asarray(bounds).reshape(-1, 4):
+        for column in range(int(numpy.floor(xmin / tileSize)), int(numpy.floor(xmax / tileSize)) + 1):
+            for row in range(int(numpy.floor(ymin / tileSize)), int(numpy.floor(ymax / tileSize)) + 1):
+                tiles.add((column, row))
+    return numpy.array(sorted(tiles), dtype=int).reshape(-1, 2)
+
+
+def tileGeometry(geometry, tiles, maxVertices=MAX_VERTICES, tileSize=TILE_SIZE):
+    """
+    Returns the parts of a polygonal geometry inside each of the given tiles,
+    subdivided, and the tile every part lies in.
+    """
+    tiles = numpy.asarray(tiles).reshape(-1, 2)
+    pieces = shapely.intersection(geometry, tileBoxes(tiles, tileSize))
+    parts, owners = subdivide(pieces, maxVertices, returnIndex=True)
+    return parts, tiles[owners]
+
+
+def tileSources(hydroBuffer, roadBuffer, tiles, maxVertices=MAX_VERTICES, tileSize=TILE_SIZE):
+    """
+    Returns the parts of two buffered networks inside each of the given
+    tiles, the tile every part lies in and the code of the SOURCES it is
+    excluded by.
+    Each tile's pieces of the two networks are overlaid on their own, so the
+    networks are split into land excluded by the hydro network only, the road
+    network only and both, without overlaying the whole networks at once.
+    """
+    tiles = numpy.asarray(tiles).reshape(-1, 2)
+    boxes = tileBoxes(tiles, tileSize)
+    hydroPieces = shapely.intersection(hydroBuffer, boxes)
+    roadPieces = shapely.intersection(roadBuffer, boxes)
+    pieces = numpy.concatenate([
+        shapely.difference(hydroPieces, roadPieces),
+        shapely.difference(roadPieces, hydroPieces),
+        shapely.intersection(hydroPieces, roadPieces)
+    ])
+    parts, owners = subdivide(pieces, maxVertices, returnIndex=True)
+    return parts, tiles[owners % len(tiles)], owners // len(tiles)
+
+
+class PolygonParts:
+    """
+    Small polygon parts behind an STRtree, overlaid with many discs at once.
+    An overlay with a disc only touches the parts whose envelopes intersect
+    it, so its cost depends on the number of parts around the disc rather
+    than on the size of the whole layer.
+    statistics holds anything worth reporting about how the parts were built.
+    """
+
+    def __init__(self, parts, statistics=None):
+        self.parts = numpy.asarray(parts)
+        self.tree = shapely.STRtree(self.parts)
+        self.statistics = statistics or {}
+
+    def localParts(self, disc):
+        """
+        Returns the parts whose envelopes intersect a disc.
+        """
+        return self.parts[self.tree.query(disc)]
+
+    def partAreas(self, discs):
+        """
+        Returns the area of the parts inside each disc.
+        """
+        discs = numpy.atleast_1d(discs)
+        # Find every disc and part pair whose envelopes intersect
+        discIndex, partIndex = self.tree.query(discs)
+        # Intersect only those pairs, then total the areas for each disc
+        areas = shapely.area(shapely.intersection(self.parts[partIndex], discs[discIndex]))
+        return numpy.bincount(discIndex, weights=areas, minlength=len(discs))
+
+    def dissolvedParts(self, discs):
+        """
+        Returns the index of every disc with parts inside it and those parts,
+        clipped to the disc and dissolved.
+        """
+        discs = numpy.atleast_1d(discs)
+        discIndex, partIndex = self.tree.query(discs)
+        pieces = shapely.intersection(self.parts[partIndex], discs[discIndex])
+        # Group the pieces by disc, as the query returns them in disc order
+        order = numpy.argsort(discIndex, kind='stable')
+        starts = numpy.flatnonzero(numpy.diff(discIndex[order], prepend=-1))
+        groups = [group for group in numpy.split(order, starts[1:]) if len(group)]
+        return discIndex[[group[0] for group in groups]], numpy.array([shapely.union_all(pieces[group]) for group in groups], dtype=object)
+
+    def boundaryLengths(self, discs):
+        """
+        Returns the length of part boundaries inside each disc.
+        Edges where the parts were subdivided are counted too, so this is
+        never less than the length of the boundary of the dissolved parts.
+        """
+        discs = numpy.atleast_1d(discs)
+        discIndex, partIndex = self.tree.query(discs)
+        lengths = shapely.length(shapely.intersection(shapely.boundary(self.parts[partIndex]), discs[discIndex]))
+        return numpy.bincount(discIndex, weights=lengths, minlength=len(discs))
+
+
+class ExclusionMask(PolygonParts):
+    """
+    Exclusion mask stored as many small, non-overlapping polygon parts behind
+    an STRtree.
+    Every part lies within one square tile, recorded in tiles as a (column,
+    row) pair, so the mask can be patched one tile at a time.
+    Masks built from the networks also record in sources which of them each
+    part is excluded by, as a code of SOURCES, so excluded land can be
+    attributed to the hydro network, the road network or both.
+    """
+
+    def __init__(self, parts, tiles=None, statistics=None, sources=None):
+        super().__init__(parts, statistics)
+        self.tiles = numpy.zeros((len(self.parts), 2), dtype=int) if tiles is None else numpy.asarray(tiles, dtype=int).reshape(-1, 2)
+        self.sources = None if sources is None else numpy.asarray(sources, dtype=int)
+
+    @classmethod
+    def fromGeometry(cls, geometry, maxVertices=MAX_VERTICES, statistics=None, tileSize=TILE_SIZE):
+        """
+        Returns the mask of a dissolved geometry, cut into tiles and
+        subdivided into small parts.
+        """
+        tiles = tilesCovering(shapely.bounds(geometry), tileSize)
+        parts, partTiles = tileGeometry(geometry, tiles, maxVertices, tileSize)
+        return cls(parts, partTiles, statistics)
+
+    def clipAreas(self, discs, bySource=False):
+        """
+        Returns the area of the mask inside each disc.
+        With bySource, the areas are split by the SOURCES excluding them and
+        shaped (discs, sources), from the same overlay as the total.
+        """
+        if not bySource:
+            return self.partAreas(discs)
+        if self.sources is None:
+            raise ValueError('The mask does not record which network each part is excluded by')
+        discs = numpy.atleast_1d(discs)
+        discIndex, partIndex = self.tree.query(discs)
+        areas = shapely.area(shapely.intersection(self.parts[partIndex], discs[discIndex]))
+        cells = discIndex * len(SOURCES) + self.sources[partIndex]
+        return numpy.bincount(cells, weights=areas, minlength=len(discs) * len(SOURCES)).reshape(len(discs), len(SOURCES))
+
+    def spreadableLand(self, discs):
+        """
+        Returns each disc less the mask, the land waste can be spread on.
+        Only the mask parts near each disc are dissolved and cut away.
+        """
+        discs = numpy.atleast_1d(discs)
+        land = discs.copy()
+        index, excluded = self.dissolvedParts(discs)
+        if len(index):
+            land[index] = shapely.difference(discs[index], excluded)
+        return land
+
+
+def prepareMask(hydroLines, roadLines, hydroDistance=HYDRO_DISTANCE, roadDistance=ROAD_DISTANCE, maxVertices=MAX_VERTICES, tolerance=0, tileSize=TILE_SIZE):
+    """
+    Returns the exclusion mask of the hydro and road networks, dissolved and
+    subdivided for repeated overlays.
+    With a tolerance, the network lines are simplified before buffering and
+    the mask statistics hold the vertex counts before and after and the
+    largest area error the simplification can have introduced.
+    """
+    statistics = {}
+    if tolerance > 0:
+        vertices = countVertices(hydroLines) + countVertices(roadLines)
+        hydroLines = simplifyNetwork(hydroLines, tolerance)
+        roadLines = simplifyNetwork(roadLines, tolerance)
+        statistics['vertices'] = vertices
+        statistics['simplifiedVertices'] = countVertices(hydroLines) + countVertices(roadLines)
+
+    # Buffer and dissolve each network, then overlay them tile by tile
+    hydroBuffer = bufferNetwork(hydroLines, hydroDistance)
+    roadBuffer = bufferNetwork(roadLines, roadDistance)
+    if tolerance > 0:
+        statistics['errorBound'] = simplificationError(hydroBuffer, tolerance) + simplificationError(roadBuffer, tolerance)
+    bounds = shapely.bounds([hydroBuffer, roadBuffer])
+    tiles = tilesCovering(bounds[~numpy.isnan(bounds).any(axis=1)], tileSize)
+    parts, partTiles, sources = tileSources(hydroBuffer, roadBuffer, tiles, maxVertices, tileSize)
+    return ExclusionMask(parts, partTiles, statistics, sources)
+
+
+def patchMask(mask, hydroLines, roadLines, hydroBounds, roadBounds, hydroDistance=HYDRO_DISTANCE, roadDistance=ROAD_DISTANCE, maxVertices=MAX_VERTICES, tolerance=0, tileSize=TILE_SIZE):
+    """
+    Returns a mask patched after the networks were edited.
+    hydroLines and roadLines are the current networks, and hydroBounds and
+    roadBounds the (xmin, ymin, xmax, ymax) bounds of every line added,
+    removed or changed, before and after the edit.  Only the tiles an edited
+    line's buffer can reach are rebuilt, from the lines that can reach them.
+    """
+    hydroBounds = numpy.asarray(hydroBounds, dtype=float).reshape(-1, 4)
+    roadBounds = numpy.asarray(roadBounds, dtype=float).reshape(-1, 4)
+    tiles = tilesCovering(numpy.concatenate([
+        hydroBounds + [-hydroDistance, -hydroDistance, hydroDistance, hydroDistance],
+        roadBounds + [-roadDistance, -roadDistance, roadDistance, roadDistance]
+    ]), tileSize)
+    if not len(tiles):
+        return mask
+    boxes = tileBoxes(tiles, tileSize)
+
+    # Buffer only the lines whose buffers reach the affected tiles
+    hydroLines = numpy.asarray(hydroLines)
+    roadLines = numpy.asarray(roadLines)
+    hydroLines = hydroLines[numpy.unique(shapely.STRtree(hydroLines).query(shapely.buffer(boxes, hydroDistance, join_style='mitre'))[1])]
+    roadLines = roadLines[numpy.unique(shapely.STRtree(roadLines).query(shapely.buffer(boxes, roadDistance, join_style='mitre'))[1])]
+    if tolerance > 0:
+        hydroLines = simplifyNetwork(hydroLines, tolerance)
+        roadLines = simplifyNetwork(roadLines, tolerance)
+    parts, partTiles, sources = tileSources(bufferNetwork(hydroLines, hydroDistance), bufferNetwork(roadLines, roadDistance), tiles, maxVertices, tileSize)
+
+    # Replace the parts of the affected tiles
+    keep = ~(mask.tiles[:, None, :] == tiles[None, :, :]).all(axis=2).any(axis=1)
+    statistics = dict(mask.statistics, patchedTiles=len(tiles))
+    return ExclusionMask(
+        numpy.concatenate([mask.parts[keep], parts]),
+        numpy.concatenate([mask.tiles[keep], partTiles]),
+        statistics,
+        None if mask.sources is None else numpy.concatenate([mask.sources[keep], sources])
+    )
+
+
+class EligibleLand(PolygonParts):
+    """
+    Land the waste may be spread on, the eligible parcels less the exclusion
+    mask, stored as small polygon parts behind an STRtree.
+    It answers the same overlays as an ExclusionMask, treating everything
+    outside the eligible land as excluded, so the solvers can use either.
+    """
+
+    sources = None
+
+    def clipAreas(self, discs, bySource=False):
+        """
+        Returns the area of each disc that is not eligible land.
+        """
+        if bySource:
+            raise ValueError('Eligible land does not record which network excludes the land around it')
+        discs = numpy.atleast_1d(discs)
+        return shapely.area(discs) - self.partAreas(discs)
+
+    def spreadableLand(self, discs):
+        """
+        Returns the eligible land inside each disc.
+        """
+        discs = numpy.atleast_1d(discs)
+        land = numpy.full(len(discs), shapely.Polygon())
+        index, parts = self.dissolvedParts(discs)
+        land[index] = parts
+        return land
+
+
+def eligibleLand(mask, parcels, maxVertices=MAX_VERTICES, land=None):
+    """
+    Returns the EligibleLand of an array of eligible parcels, each less the
+    exclusion mask around it.  Parcels are expected not to overlap, as in a
+    cadastre, and only the parcels near the farms need to be given.
+    With land, the parcels are added to an earlier EligibleLand, so parcels
+    found later are cut out of the mask without redoing the earlier ones.
+    """
+    parcels = numpy.asarray(parcels)
+    parcels = parcels[~shapely.is_empty(parcels)]
+    cut = shapely.get_parts(mask.spreadableLand(shapely.make_valid(parcels)) if len(parcels) else parcels)
+    # Repairing and cutting parcels can leave lines and points behind
+    cut = cut[shapely.get_type_id(cut) == 3]
+    parts = subdivide(cut, maxVertices) if len(cut) else cut
+    if land is None:
+        return EligibleLand(parts, {'parcels' : len(parcels)})
+    return EligibleLand(numpy.concatenate([land.parts, parts]), {'parcels' : land.statistics['parcels'] + len(parcels)})
+
+
+def discRadius(area, segments=DISC_SEGMENTS):
+    """
+    Returns the radius of the disc polygon with segments per quarter circle
+    whose area is the given area.  The polygon is inscribed in its circle,
+    so its radius is slightly longer than that of a circle of the same area.
+    """
+    sides = 4 * segments
+    return numpy.sqrt(area / (sides / 2 * numpy.sin(2 * numpy.pi / sides)))
+
+
+def makeDiscs(x, y, radii, segments=DISC_SEGMENTS):
+    """
+    Returns an array of disc polygons around points x, y of the given radii.
+    """
+    return shapely.buffer(shapely.points(x, y), radii, quad_segs=segments)
+
+
+def solveBuffer(x, y, targetArea, mask, iterations, segments=DISC_SEGMENTS):
+    """
+    Runs the iterative buffer and clip process for every point at once.
+    x, y and targetArea are arrays with one value per point and mask is an
+    ExclusionMask.  Returns the final discs and a dictionary of the
+    per-iteration arrays listAreaBuff, listAreaClip and listDistBuff, each
+    shaped (iterations + 1, points).  When the mask records the network of
+    each part, the dictionary also holds excludedSources, the area of the
+    final discs excluded by each of the SOURCES, shaped (points, sources).
+    """
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+    y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
+    targetArea = numpy.broadcast_to(numpy.asarray(targetArea, dtype=float), x.shape)
+
+    # Establish reference arrays for loop
+    listAreaBuff = numpy.zeros((iterations + 1,) + x.shape)
+    listAreaClip = numpy.zeros((iterations + 1,) + x.shape)
+    listDistBuff = numpy.zeros((iterations + 1,) + x.shape)
+
+    # Calculate area and distance of Buffer0
+    listAreaBuff[0] = targetArea
+    listDistBuff[0] = discRadius(listAreaBuff[0], segments)
+    discs = makeDiscs(x, y, listDistBuff[0], segments)
+
+    # Grow each disc by the network area it covers, as in the Processing version
+    for count in range(1, iterations + 1):
+        listAreaClip[count] = mask.clipAreas(discs)
+        listAreaBuff[count] = listAreaBuff[count - 1] + (listAreaClip[count] - listAreaClip[count - 1])
+        listDistBuff[count] = discRadius(listAreaBuff[count], segments)
+        discs = makeDiscs(x, y, listDistBuff[count], segments)
+
+    arrays = {
+        'listAreaBuff' : listAreaBuff,
+        'listAreaClip' : listAreaClip,
+        'listDistBuff' : listDistBuff
+    }
+    # Split the exclusion of the final discs between the networks
+    if mask.sources is not None:
+        arrays['excludedSources'] = mask.clipAreas(discs, bySource=True)
+    return discs, arrays
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar export of broiler buffer results.
+Batch and sweep runs solve tens of thousands of farms, and writing them one
+feature at a time into GeoJSON or a shapefile is slow to write and slower
+to read back.  This module writes every farm's attributes, solved buffer
+(as WKB) and the per-iteration trace of the process (listAreaBuff,
+listAreaClip and listDistBuff) as columns, in bulk:
+
+    .parquet    GeoParquet, compressed, readable by GeoPandas, GDAL and DuckDB
+    .arrow      Arrow IPC file, uncompressed so it can be memory-mapped and
+                read without copying
+
+Traces are fixed size list columns built directly from the NumPy arrays of
+the solver, one row per farm and one value per iteration.
+This module has no QGIS dependency, and needs pyarrow only when it writes
+or reads a file.
+"""
+
+# Import relevant Python libraries
+import json
+import warnings
+
+import numpy
+import shapely
+
+# Arrow is only needed for columnar files, which not every install has
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+
+# Names of the per-iteration trace columns
+TRACES = ['listAreaBuff', 'listAreaClip', 'listDistBuff']
+# Names of the columns written from the solve rather than from attributes
+SOLVED_COLUMNS = ['farm', 'radius', 'area', 'target'] + TRACES + ['geometry']
+# Prefix of attributes whose names are taken by a solved column
+PROPERTY_PREFIX = 'property_'
+# Version of the GeoParquet metadata written
+GEOPARQUET_VERSION = '1.0.0'
+# GeoParquet names of the Shapely geometry types
+GEOMETRY_TYPES = {0 : 'Point', 1 : 'LineString', 3 : 'Polygon', 4 : 'MultiPoint', 5 : 'MultiLineString', 6 : 'MultiPolygon', 7 : 'GeometryCollection'}
+
+
+def requireArrow():
+    """
+    Raises an ImportError naming the missing dependency when pyarrow is not
+    installed.
+    """
+    if pyarrow is None:
+        raise ImportError('Columnar export needs pyarrow, install it with "python -m pip install pyarrow"')
+
+
+def crsJSON(epsg):
+    """
+    Returns the PROJJSON of an EPSG code for the GeoParquet metadata, or None,
+    which GeoParquet reads as an unknown CRS, with a warning when pyproj is
+    not installed.  GeoParquet reads a missing CRS as longitude and latitude,
+    so the key is never left out.
+    """
+    if pyproj is not None:
+        return pyproj.CRS.from_epsg(epsg).to_json_dict()
+    warnings.warn(f'pyproj is not installed, so EPSG:{epsg} cannot be written as PROJJSON and the CRS is written as unknown, '
+                  'install it with "python -m pip install pyproj"', RuntimeWarning)
+    return None
+
+
+def resultsTable(farms, geometries, traces, properties=None, epsg=None):
+    """
+    Returns an Arrow table of solved farms.
+    farms is an array of farm numbers, geometries an array of the solved
+    buffers and traces a dictionary of (iterations + 1, farms) arrays keyed
+    by the TRACES names, as returned by broilerEngine.solveBuffer.
+    properties is a list of attribute dictionaries, one per farm.  The
+    final radius, area and target area of each farm are columns of their own.
+    Attributes named like one of the SOLVED_COLUMNS are written with
+    PROPERTY_PREFIX before their name.  Without an EPSG code the CRS is
+    written as unknown.
+    """
+    requireArrow()
+    columns = {'farm' : pyarrow.array(numpy.asarray(farms, dtype=numpy.int64))}
+    # Attributes become columns of the types Arrow finds for them
+    if properties:
+        names = list(dict.fromkeys(key for row in properties for key in row))
+        for name in names:
+            column = PROPERTY_PREFIX + name if name in SOLVED_COLUMNS else name
+            if column in columns or (column != name and column in names):
+                raise ValueError(f'The attribute {name} cannot be written, as {column} is taken by another column')
+            columns[column] = pyarrow.array([row.get(name) for row in properties])
+
+    arrays = {name : numpy.asarray(traces[name], dtype=numpy.float64) for name in TRACES}
+    columns['radius'] = pyarrow.array(arrays['listDistBuff'][-1])
+    columns['area'] = pyarrow.array(arrays['listAreaBuff'][-1])
+    columns['target'] = pyarrow.array(arrays['listAreaBuff'][0])
+    for name, values in arrays.items():
+        # Lay each farm's trace out in one row of contiguous values
+        columns[name] = pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(numpy.ascontiguousarray(values.T).ravel()), values.shape[0])
+    columns['geometry'] = pyarrow.array(shapely.to_wkb(geometries).tolist(), type=pyarrow.binary())
+
+    table = pyarrow.table(columns)
+    # Describe the geometry column as GeoParquet readers expect
+    geo = {
+        'version' : GEOPARQUET_VERSION,
+        'primary_column' : 'geometry',
+        'columns' : {
+            'geometry' : {
+                'encoding' : 'WKB',
+                'geometry_types' : sorted({GEOMETRY_TYPES[kind] for kind in numpy.unique(shapely.get_type_id(geometries)).tolist() if kind in GEOMETRY_TYPES}),
+                'bbox' : shapely.total_bounds(geometries).tolist(),
+                'crs' : crsJSON(epsg) if epsg is not None else None
+            }
+        }
+    }
+    return table.replace_schema_metadata({b'geo' : json.dumps(geo).encode()})
+
+
+def writeResults(path, table):
+    """
+    Writes an Arrow table of results to GeoParquet, or to an uncompressed
+    Arrow IPC file when path ends in .arrow or .feather.
+    """
+    requireArrow()
+    if path.endswith(('.arrow', '.feather')):
+        with pyarrow.OSFile(path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pyarrow.parquet.write_table(table, path, compression='zstd')
+
+
+def readResults(path):
+    """
+    Returns the Arrow table of a results file.  Arrow IPC files are memory
+    mapped, so their columns are read without copying.
+    """
+    requireArrow()
+    if path.endswith(('.arrow', '.feather')):
+        return pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+    return pyarrow.parquet.read_table(path)
+
+
+def traceArray(table, name):
+    """
+    Returns a trace column of a results table as a (farms, iterations + 1)
+    NumPy array, without copying where the column is contiguous.
+    flatten keeps to the rows of the column where it is a slice of a longer
+    array, as values would not.
+    """
+    column = table.column(name).combine_chunks()
+    return column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), column.type.list_size)
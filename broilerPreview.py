@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+Live preview of the broiler buffer for client meetings.
+Rerunning the Broiler Network Buffer algorithm for every change of mass or
+compound takes far too long for a conversation.  This dock lets the user
+click a farm on the map, measures the exclusion around it once as a profile
+(the excluded area inside discs of many radii, as the Monte Carlo mode
+does), and then solves the buffer from that profile on every movement of
+the mass slider or change of compound.  A solve is a few interpolations in
+the profile, taking well under a millisecond, so the disc and the net area
+are redrawn as the slider is dragged.
+From the QGIS Python console:
+
+    import broilerPreview
+    dock = broilerPreview.showPreview(iface)
+
+The map canvas must be in a projected CRS in metres.  The profile is
+measured in a background task, so QGIS stays usable while it is prepared.
+"""
+
+# Import relevant Python and PyQGIS libraries
+import numpy
+import shapely
+
+from qgis.core import (QgsApplication,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsMapLayerProxyModel,
+                       QgsPointXY,
+                       QgsRectangle,
+                       QgsTask,
+                       QgsUnitTypes,
+                       QgsWkbTypes)
+from qgis.gui import QgsMapLayerComboBox, QgsMapToolEmitPoint, QgsRubberBand
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtGui import QColor
+from qgis.PyQt.QtWidgets import (QComboBox,
+                                 QDockWidget,
+                                 QFormLayout,
+                                 QLabel,
+                                 QPushButton,
+                                 QSlider,
+                                 QWidget)
+
+import broilerCompounds
+import broilerEngine
+import broilerUncertainty
+
+
+# Largest mass the slider offers and the step it moves in (in tonnes)
+MAX_MASS = 10000
+MASS_STEP = 10
+# Mass the slider starts at (in tonnes)
+DEFAULT_MASS = 3000
+# Iterations of the buffer process repeated on the profile
+ITERATIONS = 10
+# Reach of the profile beyond the open land radius of the largest mass
+PROFILE_REACH = 1.5
+
+
+def solveProfile(radii, excluded, targetArea, iterations=ITERATIONS):
+    """
+    Returns the radius and excluded area of the buffer of a target area,
+    repeating the iterative process of the solver on an exclusion profile.
+    Returns None for both when the buffer grows past the last radius of the
+    profile, as the exclusion beyond it is unknown.
+    """
+    areaBuff = targetArea
+    for count in range(iterations):
+        areaClip = numpy.interp(broilerEngine.discRadius(areaBuff), radii, excluded)
+        areaBuff = targetArea + areaClip
+    radius = broilerEngine.discRadius(areaBuff)
+    # The profile holds its last value beyond its reach, so the buffer is
+    # too small there
+    if radius > radii[-1]:
+        return None, None
+    return float(radius), float(numpy.interp(radius, radii, excluded))
+
+
+class PreviewDock(QDockWidget):
+    """
+    Dock with the network layers, compound and mass slider of the preview.
+    """
+
+    def __init__(self, iface):
+        super().__init__('Broiler Buffer Preview')
+        self.iface = iface
+        self.canvas = iface.mapCanvas()
+        self.point = None
+        self.profile = None
+        self.task = None
+        # Counts the farms picked, so a profile measured for an earlier
+        # farm or earlier networks is never shown
+        self.token = 0
+
+        # Lay out the inputs
+        widget = QWidget()
+        layout = QFormLayout(widget)
+        self.hydroLayer = QgsMapLayerComboBox()
+        self.hydroLayer.setFilters(QgsMapLayerProxyModel.LineLayer)
+        self.roadLayer = QgsMapLayerComboBox()
+        self.roadLayer.setFilters(QgsMapLayerProxyModel.LineLayer)
+        self.compound = QComboBox()
+        self.compound.addItems(list(broilerCompounds.COMPOUNDS))
+        self.mass = QSlider(Qt.Horizontal)
+        self.mass.setRange(0, MAX_MASS // MASS_STEP)
+        self.mass.setValue(DEFAULT_MASS // MASS_STEP)
+        self.massLabel = QLabel()
+        self.pick = QPushButton('Pick farm on map')
+        self.pick.setCheckable(True)
+        self.result = QLabel('Pick a farm to preview its buffer')
+        self.result.setWordWrap(True)
+        layout.addRow('Hydro network', self.hydroLayer)
+        layout.addRow('Road network', self.roadLayer)
+        layout.addRow('Compound', self.compound)
+        layout.addRow(self.massLabel, self.mass)
+        layout.addRow(self.pick)
+        layout.addRow(self.result)
+        self.setWidget(widget)
+
+        # Draw the disc over the map without adding a layer to the project
+        self.band = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+        self.band.setColor(QColor(46, 139, 87, 90))
+        self.band.setStrokeColor(QColor(46, 139, 87))
+        self.tool = QgsMapToolEmitPoint(self.canvas)
+        self.tool.canvasClicked.connect(self.setFarm)
+        self.tool.deactivated.connect(lambda: self.pick.setChecked(False))
+
+        self.pick.toggled.connect(self.togglePick)
+        self.mass.valueChanged.connect(self.redraw)
+        self.compound.currentIndexChanged.connect(self.redraw)
+        self.hydroLayer.layerChanged.connect(self.clear)
+        self.roadLayer.layerChanged.connect(self.clear)
+        self.redraw()
+
+    def togglePick(self, checked):
+        """
+        Switches the map tool that picks the farm on and off.
+        """
+        if checked:
+            self.canvas.setMapTool(self.tool)
+        elif self.canvas.mapTool() is self.tool:
+            self.canvas.unsetMapTool(self.tool)
+
+    def clear(self):
+        """
+        Forgets the profile, as the networks it was measured on changed.
+        """
+        self.cancelTask()
+        self.point = None
+        self.profile = None
+        self.band.reset(QgsWkbTypes.PolygonGeometry)
+        self.result.setText('Pick a farm to preview its buffer')
+
+    def cancelTask(self):
+        """
+        Cancels the profile being measured, if any, and makes sure its result
+        is dropped when it finishes anyway.
+        """
+        self.token += 1
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def loadLines(self, layer, rectangle):
+        """
+        Returns the lines of a layer within a rectangle of the map, in the
+        CRS of the map, as a Shapely array.
+        """
+        request = QgsFeatureRequest().setDestinationCrs(self.canvas.mapSettings().destinationCrs(), self.canvas.mapSettings().transformContext())
+        request.setFilterRect(rectangle)
+        return shapely.from_wkb([bytes(feature.geometry().asWkb()) for feature in layer.getFeatures(request)])
+
+    def setFarm(self, point, button=None):
+        """
+        Measures the exclusion profile around a farm in a background task.
+        """
+        crs = self.canvas.mapSettings().destinationCrs()
+        if crs.isGeographic() or crs.mapUnits() != QgsUnitTypes.DistanceMeters:
+            self.result.setText('Set the map to a projected CRS in metres to preview buffers')
+            return
+        if self.hydroLayer.currentLayer() is None or self.roadLayer.currentLayer() is None:
+            self.result.setText('Select the hydro and road networks first')
+            return
+
+        # Reach far enough for the largest mass of any compound
+        areaPerTonne = max(factor / concentration for factor, concentration in broilerCompounds.COMPOUNDS.values())
+        maxRadius = PROFILE_REACH * numpy.sqrt(MAX_MASS * areaPerTonne / numpy.pi)
+        reach = maxRadius + max(broilerEngine.HYDRO_DISTANCE, broilerEngine.ROAD_DISTANCE)
+        rectangle = QgsRectangle(point.x() - reach, point.y() - reach, point.x() + reach, point.y() + reach)
+        # Read the layers here, as layers belong to the main thread
+        hydroLines = self.loadLines(self.hydroLayer.currentLayer(), rectangle)
+        roadLines = self.loadLines(self.roadLayer.currentLayer(), rectangle)
+
+        # Forget the farm before, so the slider does not redraw it meanwhile
+        self.clear()
+        token = self.token
+
+        def measure(task):
+            radii, areas = broilerUncertainty.exclusionProfile(
+                hydroLines, roadLines, point.x(), point.y(), maxRadius,
+                [broilerEngine.HYDRO_DISTANCE], [broilerEngine.ROAD_DISTANCE]
+            )
+            return radii, areas[0, 0]
+
+        def measured(exception, profile=None):
+            # Drop the profile of a farm or networks since replaced
+            if token != self.token:
+                return
+            self.task = None
+            if exception is not None or profile is None:
+                self.result.setText(f'Could not measure the exclusion around the farm: {exception}')
+                return
+            self.point = QgsPointXY(point)
+            self.profile = profile
+            self.redraw()
+
+        self.result.setText('Measuring the exclusion around the farm...')
+        self.task = QgsTask.fromFunction('Broiler buffer preview profile', measure, on_finished=measured)
+        QgsApplication.taskManager().addTask(self.task)
+
+    def redraw(self):
+        """
+        Solves and redraws the buffer for the mass and compound selected.
+        """
+        mass = self.mass.value() * MASS_STEP
+        self.massLabel.setText(f'Mass {mass} t')
+        if self.profile is None:
+            return
+        factor, concentration = broilerCompounds.COMPOUNDS[self.compound.currentText()]
+        targetArea = mass * factor / concentration
+        radius, excluded = solveProfile(self.profile[0], self.profile[1], targetArea)
+        if radius is None:
+            self.band.reset(QgsWkbTypes.PolygonGeometry)
+            self.result.setText(f'{mass} t of waste does not fit within {int(round(self.profile[0][-1]))} m of the farm, '
+                                f'run the Broiler Network Buffer algorithm to solve it')
+            return
+
+        self.band.setToGeometry(QgsGeometry.fromPointXY(self.point).buffer(radius, broilerEngine.DISC_SEGMENTS), None)
+        self.result.setText(f'{mass} t of waste holds {int(round(mass * factor))} kg of {self.compound.currentText()}, '
+                            f'spread within {int(round(radius))} m over {round(targetArea / 10000, 1)} Ha of land, '
+                            f'with {round(excluded / 10000, 1)} Ha of roads and creeks left out')
+
+    def closeEvent(self, event):
+        """
+        Removes the disc and map tool when the dock is closed.
+        """
+        self.togglePick(False)
+        self.cancelTask()
+        self.canvas.scene().removeItem(self.band)
+        super().closeEvent(event)
+
+
+def showPreview(iface):
+    """
+    Adds the preview dock to the QGIS window and returns it.
+    """
+    dock = PreviewDock(iface)
+    iface.addDockWidget(Qt.RightDockWidgetArea, dock)
+    return dock
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+"""
+Season mode for the broiler buffer process.
+Farms spread waste several times a year, and a paddock that took nutrient
+in one application cannot take the full rate again in the next.  This
+module carries the nutrient already spread forward as a raster: every cell
+holds its capacity (the concentration times its area outside the exclusion
+mask) and the load it has received.  Each application in a schedule is
+solved against the capacity left, nearest cells first, so the waste goes
+as far from the farm as it must and no further.
+Solving an application sorts the cells around the farm by distance and
+accumulates their remaining capacity until the waste is placed, so no
+iterative buffer process is needed, and only those cells are updated.  The
+raster is held in NumPy arrays and can be saved and reloaded, so a season
+can be continued by a later run.
+This module has no QGIS dependency.
+"""
+
+# Import relevant Python libraries
+import csv
+import datetime
+
+import numpy
+import shapely
+
+import broilerEngine
+
+
+# Width of the raster cells (in metres)
+CELL_SIZE = 25
+# Reach of the raster beyond the farms, as a multiple of the open land
+# radius of each farm's waste for the whole schedule
+REACH = 2
+
+
+def readSchedule(path):
+    """
+    Returns the applications of a CSV schedule with the columns farm, date
+    (as YYYY-MM-DD) and mass (in tonnes), sorted by date.  Farms are
+    numbered from 1 in the order of the farm layer.
+    """
+    applications = []
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            try:
+                applications.append((datetime.date.fromisoformat(row['date'].strip()), int(row['farm']), float(row['mass'])))
+            except (KeyError, ValueError):
+                raise ValueError(f'Cannot read schedule row {row}, expected farm, date (YYYY-MM-DD) and mass columns')
+    # Applications on the same day are solved in the order they are listed
+    return sorted(applications, key=lambda application: application[0])
+
+
+def excludedAreas(mask, corner, cellSize, rows, columns):
+    """
+    Returns the area of the mask in every cell of a raster with the corner of
+    its first cell at corner, shaped (rows, columns).
+    Rather than overlaying every cell, the boundary of the mask is split where
+    it crosses the cell edges and each piece adds the area between it and
+    the bottom of the raster to the cells below it, as in the shoelace
+    formula, which is exact for polygons and linear in their vertices.
+    """
+    xmin, ymin = corner
+    xmax = xmin + columns * cellSize
+    ymax = ymin + rows * cellSize
+    # Keep the mask within the raster, with exteriors clockwise and holes
+    # anticlockwise so every ring adds its area with the right sign
+    parts = mask.parts[mask.tree.query(shapely.box(xmin, ymin, xmax, ymax))]
+    parts = shapely.get_parts(shapely.clip_by_rect(parts, xmin, ymin, xmax, ymax))
+    parts = shapely.normalize(parts[shapely.get_type_id(parts) == 3])
+    coordinates, index = shapely.get_coordinates(shapely.get_rings(parts), return_index=True)
+    coordinates = (coordinates - [xmin, ymin]) / cellSize
+    same = index[1:] == index[:-1]
+    start = coordinates[:-1][same]
+    end = coordinates[1:][same]
+
+    # Split every edge where it crosses a column or row edge
+    low = numpy.floor(numpy.minimum(start, end))
+    crossings = numpy.abs(numpy.floor(end) - numpy.floor(start)).astype(int)
+    counts = crossings.T.ravel()
+    axis = numpy.repeat([0, 1], crossings.sum(axis=0))
+    edge = numpy.repeat(numpy.tile(numpy.arange(len(start)), 2), counts)
+    step = numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    line = low[edge, axis] + 1 + step
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        fraction = (line - start[edge, axis]) / (end[edge, axis] - start[edge, axis])
+    edge = numpy.concatenate([numpy.arange(len(start)), numpy.arange(len(start)), edge])
+    fraction = numpy.concatenate([numpy.zeros(len(start)), numpy.ones(len(start)), fraction])
+    order = numpy.lexsort((fraction, edge))
+    edge = edge[order]
+    points = start[edge] + fraction[order, None] * (end[edge] - start[edge])
+
+    # Each piece adds the area below it in its own cell and a full strip of
+    # its width to every cell below that
+    piece = edge[1:] == edge[:-1]
+    width = (points[1:, 0] - points[:-1, 0])[piece]
+    middle = ((points[1:] + points[:-1]) / 2)[piece]
+    column = numpy.clip(middle[:, 0].astype(int), 0, columns - 1)
+    row = numpy.clip(middle[:, 1].astype(int), 0, rows - 1)
+    cell = row * columns + column
+    partial = numpy.bincount(cell, weights=width * (middle[:, 1] - row), minlength=rows * columns).reshape(rows, columns)
+    full = numpy.bincount(cell, weights=width, minlength=rows * columns).reshape(rows, columns)
+    below = numpy.cumsum(full[::-1], axis=0)[::-1] - full
+    return (partial + below) * cellSize ** 2
+
+
+def cellCapacity(mask, corner, cellSize, rows, columns, concentration):
+    """
+    Returns the nutrient every cell of a raster can take, the concentration
+    times its area outside the mask, shaped (rows, columns).
+    """
+    excluded = excludedAreas(mask, corner, cellSize, rows, columns)
+    return concentration * numpy.clip(cellSize ** 2 - excluded, 0, None)
+
+
+class NutrientGrid:
+    """
+    Raster of the nutrient capacity and load of each cell, with the corner
+    of its first cell at xmin, ymin.  compound and concentration record the
+    nutrient the load is of and the rate the capacity was measured at.
+    """
+
+    def __init__(self, xmin, ymin, cellSize, capacity, load=None, date=None, compound=None, concentration=None):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.cellSize = cellSize
+        self.capacity = numpy.asarray(capacity, dtype=numpy.float32)
+        self.load = numpy.zeros_like(self.capacity) if load is None else numpy.asarray(load, dtype=numpy.float32)
+        self.date = date
+        self.compound = compound
+        self.concentration = concentration
+
+    @classmethod
+    def fromMask(cls, mask, bounds, concentration, cellSize=CELL_SIZE, compound=None):
+        """
+        Returns an empty grid over bounds, with the capacity of each cell
+        reduced by the share of it under the mask.
+        """
+        xmin, ymin, xmax, ymax = bounds
+        columns = int(numpy.ceil((xmax - xmin) / cellSize))
+        rows = int(numpy.ceil((ymax - ymin) / cellSize))
+        return cls(xmin, ymin, cellSize, cellCapacity(mask, (xmin, ymin), cellSize, rows, columns, concentration),
+                   compound=compound, concentration=concentration)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Returns a grid saved with save.
+        """
+        with numpy.load(path) as data:
+            date = str(data['date']) or None
+            # Grids saved without their nutrient read it as unrecorded
+            compound = str(data['compound']) if 'compound' in data else ''
+            concentration = float(data['concentration']) if 'concentration' in data else numpy.nan
+            return cls(float(data['xmin']), float(data['ymin']), float(data['cellSize']), data['capacity'], data['load'],
+                       datetime.date.fromisoformat(date) if date else None, compound or None,
+                       None if numpy.isnan(concentration) else concentration)
+
+    def save(self, path):
+        """
+        Saves the grid to a compressed NumPy archive.
+        """
+        numpy.savez_compressed(path, xmin=self.xmin, ymin=self.ymin, cellSize=self.cellSize, capacity=self.capacity, load=self.load,
+                               date=self.date.isoformat() if self.date else '', compound=self.compound or '',
+                               concentration=numpy.nan if self.concentration is None else self.concentration)
+
+    def covers(self, bounds):
+        """
+        Returns whether the grid covers the given bounds.
+        """
+        rows, columns = self.capacity.shape
+        return (bounds[0] >= self.xmin and bounds[1] >= self.ymin
+                and bounds[2] <= self.xmin + columns * self.cellSize and bounds[3] <= self.ymin + rows * self.cellSize)
+
+    def extended(self, mask, bounds):
+        """
+        Returns the grid widened on the same cells to cover bounds as well,
+        with the capacity and load of its cells carried across and the
+        capacity of the new cells measured from the mask.
+        """
+        rows, columns = self.capacity.shape
+        # Count whole cells on each side, so the old cells line up with new ones
+        left = int(numpy.ceil(max(self.xmin - bounds[0], 0) / self.cellSize))
+        bottom = int(numpy.ceil(max(self.ymin - bounds[1], 0) / self.cellSize))
+        right = int(numpy.ceil(max(bounds[2] - self.xmin - columns * self.cellSize, 0) / self.cellSize))
+        top = int(numpy.ceil(max(bounds[3] - self.ymin - rows * self.cellSize, 0) / self.cellSize))
+        corner = (self.xmin - left * self.cellSize, self.ymin - bottom * self.cellSize)
+        capacity = cellCapacity(mask, corner, self.cellSize, bottom + rows + top, left + columns + right, self.concentration)
+        load = numpy.zeros_like(capacity)
+        capacity[bottom:bottom + rows, left:left + columns] = self.capacity
+        load[bottom:bottom + rows, left:left + columns] = self.load
+        return NutrientGrid(corner[0], corner[1], self.cellSize, capacity, load, self.date, self.compound, self.concentration)
+
+    def decay(self, date, uptake):
+        """
+        Removes the share of the load taken up by crops since the last
+        application, where uptake is the share taken up in a year.  Dates
+        before the last application cannot be spread on.
+        """
+        if self.date is not None and date < self.date:
+            raise ValueError(f'Cannot spread on {date}, before the last application of the season on {self.date}')
+        if self.date is not None and uptake > 0:
+            self.load *= numpy.float32((1 - uptake) ** ((date - self.date).days / 365))
+        self.date = date
+
+    def apply(self, x, y, nutrient):
+        """
+        Spreads nutrient (in kilograms) around x, y on the nearest capacity
+        left.  Returns the radius reached and the nutrient that could not be
+        placed because the grid ran out.
+        """
+        # Cells fully under the mask keep a rounding residue of capacity
+        if not self.capacity.max() > 1e-3:
+            raise ValueError('The nutrient grid has no land to spread on, the exclusion mask covers every cell')
+        rows, columns = self.capacity.shape
+        # Start from the open land radius and widen until the waste fits
+        reach = numpy.sqrt(nutrient / (numpy.pi * self.capacity.max() / self.cellSize ** 2)) + self.cellSize
+        while True:
+            first = numpy.clip(((numpy.array([y, x]) - [self.ymin, self.xmin] - reach) / self.cellSize).astype(int), 0, None)
+            last = numpy.minimum(((numpy.array([y, x]) - [self.ymin, self.xmin] + reach) / self.cellSize).astype(int) + 1, [rows, columns])
+            window = (slice(first[0], last[0]), slice(first[1], last[1]))
+            distance = numpy.hypot(self.xmin + (numpy.arange(first[1], last[1]) + 0.5) * self.cellSize - x,
+                                   self.ymin + (numpy.arange(first[0], last[0])[:, None] + 0.5) * self.cellSize - y)
+            remaining = self.capacity[window] - self.load[window]
+            whole = (first[0] == 0 and first[1] == 0 and last[0] == rows and last[1] == columns)
+            # Only cells within reach are certain to be nearer than any
+            # outside, and full cells take nothing more
+            row, column = numpy.nonzero(((distance <= reach) | whole) & (remaining > 0))
+            order = numpy.argsort(distance[row, column], kind='stable')
+            row = row[order]
+            column = column[order]
+            distanceInside = distance[row, column]
+            remaining = remaining[row, column]
+            rowInside = row + first[0]
+            columnInside = column + first[1]
+            total = numpy.cumsum(remaining)
+            if (len(total) and total[-1] >= nutrient) or whole:
+                break
+            # Widen by as much as the capacity still missing needs
+            found = total[-1] if len(total) else 0
+            reach *= numpy.clip(1.1 * numpy.sqrt(nutrient / max(found, 1e-9)), 1.2, 4)
+
+        if not len(total):
+            return 0.0, float(nutrient)
+        # Fill the nearest cells, and the last one only as far as needed
+        count = int(numpy.searchsorted(total, nutrient))
+        self.load[rowInside[:count], columnInside[:count]] += remaining[:count]
+        if count < len(total):
+            self.load[rowInside[count], columnInside[count]] += numpy.float32(nutrient - (total[count - 1] if count else 0))
+            return float(distanceInside[count] + self.cellSize / 2), 0.0
+        return float(distanceInside[-1] + self.cellSize / 2), float(nutrient - total[-1])
+
+
+def scheduleBounds(x, y, applications, factor, concentration):
+    """
+    Returns bounds around the farms wide enough for every application of
+    the schedule to be spread on open land.
+    """
+    totals = numpy.zeros(len(x))
+    for date, farm, mass in applications:
+        totals[farm - 1] += mass * factor
+    reach = REACH * numpy.sqrt(totals / (numpy.pi * concentration))
+    return (float((x - reach).min()), float((y - reach).min()), float((x + reach).max()), float((y + reach).max()))
+
+
+def runSeason(x, y, applications, mask, factor, concentration, grid=None, uptake=0, cellSize=CELL_SIZE, compound=None):
+    """
+    Solves every application of a schedule in date order against the
+    capacity the earlier applications left.
+    x and y are arrays of farm coordinates and applications a list of
+    (date, farm, mass) tuples as returned by readSchedule.  A grid from an
+    earlier run is continued, widened where the schedule reaches past it,
+    and must hold a load of the same compound at the same concentration.
+    Returns the grid and a list of result dictionaries with the date, farm,
+    mass, radius, disc and unmet nutrient of each application.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    bounds = scheduleBounds(x, y, applications, factor, concentration)
+    if grid is None:
+        grid = NutrientGrid.fromMask(mask, bounds, concentration, cellSize, compound)
+    else:
+        if grid.compound != compound or grid.concentration is None or not numpy.isclose(grid.concentration, concentration):
+            raise ValueError(f'The season state holds a load of {grid.compound or "an unrecorded compound"} at a concentration of {grid.concentration}, '
+                             f'it cannot be continued with {compound} at {concentration}')
+        if not grid.covers(bounds):
+            grid = grid.extended(mask, bounds)
+
+    results = []
+    for date, farm, mass in applications:
+        grid.decay(date, uptake)
+        radius, unmet = grid.apply(x[farm - 1], y[farm - 1], mass * factor)
+        results.append({
+            'date' : date,
+            'farm' : farm,
+            'mass' : mass,
+            'radius' : radius,
+            'disc' : broilerEngine.makeDiscs(x[farm - 1], y[farm - 1], radius),
+            'unmet' : unmet
+        })
+    return grid, results
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Site suitability surface for planning new broiler sheds.
+Finding where a given mass of waste could be spread closest to the shed
+would otherwise mean solving the buffer once for every candidate site.
+Instead, this module rasterises the exclusion mask once, as the area of
+mask in every cell, and convolves that raster with discs of a few radii
+using the FFT.  This gives the excluded area within each radius around
+every cell at once.  From these the radius the waste needs is interpolated
+for every cell, or the mass that can be spread within a given radius.
+The surface is written as an ESRI ASCII grid, which QGIS and GDAL read
+directly, with a .prj file of its coordinate system.  From the command line, with networks as GeoJSON files:
+
+    python broilerSuitability.py HY_WATERCOURSE.geojson TR_ROAD.geojson radius.asc --mass 3000
+    python broilerSuitability.py HY_WATERCOURSE.geojson TR_ROAD.geojson capacity.asc --radius 2500
+
+The excluded area of a cell cut by the edge of a disc is shared in
+proportion to the share of the cell inside it, so the smaller the cells the
+closer the surface is to solving each site on its own.
+This module has no QGIS dependency.
+"""
+
+# Import relevant Python libraries
+import argparse
+import os
+import warnings
+
+import numpy
+import shapely
+
+# pyproj writes the .prj file of the grid, which not every install has
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+import broilerBatch
+import broilerCompounds
+import broilerEngine
+import broilerSeason
+
+
+# Width of the raster cells, each a candidate site (in metres)
+CELL_SIZE = 100
+# Number of radii the excluded area is measured at
+RADIUS_COUNT = 24
+# Largest radius measured, as a multiple of the open land radius
+REACH = 2
+# Number of samples across a cell used to find the share inside a disc
+KERNEL_SAMPLES = 8
+# Value of cells without an answer in the written grid
+NODATA = -9999
+
+
+def discKernel(radius, cellSize, size, samples=KERNEL_SAMPLES):
+    """
+    Returns a (2 * size + 1) square array of the share of each cell inside a
+    disc of the given radius around the centre of the middle cell.
+    """
+    # Sample points across every cell, as offsets from the middle cell
+    offsets = (numpy.arange(samples) + 0.5) / samples - 0.5
+    centres = numpy.arange(-size, size + 1)
+    positions = (centres[:, None] + offsets[None, :]).ravel() * cellSize
+    inside = numpy.hypot(positions[:, None], positions[None, :]) <= radius
+    return inside.reshape(2 * size + 1, samples, 2 * size + 1, samples).mean(axis=(1, 3))
+
+
+def excludedWithin(excluded, radii, cellSize, samples=KERNEL_SAMPLES):
+    """
+    Returns the excluded area within each radius around every cell of an
+    excluded area raster, shaped (radii, rows, columns).
+    The raster is transformed once and convolved with every disc in the
+    frequency domain.
+    """
+    rows, columns = excluded.shape
+    size = int(numpy.ceil(max(radii) / cellSize + 0.5))
+    # Pad so the convolution is linear rather than wrapping around the edges
+    shape = (rows + 2 * size, columns + 2 * size)
+    spectrum = numpy.fft.rfft2(excluded, shape)
+    areas = numpy.empty((len(radii), rows, columns), dtype=numpy.float32)
+    for index, radius in enumerate(radii):
+        kernel = numpy.fft.rfft2(discKernel(radius, cellSize, size, samples), shape)
+        areas[index] = numpy.fft.irfft2(spectrum * kernel, shape)[size:size + rows, size:size + columns]
+    return numpy.clip(areas, 0, None)
+
+
+def maskRaster(mask, bounds, cellSize=CELL_SIZE, margin=0):
+    """
+    Returns the corner of the first cell of a raster over bounds, widened by
+    margin on every side, and the area of the mask in each of its cells.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    corner = (xmin - margin, ymin - margin)
+    columns = int(numpy.ceil((xmax - xmin + 2 * margin) / cellSize))
+    rows = int(numpy.ceil((ymax - ymin + 2 * margin) / cellSize))
+    return corner, broilerSeason.excludedAreas(mask, corner, cellSize, rows, columns)
+
+
+def requiredRadius(mask, bounds, targetArea, cellSize=CELL_SIZE, radiusCount=RADIUS_COUNT, reach=REACH):
+    """
+    Returns the corner of the first cell of a raster over bounds and the
+    radius a disc around each cell needs for targetArea of open land.
+    Cells whose waste does not fit within reach times the open land radius
+    are NaN.
+    """
+    openRadius = numpy.sqrt(targetArea / numpy.pi)
+    radii = numpy.linspace(openRadius, reach * openRadius, radiusCount)
+    # Cover the land around the sites every disc can reach
+    margin = numpy.ceil(radii[-1] / cellSize) * cellSize
+    corner, excluded = maskRaster(mask, bounds, cellSize, margin)
+    cells = int(margin / cellSize)
+    areas = excludedWithin(excluded, radii, cellSize)[:, cells:-cells, cells:-cells]
+
+    # Find the first radius with enough open land, and interpolate between
+    # it and the radius before
+    netAreas = numpy.pi * radii[:, None, None] ** 2 - areas
+    enough = netAreas >= targetArea
+    first = numpy.argmax(enough, axis=0)
+    before = numpy.maximum(first - 1, 0)
+    low = numpy.take_along_axis(netAreas, before[None], axis=0)[0]
+    high = numpy.take_along_axis(netAreas, first[None], axis=0)[0]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        share = numpy.where(high > low, (targetArea - low) / (high - low), 1)
+    radius = radii[before] + numpy.clip(share, 0, 1) * (radii[first] - radii[before])
+    radius[~enough.any(axis=0)] = numpy.nan
+    return (corner[0] + margin, corner[1] + margin), radius
+
+
+def netCapacity(mask, bounds, radius, cellSize=CELL_SIZE):
+    """
+    Returns the corner of the first cell of a raster over bounds and the
+    open land within radius of each cell.
+    """
+    margin = numpy.ceil(radius / cellSize) * cellSize
+    corner, excluded = maskRaster(mask, bounds, cellSize, margin)
+    cells = int(margin / cellSize)
+    areas = excludedWithin(excluded, [radius], cellSize)[0, cells:-cells, cells:-cells]
+    return (corner[0] + margin, corner[1] + margin), numpy.pi * radius ** 2 - areas
+
+
+def writeASCII(path, raster, corner, cellSize, epsg=None, nodata=NODATA):
+    """
+    Writes a raster, with its first row at the bottom, to an ESRI ASCII grid.
+    NaN cells are written as nodata.  Given an EPSG code, the WKT of its
+    coordinate system is written beside the grid as a .prj file, with a
+    warning when pyproj is not installed.
+    """
+    rows, columns = raster.shape
+    with open(path, 'w') as file:
+        file.write(f'ncols {columns}\nnrows {rows}\nxllcorner {corner[0]}\nyllcorner {corner[1]}\ncellsize {cellSize}\nNODATA_value {nodata}\n')
+        # Grids list their top row first
+        numpy.savetxt(file, numpy.where(numpy.isnan(raster), nodata, raster)[::-1], fmt='%.2f')
+    if epsg is None:
+        return
+    if pyproj is None:
+        warnings.warn(f'pyproj is not installed, so no .prj file is written and the grid has no coordinate system, '
+                      'install it with "python -m pip install pyproj"', RuntimeWarning)
+        return
+    with open(f'{os.path.splitext(path)[0]}.prj', 'w') as file:
+        file.write(pyproj.CRS.from_epsg(epsg).to_wkt('WKT1_ESRI'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the spreading radius or capacity of every candidate farm site in a region.')
+    parser.add_argument('hydro', help='GeoJSON file of the hydro network')
+    parser.add_argument('road', help='GeoJSON file of the road network')
+    parser.add_argument('output', help='ESRI ASCII grid (.asc) the surface is written to')
+    parser.add_argument('--compound', default='Nitrogen', choices=list(broilerCompounds.COMPOUNDS))
+    parser.add_argument('--mass', type=float, default=3000, help='mass of waste to spread (in tonnes)')
+    parser.add_argument('--radius', type=float, help='write the mass of waste (in tonnes) that can be spread within this radius instead')
+    parser.add_argument('--bounds', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='region of candidate sites (defaults to the extent of the networks)')
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE)
+    parser.add_argument('--epsg', type=int, help='EPSG code of the networks and the grid (defaults to the coordinate system the networks name)')
+    arguments = parser.parse_args()
+
+    hydroLines, _, hydroEPSG = broilerBatch.readGeoJSON(arguments.hydro)
+    roadLines, _, roadEPSG = broilerBatch.readGeoJSON(arguments.road)
+    # Both networks must be in one projected coordinate system in metres,
+    # which the grid is written in
+    if arguments.epsg is None and roadEPSG != hydroEPSG:
+        raise ValueError(f'{arguments.road} is in EPSG:{roadEPSG} but {arguments.hydro} is in EPSG:{hydroEPSG}, reproject the networks to one coordinate system')
+    epsg = arguments.epsg or hydroEPSG
+    broilerBatch.requireMetres(epsg, arguments.hydro)
+    bounds = arguments.bounds or shapely.total_bounds(numpy.concatenate([hydroLines, roadLines])).tolist()
+    mask = broilerEngine.prepareMask(hydroLines, roadLines)
+    factor, concentration = broilerCompounds.COMPOUNDS[arguments.compound]
+
+    if arguments.radius is not None:
+        corner, netArea = netCapacity(mask, bounds, arguments.radius, arguments.cell_size)
+        writeASCII(arguments.output, netArea * concentration / factor, corner, arguments.cell_size, epsg)
+        print(f'Mass that can be spread within {arguments.radius} m written for {netArea.size} sites')
+    else:
+        corner, radius = requiredRadius(mask, bounds, arguments.mass * factor / concentration, arguments.cell_size)
+        writeASCII(arguments.output, radius, corner, arguments.cell_size, epsg)
+        print(f'Radius needed for {arguments.mass} t written for {radius.size} sites, {int(numpy.isnan(radius).sum())} without enough land')
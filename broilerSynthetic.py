@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+Seeded generator of synthetic study areas for the broiler buffer process.
+TestData.zip is one small study area, so it cannot show how the tool
+behaves on much larger networks or with hundreds of farms.  This module
+builds road grids, dendritic stream networks and farm points at a chosen
+density and size, with the vertex spacing of survey-grade data, so the
+engines can be tested and benchmarked at any scale.
+The defaults match TestData: about 690 square kilometres with 1.4 km of road
+and 1.6 km of watercourse per square kilometre, in GDA2020 MGA Zone 55.
+This module has no QGIS dependency.  Run it as a script to write a study
+area as GeoJSON files QGIS can open.
+"""
+
+# Import relevant Python libraries
+import argparse
+import json
+import os
+
+import numpy
+import shapely
+
+
+# EPSG code of the coordinate system the study areas are placed in
+EPSG = 7855
+# Lower left corner and size (in metres) of a study area at scale 1
+ORIGIN = (455000, 5775000)
+WIDTH = 35600
+HEIGHT = 19400
+# Length of network per square kilometre (in kilometres)
+ROAD_DENSITY = 1.4
+STREAM_DENSITY = 1.6
+# Distance between vertices along the lines (in metres)
+VERTEX_SPACING = 30
+# Largest sideways wobble given to line vertices (in metres)
+WOBBLE = 5
+# Share of road grid edges left out, so the grid is not complete
+ROAD_GAPS = 0.2
+# Size of the lattice cells streams are routed over (in metres)
+STREAM_CELL = 150
+# Range of waste mass at each farm (in tonnes)
+MASS_RANGE = (500, 5000)
+
+
+def studyBounds(scale=1):
+    """
+    Returns the (xmin, ymin, xmax, ymax) bounds of a study area scale times
+    the area of TestData.
+    """
+    factor = numpy.sqrt(scale)
+    return (ORIGIN[0], ORIGIN[1], ORIGIN[0] + WIDTH * factor, ORIGIN[1] + HEIGHT * factor)
+
+
+def wobble(lines, generator, vertexSpacing=VERTEX_SPACING, amount=WOBBLE):
+    """
+    Returns lines with vertices every vertexSpacing, each moved randomly by
+    up to amount, as surveyed lines follow the ground rather than a ruler.
+    """
+    lines = shapely.segmentize(lines, vertexSpacing)
+    coordinates, index = shapely.get_coordinates(lines, return_index=True)
+    coordinates = coordinates + generator.uniform(-amount, amount, coordinates.shape)
+    return shapely.linestrings(coordinates, indices=index)
+
+
+def roadGrid(bounds, density=ROAD_DENSITY, vertexSpacing=VERTEX_SPACING, seed=None):
+    """
+    Returns an array of road lines forming a jittered grid with gaps, one line
+    between each pair of neighbouring intersections.
+    """
+    generator = numpy.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    # A square grid of spacing s has 2 / s of road per unit area
+    spacing = 2 * (1 - ROAD_GAPS) / density * 1000
+    columns = int((xmax - xmin) / spacing) + 1
+    rows = int((ymax - ymin) / spacing) + 1
+    # Jitter every intersection within a quarter of the spacing
+    x = xmin + spacing * (numpy.arange(columns)[None, :] + 0.5) + generator.uniform(-spacing / 4, spacing / 4, (rows, columns))
+    y = ymin + spacing * (numpy.arange(rows)[:, None] + 0.5) + generator.uniform(-spacing / 4, spacing / 4, (rows, columns))
+    nodes = numpy.stack([x.ravel(), y.ravel()], axis=1)
+    node = numpy.arange(rows * columns).reshape(rows, columns)
+
+    # Join each intersection to its right and upper neighbours
+    starts = numpy.concatenate([node[:, :-1].ravel(), node[:-1, :].ravel()])
+    ends = numpy.concatenate([node[:, 1:].ravel(), node[1:, :].ravel()])
+    keep = generator.random(len(starts)) >= ROAD_GAPS
+    lines = shapely.linestrings(numpy.stack([nodes[starts[keep]], nodes[ends[keep]]], axis=1))
+    return wobble(lines, generator, vertexSpacing)
+
+
+def streamNetwork(bounds, density=STREAM_DENSITY, vertexSpacing=VERTEX_SPACING, seed=None, cell=STREAM_CELL):
+    """
+    Returns an array of dendritic watercourse lines, one line between each
+    pair of confluences.
+    Water is routed over a lattice in the manner of Scheidegger's model: every
+    cell drains to one of the three cells below it, and cells draining enough
+    of the lattice above them carry a stream.  The drainage needed is chosen
+    to give the requested length of stream.
+    """
+    generator = numpy.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    columns = int((xmax - xmin) / cell)
+    rows = int((ymax - ymin) / cell)
+
+    # Choose the cell below each cell drains to, staying on the lattice
+    target = numpy.clip(numpy.arange(columns)[None, :] + generator.integers(-1, 2, (rows, columns)), 0, columns - 1)
+    # Accumulate the drainage of every cell from the top row down
+    drainage = numpy.ones((rows, columns))
+    for row in range(rows - 1, 0, -1):
+        numpy.add.at(drainage[row - 1], target[row], drainage[row])
+
+    # Keep the most draining cells until their edges are as long as the
+    # stream length needs, with diagonal edges counting for more
+    edgeLength = cell * numpy.hypot(1, target[1:] - numpy.arange(columns)[None, :]).ravel()
+    order = numpy.argsort(-drainage[1:].ravel(), kind='stable')
+    count = numpy.searchsorted(numpy.cumsum(edgeLength[order]), density * (xmax - xmin) * (ymax - ymin) / 1000)
+    row, column = numpy.unravel_index(order[:count], (rows - 1, columns))
+    row += 1
+    x = xmin + (numpy.arange(columns) + 0.5) * cell
+    y = ymin + (numpy.arange(rows) + 0.5) * cell
+    edges = shapely.linestrings(numpy.stack([
+        numpy.stack([x[column], y[row]], axis=1),
+        numpy.stack([x[target[row, column]], y[row - 1]], axis=1)
+    ], axis=1))
+
+    # Join the edges between confluences into single watercourses
+    lines = shapely.get_parts(shapely.line_merge(shapely.multilinestrings(edges)))
+    return wobble(lines, generator, vertexSpacing)
+
+
+def farmPoints(bounds, count, massRange=MASS_RANGE, seed=None):
+    """
+    Returns an array of farm points spread over the middle of a study area and
+    the waste mass of each.
+    """
+    generator = numpy.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = bounds
+    # Keep farms clear of the edges, where their buffers would be cut short
+    marginX = (xmax - xmin) / 10
+    marginY = (ymax - ymin) / 10
+    x = generator.uniform(xmin + marginX, xmax - marginX, count)
+    y = generator.uniform(ymin + marginY, ymax - marginY, count)
+    return shapely.points(x, y), generator.uniform(massRange[0], massRange[1], count)
+
+
+def studyArea(scale=1, farms=1, seed=0):
+    """
+    Returns a dictionary of the hydro and road lines, farm points and masses
+    and bounds of a study area scale times the area of TestData.
+    """
+    bounds = studyBounds(scale)
+    # Give each layer its own stream of random numbers from the one seed
+    hydroSeed, roadSeed, farmSeed = numpy.random.SeedSequence(seed).spawn(3)
+    points, masses = farmPoints(bounds, farms, seed=farmSeed)
+    return {
+        'hydro' : streamNetwork(bounds, seed=hydroSeed),
+        'road' : roadGrid(bounds, seed=roadSeed),
+        'points' : points,
+        'masses' : masses,
+        'bounds' : bounds
+    }
+
+
+def writeGeoJSON(path, geometries, properties=None, epsg=EPSG):
+    """
+    Writes an array of geometries, with a list of property dictionaries, to a
+    GeoJSON file with a named coordinate system.
+    """
+    features = []
+    for index, geometry in enumerate(shapely.to_geojson(geometries)):
+        features.append({
+            'type' : 'Feature',
+            'properties' : properties[index] if properties is not None else {'Id' : index + 1},
+            'geometry' : json.loads(geometry)
+        })
+    with open(path, 'w') as file:
+        json.dump({
+            'type' : 'FeatureCollection',
+            'crs' : {'type' : 'name', 'properties' : {'name' : f'urn:ogc:def:crs:EPSG::{epsg}'}},
+            'features' : features
+        }, file)
+
+
+def writeStudyArea(folder, area):
+    """
+    Writes a study area to GeoJSON files named after the TestData layers.
+    Returns the paths of the hydro, road and farm files.
+    """
+    os.makedirs(folder, exist_ok=True)
+    hydroFile = os.path.join(folder, 'HY_WATERCOURSE.geojson')
+    roadFile = os.path.join(folder, 'TR_ROAD.geojson')
+    pointFile = os.path.join(folder, 'CentralPoint.geojson')
+    writeGeoJSON(hydroFile, area['hydro'])
+    writeGeoJSON(roadFile, area['road'])
+    writeGeoJSON(pointFile, area['points'], [{'Id' : index + 1, 'mass' : round(float(mass), 1)} for index, mass in enumerate(area['masses'])])
+    return hydroFile, roadFile, pointFile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic study area for the broiler buffer process.')
+    parser.add_argument('folder', help='folder the GeoJSON files are written to')
+    parser.add_argument('--scale', type=float, default=1, help='area as a multiple of TestData')
+    parser.add_argument('--farms', type=int, default=1, help='number of farm points')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    arguments = parser.parse_args()
+    area = studyArea(arguments.scale, arguments.farms, arguments.seed)
+    for path in writeStudyArea(arguments.folder, area):
+        print(path)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background tasks for the Broiler Network Buffer algorithm.
+Running the algorithm from the Processing Toolbox ties up one dialog per
+run.  This module splits a farm layer into groups and runs the algorithm on
+each group as its own task in the QGIS task manager, so the groups are
+solved in parallel and the interface stays free while they run.  From the
+QGIS Python console, with the script loaded in the Processing Toolbox:
+
+    import broilerTasks
+    task = broilerTasks.queueBatch({'HYDRO' : hydroLayer, 'ROAD' : roadLayer, 'MASS' : 3000,
+                                    'COMPOUND' : 0, 'ITERATIONS' : 10}, farmLayer, finished=show)
+
+finished is called with the output layer of every group and the messages
+of any group that failed.  When results are cached, the first group runs
+on its own and prepares the exclusion mask, and the rest then read it from
+the mask cache rather than each preparing their own.
+"""
+
+# Import relevant Python and PyQGIS libraries
+import functools
+
+from qgis.core import (QgsApplication,
+                       QgsProcessing,
+                       QgsProcessingAlgRunnerTask,
+                       QgsProcessingContext,
+                       QgsProcessingFeedback,
+                       QgsProject,
+                       QgsTask,
+                       QgsVectorLayer,
+                       QgsWkbTypes)
+
+
+# Identifier of the Broiler Network Buffer algorithm in the Processing Toolbox
+ALGORITHM = 'script:broilernetworkbuffer'
+# Number of farms solved by each task
+FARMS_PER_TASK = 25
+
+
+def farmLayers(pointLayer, farmsPerTask=FARMS_PER_TASK):
+    """
+    Returns memory layers holding the farms of a point layer in groups of
+    farmsPerTask, with its fields and CRS.
+    """
+    features = list(pointLayer.getFeatures())
+    layers = []
+    for start in range(0, len(features), farmsPerTask):
+        group = features[start:start + farmsPerTask]
+        layer = QgsVectorLayer(QgsWkbTypes.displayString(pointLayer.wkbType()), f'Farms {start + 1} to {start + len(group)}', 'memory')
+        layer.setCrs(pointLayer.crs())
+        layer.dataProvider().addAttributes(pointLayer.fields().toList())
+        layer.updateFields()
+        layer.dataProvider().addFeatures(group)
+        layers.append(layer)
+    return layers
+
+
+class BroilerBatchTask(QgsTask):
+    """
+    Task running the algorithm on groups of farms as concurrent subtasks.
+    parameters are those of the algorithm, less the farm layer and output,
+    which are set for each group.
+    """
+
+    def __init__(self, parameters, pointLayer, farmsPerTask=FARMS_PER_TASK, finished=None):
+        super().__init__('Broiler Network Buffer batch', QgsTask.CanCancel)
+        algorithm = QgsApplication.processingRegistry().algorithmById(ALGORITHM)
+        if algorithm is None:
+            raise ValueError(f'The {ALGORITHM} algorithm is not loaded in the Processing Toolbox')
+        self.callback = finished
+        self.layers = []
+        self.errors = []
+        # Keep the context and feedback of every group alive until it ends
+        self.runs = []
+
+        first = None
+        for index, layer in enumerate(farmLayers(pointLayer, farmsPerTask)):
+            # Give each group its own context, so no two share state
+            context = QgsProcessingContext()
+            context.setProject(QgsProject.instance())
+            context.temporaryLayerStore().addMapLayer(layer)
+            feedback = QgsProcessingFeedback()
+            groupParameters = dict(parameters, INPUT=layer.id(), OUTPUT=QgsProcessing.TEMPORARY_OUTPUT)
+            task = QgsProcessingAlgRunnerTask(algorithm, groupParameters, context, feedback)
+            task.executed.connect(functools.partial(self.collect, index, layer.name(), context, feedback))
+            self.runs.append((context, feedback, task))
+
+            # Let the first group fill the mask cache before the rest start
+            waitFor = [first] if first is not None and parameters.get('USE_CACHE', True) else []
+            self.addSubTask(task, waitFor, QgsTask.ParentDependsOnSubTask)
+            if first is None:
+                first = task
+
+    def collect(self, index, name, context, feedback, successful, results):
+        """
+        Keeps the output layer of a group once it has been solved.
+        """
+        if successful:
+            layer = context.takeResultLayer(results['OUTPUT'])
+            layer.setName(f'Broiler buffers, {name.lower()}')
+            self.layers.append((index, layer))
+        else:
+            self.errors.append(f'{name} failed: {feedback.textLog().strip() or "cancelled"}')
+
+    def run(self):
+        """
+        The groups are solved by the subtasks, so there is nothing to do here.
+        """
+        return True
+
+    def finished(self, result):
+        """
+        Passes the output layers, in the order of the farms, and any errors to
+        the finished callback.
+        """
+        if self.callback is not None:
+            self.callback([layer for index, layer in sorted(self.layers, key=lambda pair: pair[0])], self.errors)
+
+
+def queueBatch(parameters, pointLayer, farmsPerTask=FARMS_PER_TASK, finished=None):
+    """
+    Queues a batch of the algorithm on the farms of a point layer in the QGIS
+    task manager and returns its task.
+    """
+    task = BroilerBatchTask(parameters, pointLayer, farmsPerTask, finished)
+    QgsApplication.taskManager().addTask(task)
+    return task
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Monte Carlo uncertainty mode for the broiler buffer process.
+The nutrient factors, concentrations, waste mass and buffer distances used by
+the tool are point estimates, but laboratory results for waste vary a lot
+between batches.  This module samples thousands of combinations of them from
+user-supplied distributions and reports percentiles of the solved area and
+radius.
+Rather than running thousands of full solves, the exclusion around a farm is
+measured once as a profile: the excluded area inside discs of many radii, for
+a small grid of buffer distances.  Every sample is then solved at once by
+interpolating in that profile, so 10,000 draws take seconds.
+"""
+
+# Import relevant Python libraries
+import re
+
+import numpy
+import shapely
+
+import broilerEngine
+
+
+# Names of the quantities that can be given a distribution
+QUANTITIES = ['mass', 'factor', 'concentration', 'hydroDistance', 'roadDistance']
+# Number of parameters each kind of distribution takes
+DISTRIBUTIONS = {'fixed' : 1, 'normal' : 2, 'lognormal' : 2, 'uniform' : 2, 'triangular' : 3}
+# Number of radii the exclusion profile is measured at
+PROFILE_RADII = 200
+# Number of buffer distances the profile is measured at, for each network
+PROFILE_DISTANCES = 3
+# Percentiles reported and output as discs
+PERCENTILES = [10, 50, 90]
+
+
+def parseDistributions(text):
+    """
+    Returns a dictionary of distributions from text such as
+    'mass=normal(3000, 300); concentration=uniform(0.0025, 0.0029)'.
+    Each distribution is a (kind, parameters) tuple.  Normal and lognormal
+    distributions take a mean and standard deviation, uniform a low and high
+    value, triangular a low, most likely and high value.
+    """
+    distributions = {}
+    for entry in filter(None, (part.strip() for part in (text or '').split(';'))):
+        match = re.fullmatch(r'(\w+)\s*=\s*(\w+)\s*\(([^)]*)\)', entry)
+        if match is None:
+            raise ValueError(f'Cannot read distribution "{entry}"')
+        name, kind, parameters = match.groups()
+        if name not in QUANTITIES:
+            raise ValueError(f'Unknown quantity "{name}", expected one of {", ".join(QUANTITIES)}')
+        if kind not in DISTRIBUTIONS:
+            raise ValueError(f'Unknown distribution "{kind}", expected one of {", ".join(DISTRIBUTIONS)}')
+        values = [float(value) for value in parameters.split(',')]
+        if len(values) != DISTRIBUTIONS[kind]:
+            raise ValueError(f'A {kind} distribution takes {DISTRIBUTIONS[kind]} values')
+        distributions[name] = (kind, values)
+    return distributions
+
+
+def sample(distributions, defaults, count, seed=None):
+    """
+    Returns a dictionary of arrays of count samples of every quantity.
+    Quantities without a distribution keep their value in defaults.  Samples
+    are kept positive.
+    """
+    generator = numpy.random.default_rng(seed)
+    samples = {}
+    for name in QUANTITIES:
+        kind, values = distributions.get(name, ('fixed', [defaults[name]]))
+        if kind == 'fixed':
+            drawn = numpy.full(count, values[0])
+        elif kind == 'normal':
+            drawn = generator.normal(values[0], values[1], count)
+        elif kind == 'lognormal':
+            # Convert the mean and deviation to those of the underlying normal
+            variance = numpy.log(1 + (values[1] / values[0]) ** 2)
+            drawn = generator.lognormal(numpy.log(values[0]) - variance / 2, numpy.sqrt(variance), count)
+        elif kind == 'uniform':
+            drawn = generator.uniform(values[0], values[1], count)
+        else:
+            drawn = generator.triangular(values[0], values[1], values[2], count)
+        samples[name] = numpy.maximum(drawn, 1e-9)
+    return samples
+
+
+def exclusionProfile(hydroLines, roadLines, x, y, maxRadius, hydroDistances, roadDistances, radiusCount=PROFILE_RADII, segments=broilerEngine.DISC_SEGMENTS):
+    """
+    Returns the radii and the excluded area inside a disc of each radius
+    around x, y, for every pair of hydro and road buffer distances.  The
+    areas are shaped (hydro distances, road distances, radii).
+    Only the network within reach of the largest disc is buffered.
+    """
+    radii = numpy.linspace(0, maxRadius, radiusCount)
+    discs = broilerEngine.makeDiscs(numpy.full(radiusCount, x), numpy.full(radiusCount, y), radii, segments)
+    # Keep only the lines that can reach the largest disc
+    reach = maxRadius + max(numpy.max(hydroDistances), numpy.max(roadDistances))
+    window = shapely.box(x - reach, y - reach, x + reach, y + reach)
+    hydroLines = hydroLines[shapely.intersects(hydroLines, window)]
+    roadLines = roadLines[shapely.intersects(roadLines, window)]
+
+    areas = numpy.zeros((len(hydroDistances), len(roadDistances), radiusCount))
+    for hydroIndex, hydroDistance in enumerate(hydroDistances):
+        hydroBuffer = broilerEngine.bufferNetwork(hydroLines, hydroDistance)
+        for roadIndex, roadDistance in enumerate(roadDistances):
+            mask = broilerEngine.ExclusionMask.fromGeometry(
+                shapely.union_all([hydroBuffer, broilerEngine.bufferNetwork(roadLines, roadDistance)])
+            )
+            areas[hydroIndex, roadIndex] = mask.clipAreas(discs)
+    return radii, areas
+
+
+def interpolateProfile(radii, areas, hydroDistances, roadDistances, radius, hydroDistance, roadDistance):
+    """
+    Returns the excluded area inside discs of each radius for each pair of
+    buffer distances, interpolated linearly in the profile.
+    """
+    def locate(grid, values):
+        # Find the grid cell and the position within it of every value
+        if len(grid) == 1:
+            return numpy.zeros(len(values), dtype=int), numpy.zeros(len(values))
+        index = numpy.clip(numpy.searchsorted(grid, values) - 1, 0, len(grid) - 2)
+        weight = numpy.clip((values - grid[index]) / (grid[index + 1] - grid[index]), 0, 1)
+        return index, weight
+
+    hydroIndex, hydroWeight = locate(hydroDistances, hydroDistance)
+    roadIndex, roadWeight = locate(roadDistances, roadDistance)
+    radiusIndex, radiusWeight = locate(radii, radius)
+    hydroNext = numpy.minimum(hydroIndex + 1, len(hydroDistances) - 1)
+    roadNext = numpy.minimum(roadIndex + 1, len(roadDistances) - 1)
+
+    # Interpolate along the radius, then between the buffer distances
+    def alongRadius(h, r):
+        return areas[h, r, radiusIndex] * (1 - radiusWeight) + areas[h, r, radiusIndex + 1] * radiusWeight
+    return (alongRadius(hydroIndex, roadIndex) * (1 - hydroWeight) * (1 - roadWeight)
+            + alongRadius(hydroNext, roadIndex) * hydroWeight * (1 - roadWeight)
+            + alongRadius(hydroIndex, roadNext) * (1 - hydroWeight) * roadWeight
+            + alongRadius(hydroNext, roadNext) * hydroWeight * roadWeight)
+
+
+def simulate(hydroLines, roadLines, x, y, samples, iterations):
+    """
+    Solves the buffer of every sample at once for a farm at x, y.
+    samples is a dictionary of arrays as returned by sample.  Returns arrays
+    of the solved disc area and radius of every sample.
+    """
+    targetArea = samples['mass'] * samples['factor'] / samples['concentration']
+    hydroDistances = numpy.unique(numpy.linspace(samples['hydroDistance'].min(), samples['hydroDistance'].max(), PROFILE_DISTANCES))
+    roadDistances = numpy.unique(numpy.linspace(samples['roadDistance'].min(), samples['roadDistance'].max(), PROFILE_DISTANCES))
+    maxRadius = 1.5 * numpy.sqrt(targetArea.max() / numpy.pi)
+
+    while True:
+        radii, areas = exclusionProfile(hydroLines, roadLines, x, y, maxRadius, hydroDistances, roadDistances)
+        # Repeat the iterative process of the solver on every sample
+        areaBuff = targetArea.copy()
+        for count in range(iterations):
+            radius = broilerEngine.discRadius(areaBuff)
+            areaBuff = targetArea + interpolateProfile(radii, areas, hydroDistances, roadDistances, radius, samples['hydroDistance'], samples['roadDistance'])
+        radius = broilerEngine.discRadius(areaBuff)
+        # Measure a larger profile if any disc outgrew this one
+        if radius.max() <= maxRadius:
+            return areaBuff, radius
+        maxRadius = 1.5 * radius.max()